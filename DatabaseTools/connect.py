@@ -1,14 +1,74 @@
+import functools
+import itertools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
 import psycopg2
+import psycopg2.errors
 import psycopg2.extras
-from psycopg2.extras import RealDictCursor
+import psycopg2.pool
+from psycopg2.extras import RealDictCursor, execute_values
 from psycopg2 import sql
 
+from DatabaseTools.statements import StatementCache
+from Utils.metrics import METRICS
+
+log = logging.getLogger(__name__)
+
+# Номера для имен серверных курсоров
+_cursor_ids = itertools.count(1)
+
+# Ошибки потери соединения с сервером (в том числе обрыв TLS-сессии)
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+
+def reconnecting(method):
+    """
+    Декоратор методов DB: если во время выполнения соединение с сервером
+    было потеряно, метод выполняется повторно на новом соединении (не
+    больше DB.retries раз). Внутри внешнего connection() повтор не
+    выполняется - ошибка передается владельцу транзакции.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        attempt = 0
+        while True:
+            nested = getattr(self._local, 'con', None) is not None
+            self._local.lost = False
+            try:
+                return method(self, *args, **kwargs)
+            except CONNECTION_ERRORS as exc:
+                attempt += 1
+                if nested or not self._local.lost or attempt > self.retries:
+                    raise
+                log.warning(f'{exc} Соединение с БД потеряно, повтор '
+                            f'запроса.')
+    return wrapper
+
 
 class DB:
     """
     Класс для работы с БД в проекте с необходимым функционалом.
     По умолчанию использует локальный сервер '127.0.0.1', порт 5432,
     sslmode='require' и sslrootcert=''.
+
+    Собранные запросы частых операций кэшируются (self.statements, см.
+    StatementCache). Если задан prepare_threshold, запросы, выполненные
+    столько раз, подготавливаются на сервере (PREPARE).
+
+    Соединения берутся из пула (от minconn до maxconn соединений), поэтому
+    DB можно использовать из нескольких потоков. Соединение, простоявшее
+    без дела дольше health_check_interval секунд, перед выдачей
+    проверяется запросом "select 1", разорванные соединения заменяются
+    новыми. Метод, во время которого соединение оборвалось, повторяется
+    (retries раз).
+
+    Пример.
+    with db.connection() as con:
+        with con.cursor() as cur:
+            cur.execute("select 1")
     """
     def __init__(self,
                  database: str,
@@ -17,30 +77,161 @@ class DB:
                  host='127.0.0.1',
                  port=5432,
                  sslmode='require',
-                 sslrootcert=''
+                 sslrootcert='',
+                 prepare_threshold=None,
+                 minconn=1,
+                 maxconn=4,
+                 health_check_interval=30.0,
+                 retries=1
                  ) -> None:
 
         # https://help.compose.com/docs/postgresql-and-python
         # https://stackoverflow.com/questions/28228241/how-to-connect-to-a
         # -remote-postgresql-database-through-ssl-with-python
 
-        self.con = psycopg2.connect(database=database,
-                                    user=user,
-                                    password=password,
-                                    host=host,
-                                    port=port,
-                                    sslmode=sslmode,
-                                    sslrootcert=sslrootcert
-                                    )
+        self.pool = psycopg2.pool.ThreadedConnectionPool(
+            minconn, maxconn,
+            database=database,
+            user=user,
+            password=password,
+            host=host,
+            port=port,
+            sslmode=sslmode,
+            sslrootcert=sslrootcert
+        )
+        # ThreadedConnectionPool не ждет освобождения соединения, поэтому
+        # число выданных соединений ограничивается семафором
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._local = threading.local()
+        # {id(соединения): время возврата в пул}
+        self._released = {}
+        self.health_check_interval = health_check_interval
+        self.retries = retries
+        self.statements = StatementCache(prepare_threshold)
+
+    @contextmanager
+    def connection(self):
+        """
+        Соединение из пула для одной задачи, с транзакцией: при выходе
+        из блока изменения фиксируются, при ошибке - откатываются, затем
+        соединение возвращается в пул.
+
+        Вложенные вызовы в том же потоке (в том числе методы DB внутри
+        блока) используют то же соединение и ту же транзакцию.
 
-    def create_table(self, table: str, schema: list) -> None:
+        :return: соединение psycopg2
         """
-        Создает таблицу в БД.
+        con = getattr(self._local, 'con', None)
+        if con is not None:
+            yield con
+            return
+
+        con = self.acquire()
+        self._local.con = con
+        try:
+            with con:
+                yield con
+        except CONNECTION_ERRORS:
+            if con.closed:
+                self._local.lost = True
+            raise
+        finally:
+            self._local.con = None
+            self.release(con)
+
+    def transaction(self):
+        """
+        Единица работы: все методы DB, вызванные в блоке в этом потоке
+        (в том числе BulkWriter.flush()), выполняются в одной транзакции
+        с одной фиксацией при выходе из блока. При ошибке все изменения
+        блока откатываются.
+
+        Пример.
+        with db.transaction():
+            db.insert_record("book_books", record)
+            db.insert_record("service_info", info)
+
+        :return: контекстный менеджер соединения (см. connection())
+        """
+        return self.connection()
+
+    def acquire(self):
+        """
+        Взять из пула рабочее соединение (ожидает, если все соединения
+        заняты). Соединение нужно вернуть методом release().
+
+        :return: соединение psycopg2
+        """
+        self._slots.acquire()
+        try:
+            while True:
+                con = self.pool.getconn()
+                if self._healthy(con):
+                    return con
+                log.warning('Соединение с БД разорвано, переподключение.')
+                self._discard(con)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, con) -> None:
+        """
+        Вернуть соединение в пул. Разорванное соединение закрывается.
+
+        :param con: соединение psycopg2
+        """
+        try:
+            if con.closed:
+                self._discard(con)
+            else:
+                self._released[id(con)] = time.monotonic()
+                self.pool.putconn(con)
+        finally:
+            self._slots.release()
+
+    def _healthy(self, con) -> bool:
+        if con.closed:
+            return False
+        idle = time.monotonic() - self._released.get(id(con), 0.0)
+        if idle < self.health_check_interval:
+            return True
+        try:
+            with con.cursor() as cur:
+                cur.execute("select 1")
+            con.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def _discard(self, con) -> None:
+        self._released.pop(id(con), None)
+        self.statements.forget(con)
+        self.pool.putconn(con, close=True)
+
+    def close(self) -> None:
+        """
+        Закрыть все соединения пула.
+        """
+        self.pool.closeall()
+
+    @METRICS.timed('db_query')
+    @reconnecting
+    def create_table(self, table: str, schema: list, indexes=None,
+                     deduplicate=False) -> None:
+        """
+        Создает таблицу в БД и ее индексы. Повторный вызов безопасен:
+        существующие таблица, столбцы и индексы не изменяются, недостающие
+        столбцы и индексы создаются.
 
         :param table: название таблицы (например, "main_mains")
         :param schema: список подстрок SQL-запроса создания столбцов
         (например, ["ID serial primary key", "CHANNEL_ID bigint NOT NULL",
         "FILE_NAME VARCHAR(255)", ...])
+        :param indexes: список индексов вида (суффикс, уникальный,
+        определение) (например, [("channel_message_key", True,
+        "(CHANNEL_ID, MESSAGE_ID)")])
+        :param deduplicate: удалять дубликаты строк, мешающие созданию
+        уникального индекса
         :return: None
         """
 
@@ -48,11 +239,121 @@ class DB:
             sql.Identifier(table),
             sql.SQL(','.join(schema))
         )
-        with self.con:
-            with self.con.cursor() as cur:
+        with self.connection() as con:
+            with con.cursor() as cur:
+                cur.execute(query)
+        log.info(f'таблица: {table} создана/существует')
+
+        self.add_columns(table, schema)
+        for suffix, unique, definition in indexes or []:
+            self.create_index(table, suffix, unique, definition, deduplicate)
+
+    @METRICS.timed('db_query')
+    @reconnecting
+    def add_columns(self, table: str, schema: list) -> list:
+        """
+        Добавляет в существующую таблицу столбцы из схемы, которых в ней
+        нет (например, столбцы, появившиеся в схеме после создания таблицы).
+
+        :param table: название таблицы (например, "main_mains")
+        :param schema: список подстрок SQL-запроса создания столбцов
+        :return: список добавленных столбцов
+        """
+        existing = {column[0].lower() for column in self.get_schema(table)}
+        added = []
+        for column in schema:
+            name = column.split()[0]
+            if name.lower() in existing:
+                continue
+            query = sql.SQL("alter table {} add column {}").format(
+                sql.Identifier(table),
+                sql.SQL(column)
+            )
+            with self.connection() as con:
+                with con.cursor() as cur:
+                    cur.execute(query)
+            added.append(name)
+            log.info(f'таблица: {table} добавлен столбец {name}')
+        return added
+
+    def create_index(self, table: str, suffix: str, unique: bool,
+                     definition: str, deduplicate=False) -> bool:
+        """
+        Создает индекс "{table}_{suffix}", если он не существует.
+
+        Если уникальный индекс создать нельзя из-за дубликатов в таблице,
+        то при deduplicate=True лишние строки удаляются (остается строка с
+        наибольшей датой, см. delete_duplicates()), иначе вместо
+        уникального создается обычный индекс "{table}_{suffix}_nonunique".
+
+        :param table: название таблицы (например, "service_info")
+        :param suffix: суффикс имени индекса (например, "channel_message_key")
+        :param unique: уникальный индекс или нет
+        :param definition: столбцы и условие индекса
+        (например, "(channel_id, message_id)")
+        :param deduplicate: удалять дубликаты строк
+        :return: True - создан/существует требуемый индекс, False - создан
+        обычный индекс вместо уникального
+        """
+        name = f'{table}_{suffix}'
+        try:
+            self._execute_index(table, name, unique, definition)
+        except psycopg2.errors.UniqueViolation:
+            if not deduplicate:
+                log.warning(f'индекс: {name} не создан, в таблице {table} '
+                            f'есть дубликаты {definition}')
+                self._execute_index(table, f'{name}_nonunique', False,
+                                    definition)
+                return False
+            self.delete_duplicates(table, definition)
+            self._execute_index(table, name, unique, definition)
+        log.info(f'индекс: {name} создан/существует')
+        return True
+
+    @reconnecting
+    def _execute_index(self, table: str, name: str, unique: bool,
+                       definition: str) -> None:
+        query = sql.SQL("create {}index if not exists {} on {} {}").format(
+            sql.SQL('unique ' if unique else ''),
+            sql.Identifier(name),
+            sql.Identifier(table),
+            sql.SQL(definition)
+        )
+        with self.connection() as con:
+            with con.cursor() as cur:
                 cur.execute(query)
-        print(f'таблица: {table} создана/существует')
 
+    @METRICS.timed('db_query')
+    @reconnecting
+    def delete_duplicates(self, table: str, columns: str) -> int:
+        """
+        Удаляет повторяющиеся по заданным столбцам строки таблицы,
+        оставляя строку с наибольшим значением столбца date (при равных
+        датах - строку с наибольшим ctid). Порядок ctid не совпадает с
+        порядком добавления строк после UPDATE и VACUUM, поэтому сам по
+        себе не используется. Таблица должна содержать столбец date.
+
+        :param table: название таблицы (например, "service_info")
+        :param columns: столбцы (например, "(channel_id, message_id)")
+        :return: число удаленных строк
+        """
+        query = sql.SQL(
+            "delete from {0} where ctid in (select ctid from ("
+            "select ctid, row_number() over (partition by {1} "
+            "order by date desc, ctid desc) as num from {0}) as numbered "
+            "where num > 1)").format(
+            sql.Identifier(table),
+            sql.SQL(columns)
+        )
+        with self.connection() as con:
+            with con.cursor() as cur:
+                cur.execute(query)
+                deleted = cur.rowcount
+        log.info(f'таблица: {table} удалено дубликатов {columns}: {deleted}')
+        return deleted
+
+    @METRICS.timed('db_query')
+    @reconnecting
     def select_all(self, table: str, output="dict") -> list:
         """
         Выбрать все записи в заданной таблице БД.
@@ -64,23 +365,92 @@ class DB:
         """
         query = sql.SQL("SELECT * FROM {}").format(sql.Identifier(table))
 
-        with self.con:
+        with self.connection() as con:
             if output == "dict":
-                with self.con.cursor() as cur:
+                with con.cursor() as cur:
                     cur.execute(query)
                     list_all = cur.fetchall()
             elif output == "tuple":
-                with self.con.cursor(cursor_factory=RealDictCursor) as cur:
+                with con.cursor(cursor_factory=RealDictCursor) as cur:
                     cur.execute(query)
                     list_all = cur.fetchall()
         return list_all
 
-    def insert_record(self, table: str, dictionary: dict) -> bool:
+    def iter_select_all(self, table: str, output="dict", itersize=2000,
+                        batch_size=None):
+        """
+        Потоковый вариант select_all: записи читаются серверным курсором
+        по itersize строк, поэтому память не зависит от размера таблицы.
+
+        :param table: название таблицы (например, "main_mains")
+        :param output: тип записей: "dict" - словари, "tuple" - кортежи
+        (в отличие от select_all, где эти значения перепутаны)
+        :param itersize: число строк, получаемых с сервера за раз
+        :param batch_size: если задан, записи выдаются списками по
+        batch_size штук
+        :return: генератор записей (или списков записей)
+        """
+        query = sql.SQL("SELECT * FROM {}").format(sql.Identifier(table))
+        cursor_factory = RealDictCursor if output == "dict" else None
+        return self.stream(query, itersize=itersize, batch_size=batch_size,
+                           cursor_factory=cursor_factory)
+
+    def stream(self, query, params=None, itersize=2000, batch_size=None,
+               cursor_factory=None):
+        """
+        Выполнить запрос на серверном (именованном) курсоре и выдавать
+        результат по мере чтения.
+
+        Для курсора берется отдельное соединение из пула, поэтому во время
+        чтения можно выполнять другие методы DB (например, записывать
+        ссылки на ЯндексДиск по мере загрузки файлов).
+
+        :param query: запрос (строка или sql.Composed)
+        :param params: параметры запроса
+        :param itersize: число строк, получаемых с сервера за раз
+        :param batch_size: если задан, строки выдаются списками по
+        batch_size штук
+        :param cursor_factory: класс курсора (например, RealDictCursor)
+        :return: генератор строк (или списков строк)
+        """
+        con = self.acquire()
+        cur = con.cursor(name=f'stream_{next(_cursor_ids)}',
+                         cursor_factory=cursor_factory)
+        cur.itersize = itersize
+        try:
+            cur.execute(query, params)
+            if batch_size:
+                while True:
+                    rows = cur.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield rows
+            else:
+                yield from cur
+        finally:
+            try:
+                if not con.closed:
+                    cur.close()
+                    con.commit()
+            finally:
+                self.release(con)
+
+    @METRICS.timed('db_query')
+    @reconnecting
+    def insert_record(self, table: str, dictionary: dict, conflict=None,
+                      update=None) -> bool:
         """
         Запись данных в заданную таблицу БД с переменным числом параметров.
 
+        Если задан ключ conflict, запись выполняется как upsert:
+        при совпадении ключа с существующей строкой она не изменяется
+        (ON CONFLICT DO NOTHING) или обновляется (ON CONFLICT DO UPDATE,
+        см. update). По ключу должен существовать уникальный индекс
+        (см. has_unique_key).
+
         Полезные ссылки:
         https://www.psycopg.org/docs/sql.html#module-usage
+        https://www.postgresql.org/docs/current/sql-insert.html
 
         Пример.
         table="main_mains"
@@ -92,20 +462,170 @@ class DB:
         :param table: название таблицы (напимер, "main_mains")
         :param dictionary: словарь, где {key=имя столбца: value=значение}
         (например, {"col1": True, "col2": 777, "title": 'Universium'})
-        :return: True
+        :param conflict: столбцы ключа (например, ("channel_id",
+        "message_id")) или None
+        :param update: None - не изменять существующую строку, True -
+        обновить все столбцы кроме ключа, список столбцов - обновить их
+        :return: True, если строка добавлена, False, если строка с таким
+        ключом уже была (при conflict=None всегда True)
+        """
+        columns = tuple(dictionary.keys())
+
+        def build():
+            query = sql.SQL("insert into {} ({}) values ({})").format(
+                sql.Identifier(table),
+                sql.SQL(', ').join(map(sql.Identifier, columns)),
+                sql.SQL(', ').join(map(sql.Placeholder, columns))
+            )
+            if conflict:
+                query += conflict_clause(conflict, update, columns)
+                # xmax = 0 только у строк, созданных этим запросом
+                query += sql.SQL(" returning (xmax = 0)")
+            return query
+
+        key = ('insert', table, columns, conflict and tuple(conflict),
+               update if update in (None, True) else tuple(update))
+        with self.connection() as con:
+            with con.cursor() as cur:
+                self.statements.execute(cur, key, build, dictionary)
+                if conflict:
+                    row = cur.fetchone()
+                    inserted = bool(row and row[0])
+                else:
+                    inserted = True
+        return inserted
+
+    @METRICS.timed('db_query')
+    @reconnecting
+    def insert_many(self, table: str, dictionaries: list, conflict=None,
+                    update=None, page_size=1000) -> list:
+        """
+        Пакетный вариант insert_record: запись многих строк запросами
+        INSERT ... VALUES по page_size строк в одной транзакции.
+
+        Все словари должны содержать одинаковый набор ключей. Повторы
+        ключа conflict внутри пакета объединяются: записывается последняя
+        строка с этим ключом.
+
+        :param table: название таблицы (напимер, "main_mains")
+        :param dictionaries: список словарей {имя столбца: значение}
+        :param conflict: столбцы ключа (например, ("channel_id",
+        "message_id")) или None
+        :param update: None, True или список столбцов (см. insert_record)
+        :param page_size: число строк в одном запросе
+        :return: список True/False для каждого словаря: была ли строка
+        добавлена (False - строка с таким ключом уже была)
         """
-        columns = dictionary.keys()
-        query = sql.SQL("insert into {} ({}) values ({})").format(
+        if not dictionaries:
+            return []
+        columns = list(dictionaries[0].keys())
+        if any(dictionary.keys() != dictionaries[0].keys()
+               for dictionary in dictionaries):
+            raise ValueError('словари должны содержать одинаковые ключи')
+        rows = [tuple(dictionary[column] for column in columns)
+                for dictionary in dictionaries]
+        query = sql.SQL("insert into {} ({}) values %s").format(
             sql.Identifier(table),
-            sql.SQL(', ').join(map(sql.Identifier, columns)),
-            sql.SQL(', ').join(map(sql.Placeholder, columns))
-        )
-        with self.con:
-            with self.con.cursor() as cur:
-                cur.execute(query, dictionary)
-                self.con.commit()
-        return True
+            sql.SQL(', ').join(map(sql.Identifier, columns)))
+
+        if not conflict:
+            with self.connection() as con:
+                with con.cursor() as cur:
+                    execute_values(cur, query, rows, page_size=page_size)
+            return [True] * len(rows)
+
+        names = [column.lower() for column in columns]
+        positions = [names.index(column.lower()) for column in conflict]
+
+        def key(row):
+            return tuple(row[position] for position in positions)
+
+        # последняя строка с ключом, в порядке первого появления ключа
+        unique = {}
+        for row in rows:
+            unique[key(row)] = row
+
+        query += conflict_clause(conflict, update, columns)
+        query += sql.SQL(" returning {}, (xmax = 0)").format(
+            sql.SQL(', ').join(map(sql.Identifier, conflict)))
+        with self.connection() as con:
+            with con.cursor() as cur:
+                result = execute_values(cur, query, list(unique.values()),
+                                        page_size=page_size, fetch=True)
+        inserted = {tuple(row[:-1]): row[-1] for row in result}
 
+        flags = []
+        seen = set()
+        for row in rows:
+            row_key = key(row)
+            flags.append(bool(inserted.get(row_key)) and row_key not in seen)
+            seen.add(row_key)
+        return flags
+
+    @METRICS.timed('db_query')
+    @reconnecting
+    def has_unique_key(self, table: str, columns) -> bool:
+        """
+        Проверяет, есть ли в таблице уникальный индекс (без условия) ровно
+        по заданным столбцам, то есть можно ли использовать их как ключ
+        ON CONFLICT.
+
+        :param table: название таблицы (напимер, "main_mains")
+        :param columns: столбцы (например, ("channel_id", "message_id"))
+        :return: True/False
+        """
+        query = """SELECT 1 FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indrelid
+        WHERE c.relname = %s AND i.indisunique AND i.indpred IS NULL
+        AND (SELECT array_agg(a.attname::text ORDER BY a.attname::text)
+             FROM pg_attribute a
+             WHERE a.attrelid = c.oid AND a.attnum = ANY(i.indkey))
+            = %s::text[];"""
+        with self.connection() as con:
+            with con.cursor() as cur:
+                cur.execute(query, (table, sorted(column.lower()
+                                                  for column in columns)))
+                found = cur.fetchone() is not None
+        return found
+
+    def conflict_keys(self, tables: list, columns) -> dict:
+        """
+        Ключи ON CONFLICT для таблиц, в которых есть уникальный индекс по
+        заданным столбцам (см. has_unique_key). Используется для
+        параметра conflicts в bulk_writer.
+
+        :param tables: названия таблиц (например, ["book_books",
+        "service_info"])
+        :param columns: столбцы ключа (например, ("channel_id", "message_id"))
+        :return: {таблица: столбцы}
+        """
+        return {table: tuple(columns) for table in tables
+                if self.has_unique_key(table, columns)}
+
+    def bulk_writer(self, batch_size=500, flush_interval=5.0,
+                    returning=None, conflicts=None,
+                    update=None) -> 'BulkWriter':
+        """
+        Создает буферизованный писатель для пакетной записи строк в БД.
+
+        :param batch_size: число строк, после которого выполняется запись
+        :param flush_interval: интервал в секундах, после которого
+        выполняется запись
+        :param returning: словарь {таблица: столбец} для возврата
+        сгенерированных значений (например, {"book_books": "id"})
+        :param conflicts: словарь {таблица: столбцы ключа} для записи
+        через ON CONFLICT (например, {"service_info": ("channel_id",
+        "message_id")})
+        :param update: словарь {таблица: True | список столбцов} для
+        обновления существующих строк (по умолчанию DO NOTHING)
+        :return: BulkWriter
+        """
+        return BulkWriter(self, batch_size=batch_size,
+                          flush_interval=flush_interval, returning=returning,
+                          conflicts=conflicts, update=update)
+
+    @METRICS.timed('db_query')
+    @reconnecting
     def get_last_post(self, table: str, channel_id: int) -> int:
         """
         Получить номер последнего сообщения для заданного канала.
@@ -114,16 +634,183 @@ class DB:
         :param channel_id: id канала(например, 111111)
         :return: номер сообщения или 0
         """
+        def build():
+            return sql.SQL(
+                "select max(message_id) from {} where channel_id = %s"
+            ).format(sql.Identifier(table))
+
+        with self.connection() as con:
+            with con.cursor() as cur:
+                self.statements.execute(cur, ('last_post', table), build,
+                                        (channel_id,))
+                msg_id = cur.fetchone()[0]
+        return msg_id or 0
+
+    @METRICS.timed('db_query')
+    @reconnecting
+    def get_checkpoint(self, table: str, channel_id: int) -> (int, None):
+        """
+        Получить контрольную точку парсинга канала - номер последнего
+        полностью обработанного сообщения.
+
+        :param table: название таблицы (например, "parser_checkpoints")
+        :param channel_id: id канала(например, 111111)
+        :return: номер сообщения или None, если точки нет
+        """
+        def build():
+            return sql.SQL(
+                "select message_id from {} where channel_id = %s").format(
+                sql.Identifier(table))
+
+        with self.connection() as con:
+            with con.cursor() as cur:
+                self.statements.execute(cur, ('get_checkpoint', table),
+                                        build, (channel_id,))
+                row = cur.fetchone()
+        return row[0] if row else None
+
+    @METRICS.timed('db_query')
+    @reconnecting
+    def set_checkpoint(self, table: str, channel_id: int,
+                       message_id: int) -> None:
+        """
+        Записать контрольную точку парсинга канала. Точка только
+        сдвигается вперед: меньший номер сообщения не записывается.
+        Требует уникального индекса по channel_id
+        (см. schemas.CHECKPOINTS_INDEXES).
+
+        :param table: название таблицы (например, "parser_checkpoints")
+        :param channel_id: id канала(например, 111111)
+        :param message_id: номер сообщения (например, 213)
+        """
+        def build():
+            return sql.SQL(
+                "insert into {table} (channel_id, message_id, date) "
+                "values (%s, %s, now()) "
+                "on conflict (channel_id) do update "
+                "set message_id = greatest({table}.message_id, "
+                "excluded.message_id), date = excluded.date").format(
+                table=sql.Identifier(table))
+
+        with self.connection() as con:
+            with con.cursor() as cur:
+                self.statements.execute(cur, ('set_checkpoint', table),
+                                        build, (channel_id, message_id))
+
+    @METRICS.timed('db_query')
+    @reconnecting
+    def add_failure(self, table: str, channel_id: int, message_id: int,
+                    stage: str, error: str) -> int:
+        """
+        Записать неудачную попытку обработки сообщения и получить число
+        попыток. Требует уникального индекса по (channel_id, message_id)
+        (см. schemas.PARSER_FAILURES_INDEXES).
+
+        :param table: название таблицы (например, "parser_failures")
+        :param channel_id: id канала(например, 111111)
+        :param message_id: номер сообщения (например, 213)
+        :param stage: стадия обработки (например, "image")
+        :param error: текст ошибки
+        :return: число неудачных попыток, включая эту
+        """
+        def build():
+            return sql.SQL(
+                "insert into {table} (channel_id, message_id, stage, error, "
+                "attempts, date) values (%s, %s, %s, %s, 1, now()) "
+                "on conflict (channel_id, message_id) do update "
+                "set stage = excluded.stage, error = excluded.error, "
+                "attempts = {table}.attempts + 1, date = excluded.date "
+                "returning attempts").format(table=sql.Identifier(table))
+
+        with self.connection() as con:
+            with con.cursor() as cur:
+                self.statements.execute(cur, ('add_failure', table), build,
+                                        (channel_id, message_id, stage,
+                                         error))
+                attempts = cur.fetchone()[0]
+        return attempts
+
+    @METRICS.timed('db_query')
+    @reconnecting
+    def get_backfill_ranges(self, table: str, channel_id: int) -> list:
+        """
+        Получить диапазоны исторической загрузки канала.
+
+        :param table: название таблицы (например, "backfill_ranges")
+        :param channel_id: id канала(например, 111111)
+        :return: list(Tuple[range_start, range_end, message_id, complete],
+        ...) по возрастанию range_start
+        """
+        def build():
+            return sql.SQL(
+                "select range_start, range_end, message_id, complete "
+                "from {} where channel_id = %s order by range_start").format(
+                sql.Identifier(table))
+
+        with self.connection() as con:
+            with con.cursor() as cur:
+                self.statements.execute(cur, ('get_backfill_ranges', table),
+                                        build, (channel_id,))
+                ranges = cur.fetchall()
+        return ranges
+
+    @METRICS.timed('db_query')
+    @reconnecting
+    def add_backfill_ranges(self, table: str, channel_id: int,
+                            ranges: list) -> None:
+        """
+        Записать диапазоны исторической загрузки канала. Существующие
+        диапазоны (по уникальному индексу (channel_id, range_start), см.
+        schemas.BACKFILL_RANGES_INDEXES) не изменяются.
+
+        :param table: название таблицы (например, "backfill_ranges")
+        :param channel_id: id канала(например, 111111)
+        :param ranges: список (range_start, range_end)
+        (например, [(0, 5000), (5000, 10000)])
+        """
         query = sql.SQL(
-            "select message_id from {} where channel_id = %s "
-            "order by message_id desc").format(sql.Identifier(table))
+            "insert into {} (channel_id, range_start, range_end, message_id, "
+            "complete, date) values %s "
+            "on conflict (channel_id, range_start) do nothing").format(
+            sql.Identifier(table))
+        rows = [(channel_id, start, end, start) for start, end in ranges]
 
-        with self.con:
-            with self.con.cursor() as cur:
-                cur.execute(query, (channel_id,))
-                msg_id = cur.fetchone()
-        return msg_id[0] if msg_id else 0
+        with self.connection() as con:
+            with con.cursor() as cur:
+                execute_values(cur, query.as_string(cur), rows,
+                               template='(%s, %s, %s, %s, false, now())')
+
+    @METRICS.timed('db_query')
+    @reconnecting
+    def set_backfill_range(self, table: str, channel_id: int,
+                           range_start: int, message_id: int,
+                           complete=False) -> None:
+        """
+        Записать ход исторической загрузки диапазона. Номер сообщения
+        только сдвигается вперед, завершенный диапазон остается
+        завершенным.
 
+        :param table: название таблицы (например, "backfill_ranges")
+        :param channel_id: id канала(например, 111111)
+        :param range_start: начало диапазона (например, 5000)
+        :param message_id: номер последнего обработанного сообщения
+        :param complete: диапазон обработан полностью
+        """
+        def build():
+            return sql.SQL(
+                "update {} set message_id = greatest(message_id, %s), "
+                "complete = complete or %s, date = now() "
+                "where channel_id = %s and range_start = %s").format(
+                sql.Identifier(table))
+
+        with self.connection() as con:
+            with con.cursor() as cur:
+                self.statements.execute(cur, ('set_backfill_range', table),
+                                        build, (message_id, complete,
+                                                channel_id, range_start))
+
+    @METRICS.timed('db_query')
+    @reconnecting
     def check_friendly_channel(self, table: str, channel_id: int) -> bool:
         """
         Проверяет наличие канала в проверенных.
@@ -132,17 +819,20 @@ class DB:
         :param channel_id: channel_id: id канала(например, 111111)
         :return: True/False
         """
-        query = sql.SQL(
-            "select exists (select * from {} where channel_id = %s)").format(
-            sql.Identifier(table)
-        )
+        def build():
+            return sql.SQL(
+                "select exists (select * from {} where channel_id = %s)"
+            ).format(sql.Identifier(table))
 
-        with self.con:
-            with self.con.cursor() as cur:
-                cur.execute(query, (channel_id,))
+        with self.connection() as con:
+            with con.cursor() as cur:
+                self.statements.execute(cur, ('friendly_channel', table),
+                                        build, (channel_id,))
                 exists = cur.fetchone()[0]
         return exists
 
+    @METRICS.timed('db_query')
+    @reconnecting
     def get_friendly_channels(self, table: str, column: str) -> list:
         """
         Получить список проверенных каналов.
@@ -155,12 +845,14 @@ class DB:
             sql.Identifier(column),
             sql.Identifier(table)
         )
-        with self.con:
-            with self.con.cursor() as cur:
+        with self.connection() as con:
+            with con.cursor() as cur:
                 cur.execute(query)
                 list_friendly = cur.fetchall()
         return list_friendly
 
+    @METRICS.timed('db_query')
+    @reconnecting
     def check_record(
             self, channel_id: int, message_id: int, table: str) -> bool:
         """
@@ -172,17 +864,62 @@ class DB:
         :param message_id: id сообщения в канале (например, 123)
         :return: True/False
         """
-        query = sql.SQL("select exists (select * from {} "
-                        "where channel_id = %s and message_id = %s)").format(
-            sql.Identifier(table))
+        def build():
+            return sql.SQL(
+                "select exists (select * from {} "
+                "where channel_id = %s and message_id = %s)").format(
+                sql.Identifier(table))
 
         values = (channel_id, message_id)
-        with self.con:
-            with self.con.cursor() as cur:
-                cur.execute(query, values)
+        with self.connection() as con:
+            with con.cursor() as cur:
+                self.statements.execute(cur, ('check_record', table), build,
+                                        values)
                 exists = cur.fetchone()[0]
         return exists
 
+    @METRICS.timed('db_query')
+    @reconnecting
+    def get_message_ids(self, table: str, channel_id: int) -> list:
+        """
+        Получить отсортированный список номеров сообщений заданного канала,
+        записанных в таблицу.
+
+        :param table: название таблицы (напимер, "service_info")
+        :param channel_id: id канала(например, 111111)
+        :return: список номеров сообщений по возрастанию
+        """
+        query = sql.SQL("select distinct message_id from {} "
+                        "where channel_id = %s order by message_id").format(
+            sql.Identifier(table))
+
+        with self.connection() as con:
+            with con.cursor() as cur:
+                cur.execute(query, (channel_id,))
+                list_ids = [row[0] for row in cur]
+        return list_ids
+
+    @METRICS.timed('db_query')
+    @reconnecting
+    def get_documents(self, table: str) -> list:
+        """
+        Получить список загруженных документов.
+
+        :param table: название таблицы (напимер, "book_books")
+        :return: list(Tuple[document_id, file_name, file_hash, yadisk], ...)
+        """
+        query = sql.SQL("select document_id, file_name, file_hash, yadisk "
+                        "from {} where file_name is not null").format(
+            sql.Identifier(table))
+
+        with self.connection() as con:
+            with con.cursor() as cur:
+                cur.execute(query)
+                list_documents = cur.fetchall()
+        return list_documents
+
+    @METRICS.timed('db_query')
+    @reconnecting
     def set_values(self, table: str, dictionary: dict) -> bool:
         """
         Изменить данные по PK в заданной таблице БД с переменным числом
@@ -205,22 +942,97 @@ class DB:
         """
         flag_complete = False
         if dictionary.get('id', False):
-            columns = dictionary.keys()
+            columns = tuple(dictionary.keys())
 
-            query = sql.SQL("UPDATE {} SET ({}) = ({}) WHERE ID = {}").format(
-                sql.Identifier(table),
-                sql.SQL(', ').join(map(sql.Identifier, columns)),
-                sql.SQL(', ').join(map(sql.Placeholder, columns)),
-                sql.Placeholder('id')
-            )
+            def build():
+                return sql.SQL(
+                    "UPDATE {} SET ({}) = ({}) WHERE ID = {}").format(
+                    sql.Identifier(table),
+                    sql.SQL(', ').join(map(sql.Identifier, columns)),
+                    sql.SQL(', ').join(map(sql.Placeholder, columns)),
+                    sql.Placeholder('id')
+                )
 
-            with self.con:
-                with self.con.cursor() as cur:
-                    cur.execute(query, dictionary)
-                    self.con.commit()
+            with self.connection() as con:
+                with con.cursor() as cur:
+                    self.statements.execute(
+                        cur, ('set_values', table, columns), build,
+                        dictionary)
             flag_complete = True
         return flag_complete
 
+    @METRICS.timed('db_query')
+    @reconnecting
+    def set_values_many(self, table: str, dictionaries: list,
+                        batch_size=1000) -> list:
+        """
+        Пакетный вариант set_values: изменить данные многих записей по PK
+        одним запросом UPDATE ... FROM (VALUES ...) на каждые batch_size
+        записей. Все пакеты выполняются в одной транзакции.
+
+        Все словари должны содержать одинаковый набор ключей, в том числе
+        'id'. Значения приводятся к типам столбцов таблицы (см.
+        get_schema), чтобы None и даты корректно сопоставлялись столбцам.
+
+        Пример.
+        table="book_books"
+        dictionaries = [{"id": 61, "yadisk": 'https://yadi.sk/d/1'},
+                        {"id": 62, "yadisk": 'https://yadi.sk/d/2'}]
+        query -> UPDATE "book_books" AS t SET "yadisk" = v."yadisk"
+        FROM (VALUES (61::integer, 'https://yadi.sk/d/1'::text), ...)
+        AS v ("id", "yadisk") WHERE t.id = v.id RETURNING t.id
+        return [61, 62]
+
+        :param table: название таблицы (напимер, "main_mains")
+        :param dictionaries: список словарей изменяемых параметров
+        (например, [{"id": 61, "yadisk": 'https://yadi.sk/d/1'}, ...])
+        :param batch_size: число записей в одном запросе
+        :return: список id измененных записей
+        """
+        if not dictionaries:
+            return []
+        columns = list(dictionaries[0].keys())
+        if 'id' not in columns:
+            raise ValueError('словари должны содержать ключ "id"')
+        if any(dictionary.keys() != dictionaries[0].keys()
+               for dictionary in dictionaries):
+            raise ValueError('словари должны содержать одинаковые ключи')
+        values = [columns.pop(columns.index('id'))] + columns
+        if not columns:
+            raise ValueError('нет изменяемых столбцов')
+
+        types = {column.lower(): data_type
+                 for column, data_type, _ in self.get_schema(table)}
+        template = sql.SQL('({})').format(sql.SQL(', ').join(
+            sql.SQL('%s::{}').format(sql.SQL(types[column.lower()]))
+            if types.get(column.lower()) not in (None, 'ARRAY',
+                                                 'USER-DEFINED')
+            else sql.SQL('%s')
+            for column in values))
+
+        query = sql.SQL(
+            "UPDATE {table} AS t SET {assignments} "
+            "FROM (VALUES %s) AS v ({values}) "
+            "WHERE t.id = v.id RETURNING t.id").format(
+            table=sql.Identifier(table),
+            assignments=sql.SQL(', ').join(
+                sql.SQL('{} = v.{}').format(sql.Identifier(column),
+                                            sql.Identifier(column))
+                for column in columns),
+            values=sql.SQL(', ').join(map(sql.Identifier, values)))
+
+        rows = [tuple(dictionary[column] for column in values)
+                for dictionary in dictionaries]
+        with self.connection() as con:
+            with con.cursor() as cur:
+                query = query.as_string(cur)
+                template = template.as_string(cur)
+                updated = execute_values(cur, query, rows, template=template,
+                                         page_size=batch_size, fetch=True)
+        return [row[0] for row in updated]
+
+    @METRICS.timed('db_query')
+    @reconnecting
     def select_null_yadisk(self, table: str) -> list:
         """
         Получить список файлов не имеющих ссылку на ЯндексДиск.
@@ -233,12 +1045,48 @@ class DB:
                         "FILE_NAME IS NOT NULL AND YADISK IS NULL;").format(
             sql.Identifier(table))
 
-        with self.con:
-            with self.con.cursor() as cur:
+        with self.connection() as con:
+            with con.cursor() as cur:
                 cur.execute(query)
                 list_null = cur.fetchall()
         return list_null
 
+    def iter_null_yadisk(self, table: str, itersize=2000, batch_size=None):
+        """
+        Потоковый вариант select_null_yadisk (см. stream).
+
+        :param table: название таблицы (напимер, "main_mains")
+        :param itersize: число строк, получаемых с сервера за раз
+        :param batch_size: если задан, строки выдаются списками по
+        batch_size штук
+        :return: генератор Tuple[id, file_name, yadisk]
+        """
+        query = sql.SQL("SELECT ID, FILE_NAME, YADISK FROM {} WHERE "
+                        "FILE_NAME IS NOT NULL AND YADISK IS NULL "
+                        "ORDER BY ID").format(sql.Identifier(table))
+        return self.stream(query, itersize=itersize, batch_size=batch_size)
+
+    @METRICS.timed('db_query')
+    @reconnecting
+    def count_null_yadisk(self, table: str) -> int:
+        """
+        Число файлов не имеющих ссылку на ЯндексДиск.
+
+        :param table: название таблицы (напимер, "main_mains")
+        :return: число записей
+        """
+        query = sql.SQL("SELECT count(*) FROM {} WHERE "
+                        "FILE_NAME IS NOT NULL AND YADISK IS NULL").format(
+            sql.Identifier(table))
+
+        with self.connection() as con:
+            with con.cursor() as cur:
+                cur.execute(query)
+                count = cur.fetchone()[0]
+        return count
+
+    @METRICS.timed('db_query')
+    @reconnecting
     def get_schema(self, table: str) -> list:
         """
         Схема таблицы.
@@ -249,8 +1097,292 @@ class DB:
         query = """SELECT column_name, data_type, is_nullable
         FROM information_schema.columns
         WHERE table_name = %s;"""
-        with self.con:
-            with self.con.cursor() as cur:
+        with self.connection() as con:
+            with con.cursor() as cur:
                 cur.execute(query, (table,))
                 list_schema = cur.fetchall()
         return list_schema
+
+
+def conflict_clause(conflict, update, columns) -> sql.Composable:
+    """
+    Часть запроса INSERT "ON CONFLICT (...) DO NOTHING/DO UPDATE".
+
+    :param conflict: столбцы ключа (например, ("channel_id", "message_id"))
+    :param update: None - DO NOTHING, True - обновить все столбцы кроме
+    ключа, список столбцов - обновить их
+    :param columns: столбцы вставляемой строки
+    :return: sql.Composed
+    """
+    key = {column.lower() for column in conflict}
+    if update is True:
+        update = [column for column in columns if column.lower() not in key]
+    clause = sql.SQL(" on conflict ({})").format(
+        sql.SQL(', ').join(map(sql.Identifier, conflict)))
+    if not update:
+        return clause + sql.SQL(" do nothing")
+    return clause + sql.SQL(" do update set {}").format(
+        sql.SQL(', ').join(
+            sql.SQL("{} = excluded.{}").format(sql.Identifier(column),
+                                               sql.Identifier(column))
+            for column in update))
+
+
+class BulkWriter:
+    """
+    Буферизованная пакетная запись строк в таблицы БД.
+
+    Строки накапливаются по таблицам и записываются одним запросом
+    execute_values на каждую таблицу в одной транзакции. Запись выполняется
+    вызовом flush(), при достижении batch_size строк или по истечении
+    flush_interval секунд (проверяется в maybe_flush()) и при выходе из
+    контекстного менеджера.
+
+    Для таблиц из conflicts строки пишутся через ON CONFLICT: строка с уже
+    существующим ключом пропускается (или обновляется, см. update), а ее
+    сгенерированные значения не возвращаются.
+
+    Строки одного исходного сообщения добавляются как единица записи
+    (unit() или begin()/end()): они попадают в буфер только целиком, а при
+    ошибке обработки сообщения отбрасываются. Единица записывается или
+    отбрасывается целиком и в flush() (см. flush()). Поэтому каждая
+    транзакция flush() содержит только полностью обработанные сообщения, и
+    в БД не остается записи о книге без записи в сервисной таблице.
+    Внутри DB.transaction() flush() выполняется в общей транзакции.
+    Для строки можно задать замену (on_failure), которая записывается
+    вместо нее, если единица записи не прошла проверку БД (например,
+    статус сообщения complete=False вместо complete=True).
+
+    Пример.
+    with db.bulk_writer(returning={"book_books": "id"}) as writer:
+        with writer.unit():
+            writer.add("book_books", record)
+            writer.add("service_info", info,
+                       on_failure=dict(info, complete=False))
+        writer.maybe_flush()
+    """
+
+    def __init__(self, db: DB, batch_size=500, flush_interval=5.0,
+                 returning=None, conflicts=None, update=None) -> None:
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.returning = returning or {}
+        self.conflicts = conflicts or {}
+        self.update = update or {}
+        # {таблица: {кортеж столбцов: [кортеж значений, ...]}}
+        self._buffers = {}
+        self._count = 0
+        self._last_flush = time.monotonic()
+        # строки незавершенной единицы записи
+        # [(таблица, словарь, замена), ...]
+        self._staged = None
+        # единицы записи в буфере: [(строки, замены), ...], строки и
+        # замены - [(таблица, столбцы, значения), ...]
+        self._units = []
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __enter__(self) -> 'BulkWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.flush()
+
+    def begin(self) -> None:
+        """
+        Начать единицу записи (например, обработку исходного сообщения).
+        Строки незавершенной предыдущей единицы отбрасываются.
+        """
+        if self._staged:
+            log.warning(f'Отброшено строк незавершенной записи: '
+                        f'{len(self._staged)}')
+        self._staged = []
+
+    def end(self) -> None:
+        """
+        Завершить единицу записи: ее строки переносятся в буфер.
+        """
+        staged, self._staged = self._staged or [], None
+        if staged:
+            self._add_unit(staged)
+
+    @contextmanager
+    def unit(self):
+        """
+        Единица записи в виде контекстного менеджера: строки, добавленные
+        в блоке, попадают в буфер при выходе из блока без ошибки и
+        отбрасываются при ошибке.
+        """
+        self.begin()
+        try:
+            yield self
+        except BaseException:
+            self._staged = None
+            raise
+        self.end()
+
+    def add(self, table: str, dictionary: dict, on_failure=None) -> None:
+        """
+        Добавить строку в буфер таблицы (внутри единицы записи - в
+        единицу записи).
+
+        :param table: название таблицы (например, "main_mains")
+        :param dictionary: словарь, где {key=имя столбца: value=значение}
+        :param on_failure: словарь, записываемый в table вместо dictionary,
+        если единица записи не записана, или None
+        :return: None
+        """
+        entry = (table, dict(dictionary),
+                 None if on_failure is None else dict(on_failure))
+        if self._staged is not None:
+            self._staged.append(entry)
+        else:
+            self._add_unit([entry])
+
+    def _add_unit(self, entries: list) -> None:
+        rows = [self._append(table, dictionary)
+                for table, dictionary, _ in entries]
+        replacements = [_row(table, on_failure)
+                        for table, _, on_failure in entries
+                        if on_failure is not None]
+        self._units.append((rows, replacements))
+
+    def _append(self, table: str, dictionary: dict) -> tuple:
+        row = _row(table, dictionary)
+        self._buffers.setdefault(table, {}).setdefault(row[1], []).append(
+            row[2])
+        self._count += 1
+        return row
+
+    def need_flush(self) -> bool:
+        """
+        Проверяет необходимость записи буфера по числу строк и времени.
+
+        :return: True/False
+        """
+        if not self._count:
+            return False
+        return (self._count >= self.batch_size or
+                time.monotonic() - self._last_flush >= self.flush_interval)
+
+    def maybe_flush(self) -> dict:
+        """
+        Записать буфер, если достигнут порог по числу строк или времени.
+        Вызывается в точках, где записанные данные согласованы (например,
+        после обработки очередного сообщения).
+
+        :return: {таблица: [сгенерированные значения, ...]} или {}
+        """
+        return self.flush() if self.need_flush() else {}
+
+    @METRICS.timed('db_query')
+    def flush(self) -> dict:
+        """
+        Записать все накопленные строки в одной транзакции с одной
+        фиксацией. Если пакетная запись не удалась, она откатывается до
+        точки сохранения и строки записываются по единицам записи, каждая
+        под своей точкой сохранения: единица, в которой хотя бы одна
+        строка не прошла проверку БД, откатывается целиком, вместо нее
+        записываются замены ее строк (см. add()).
+        Строки незавершенной единицы записи не записываются.
+
+        :return: {таблица: [сгенерированные значения, ...]}
+        """
+        if not self._count:
+            self._last_flush = time.monotonic()
+            return {}
+        with self.db.connection() as con:
+            with con.cursor() as cur:
+                cur.execute("savepoint bulk_batch")
+                try:
+                    generated = self._write(cur)
+                    cur.execute("release savepoint bulk_batch")
+                except CONNECTION_ERRORS:
+                    raise
+                except psycopg2.Error as exc:
+                    log.warning(f'{exc} Пакетная запись не удалась, запись '
+                                f'по единицам записи.')
+                    cur.execute("rollback to savepoint bulk_batch")
+                    generated = self._write_units(cur)
+
+        log.debug(f'Записано строк: {self._count}',
+                  extra={'rows': self._count})
+        self._buffers = {}
+        self._units = []
+        self._count = 0
+        self._last_flush = time.monotonic()
+        return generated
+
+    def _query(self, table: str, columns: tuple, con) -> str:
+        def build():
+            query = sql.SQL("insert into {} ({}) values %s").format(
+                sql.Identifier(table),
+                sql.SQL(', ').join(map(sql.Identifier, columns))
+            )
+            if table in self.conflicts:
+                query += conflict_clause(self.conflicts[table],
+                                         self.update.get(table), columns)
+            if table in self.returning:
+                query += sql.SQL(" returning {}").format(
+                    sql.Identifier(self.returning[table]))
+            return query
+
+        key = ('bulk_insert', table, columns,
+               repr(self.conflicts.get(table)), repr(self.update.get(table)),
+               self.returning.get(table))
+        return self.db.statements.query(key, build, con)
+
+    def _write(self, cur) -> dict:
+        generated = {}
+        for table, groups in self._buffers.items():
+            fetch = table in self.returning
+            for columns, rows in groups.items():
+                query = self._query(table, columns, cur.connection)
+                result = execute_values(cur, query, rows,
+                                        page_size=len(rows), fetch=fetch)
+                if fetch:
+                    generated.setdefault(table, []).extend(
+                        row[0] for row in result)
+        return generated
+
+    def _write_units(self, cur) -> dict:
+        generated = {}
+        for rows, replacements in self._units:
+            result = self._write_unit(cur, rows)
+            if result is None and replacements:
+                result = self._write_unit(cur, replacements)
+            for table, values in (result or {}).items():
+                generated.setdefault(table, []).extend(values)
+        return generated
+
+    def _write_unit(self, cur, rows: list) -> (dict, None):
+        cur.execute("savepoint bulk_unit")
+        try:
+            generated = self._insert_rows(cur, rows)
+            cur.execute("release savepoint bulk_unit")
+        except CONNECTION_ERRORS:
+            raise
+        except psycopg2.Error as exc:
+            cur.execute("rollback to savepoint bulk_unit")
+            log.warning(f'{exc} Единица записи не записана: {rows}')
+            return None
+        return generated
+
+    def _insert_rows(self, cur, unit: list) -> dict:
+        generated = {}
+        for table, columns, values in unit:
+            fetch = table in self.returning
+            result = execute_values(cur, self._query(table, columns,
+                                                     cur.connection),
+                                    [values], fetch=fetch)
+            if fetch:
+                generated.setdefault(table, []).extend(
+                    row[0] for row in result)
+        return generated
+
+
+def _row(table: str, dictionary: dict) -> tuple:
+    columns = tuple(dictionary.keys())
+    return table, columns, tuple(dictionary[column] for column in columns)
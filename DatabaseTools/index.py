@@ -0,0 +1,158 @@
+import logging
+from array import array
+from bisect import bisect_left
+
+from DatabaseTools.connect import DB
+
+log = logging.getLogger(__name__)
+
+
+class ProcessedIndex:
+    """
+    Индекс обработанных сообщений в памяти. Заменяет запросы
+    DB.check_record в цикле парсинга.
+
+    Номера сообщений канала загружаются из сервисной таблицы одним запросом
+    при первом обращении к каналу и хранятся в отсортированном массиве
+    64-битных целых. Новые сообщения добавляются методом add().
+
+    Пример.
+    index = ProcessedIndex(db, "service_info")
+    if (channel_id, message.id) not in index:
+        ...
+        index.add(channel_id, message.id)
+    """
+
+    def __init__(self, db: DB, table: str) -> None:
+        self.db = db
+        self.table = table
+        # {channel_id: array('q', [message_id, ...])} - загружено из БД
+        self._loaded = {}
+        # {channel_id: {message_id, ...}} - добавлено в текущем запуске
+        self._added = {}
+
+    def __contains__(self, key: tuple) -> bool:
+        channel_id, message_id = key
+        return self.contains(channel_id, message_id)
+
+    def is_loaded(self, channel_id: int) -> bool:
+        """
+        Проверяет загружены ли сообщения канала из БД.
+
+        :param channel_id: id канала(например, 111111)
+        :return: True/False
+        """
+        return channel_id in self._loaded
+
+    def load(self, channel_id: int) -> int:
+        """
+        Загружает номера обработанных сообщений канала из БД.
+
+        :param channel_id: id канала(например, 111111)
+        :return: число загруженных сообщений
+        """
+        ids = array('q', self.db.get_message_ids(self.table, channel_id))
+        self._loaded[channel_id] = ids
+        log.info(f'Индекс {self.table}: канал {channel_id}, '
+                 f'загружено сообщений {len(ids)}')
+        return len(ids)
+
+    def contains(self, channel_id: int, message_id: int) -> bool:
+        """
+        Проверяет наличие сообщения в индексе. При первом обращении к каналу
+        загружает его сообщения из БД.
+
+        :param channel_id: id канала(например, 111111)
+        :param message_id: id сообщения в канале (например, 123)
+        :return: True/False
+        """
+        if message_id in self._added.get(channel_id, ()):
+            return True
+        if channel_id not in self._loaded:
+            self.load(channel_id)
+        ids = self._loaded[channel_id]
+        position = bisect_left(ids, message_id)
+        return position < len(ids) and ids[position] == message_id
+
+    def add(self, channel_id: int, message_id: int) -> None:
+        """
+        Добавляет сообщение в индекс.
+
+        :param channel_id: id канала(например, 111111)
+        :param message_id: id сообщения в канале (например, 123)
+        """
+        self._added.setdefault(channel_id, set()).add(message_id)
+
+
+class DocumentIndex:
+    """
+    Индекс загруженных документов для исключения повторных загрузок.
+
+    Первый ключ - id документа Telegram (document.id), второй - хеш-сумма
+    содержимого файла (для одного и того же файла, загруженного в разные
+    каналы как разные документы). Для каждого документа хранится имя
+    файла и ссылка на ЯндексДиск.
+    """
+
+    def __init__(self, db: DB, table: str) -> None:
+        self.db = db
+        self.table = table
+        # {document_id: {'file_name', 'file_hash', 'yadisk'}}
+        self._documents = {}
+        # {file_hash: {'file_name', 'file_hash', 'yadisk'}}
+        self._hashes = {}
+
+    def __len__(self) -> int:
+        return len(self._documents)
+
+    def load(self) -> int:
+        """
+        Загружает документы из БД.
+
+        :return: число загруженных документов
+        """
+        for document_id, file_name, file_hash, yadisk in \
+                self.db.get_documents(self.table):
+            self.add(document_id, file_name, file_hash, yadisk)
+        log.info(f'Индекс документов {self.table}: загружено {len(self)}')
+        return len(self)
+
+    def get_by_document(self, document_id: int) -> (dict, None):
+        """
+        Найти файл по id документа Telegram.
+
+        :param document_id: id документа (например, 5345345345345345)
+        :return: {'file_name', 'file_hash', 'yadisk'} или None
+        """
+        return self._documents.get(document_id)
+
+    def get_by_hash(self, file_hash: str) -> (dict, None):
+        """
+        Найти файл по хеш-сумме содержимого.
+
+        :param file_hash: хеш-сумма md5
+        :return: {'file_name', 'file_hash', 'yadisk'} или None
+        """
+        return self._hashes.get(file_hash)
+
+    def add(self, document_id: int, file_name: str, file_hash: str,
+            yadisk: str) -> dict:
+        """
+        Добавить документ в индекс. Для хеш-суммы сохраняется первый
+        добавленный файл, ссылка на ЯндексДиск дополняется, если ее не было.
+
+        :param document_id: id документа
+        :param file_name: имя файла
+        :param file_hash: хеш-сумма md5 или None
+        :param yadisk: ссылка на ЯндексДиск или None
+        :return: {'file_name', 'file_hash', 'yadisk'}
+        """
+        entry = {'file_name': file_name,
+                 'file_hash': file_hash,
+                 'yadisk': yadisk}
+        self._documents[document_id] = entry
+        if file_hash:
+            known = self._hashes.setdefault(file_hash, entry)
+            if not known['yadisk']:
+                known['yadisk'] = yadisk
+        return entry
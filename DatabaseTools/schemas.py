@@ -24,6 +24,7 @@ MAIN_TABLE = [
                 "PUBLIC_SITE BOOL",
                 "CATEGORY VARCHAR(255)",
                 "YADISK text",
+                "FILE_HASH VARCHAR(32)",
             ]
 
 # Шаблон для создания таблицы лога
@@ -41,3 +42,66 @@ FRIENDLY_CHANNELS = [
                 "USERNAME VARCHAR(255) NOT NULL",
                 "CHANNEL_ID bigint NOT NULL"
             ]
+
+# Шаблон для создания таблицы контрольных точек парсинга каналов
+CHECKPOINTS = [
+                "channel_id bigint not null",
+                "message_id bigint not null",
+                "date timestamp with time zone not null",
+            ]
+
+# Шаблон для создания таблицы диапазонов исторической загрузки каналов:
+# диапазон номеров сообщений (range_start, range_end] и номер последнего
+# обработанного в нем сообщения
+BACKFILL_RANGES = [
+                "channel_id bigint not null",
+                "range_start bigint not null",
+                "range_end bigint not null",
+                "message_id bigint not null",
+                "complete boolean not null",
+                "date timestamp with time zone not null",
+            ]
+
+# Шаблон для создания таблицы сообщений, обработка которых завершилась
+# ошибкой: стадия, текст ошибки и число попыток
+PARSER_FAILURES = [
+                "channel_id bigint not null",
+                "message_id bigint not null",
+                "stage varchar(64) not null",
+                "error text",
+                "attempts integer not null",
+                "date timestamp with time zone not null",
+            ]
+
+# Ключ сообщения для записи через ON CONFLICT в основную и сервисную
+# таблицы (уникальные индексы "channel_message_key")
+CONFLICT_KEY = ("channel_id", "message_id")
+
+# Индексы таблиц. Каждый индекс задается кортежем
+# (суффикс имени индекса, уникальный или нет, определение), имя индекса
+# получается как "{таблица}_{суффикс}".
+MAIN_TABLE_INDEXES = [
+                ("channel_message_key", True, "(CHANNEL_ID, MESSAGE_ID)"),
+                ("yadisk_null_idx", False,
+                 "(ID) WHERE FILE_NAME IS NOT NULL AND YADISK IS NULL"),
+            ]
+
+SERVICE_INFO_INDEXES = [
+                ("channel_message_key", True, "(channel_id, message_id)"),
+            ]
+
+FRIENDLY_CHANNELS_INDEXES = [
+                ("channel_id_key", True, "(CHANNEL_ID)"),
+            ]
+
+CHECKPOINTS_INDEXES = [
+                ("channel_id_key", True, "(channel_id)"),
+            ]
+
+BACKFILL_RANGES_INDEXES = [
+                ("channel_range_key", True, "(channel_id, range_start)"),
+            ]
+
+PARSER_FAILURES_INDEXES = [
+                ("channel_message_key", True, "(channel_id, message_id)"),
+            ]
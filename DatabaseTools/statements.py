@@ -0,0 +1,182 @@
+import itertools
+import re
+import threading
+
+from psycopg2 import sql
+
+# Заполнители psycopg2 в тексте запроса: %(name)s, %s и экранированный %%
+_PLACEHOLDER = re.compile(r'%\((\w+)\)s|%s|%%')
+
+
+def to_server_placeholders(query: str) -> tuple:
+    """
+    Переводит текст запроса с заполнителями psycopg2 в текст для PREPARE
+    с заполнителями $1, $2, ...
+
+    Пример.
+    to_server_placeholders('select * from "t" where a = %(a)s and b = %s')
+    -> ('select * from "t" where a = $1 and b = $2', ['a', 1])
+
+    :param query: текст запроса
+    :return: Tuple[текст запроса, порядок параметров (имена для %(name)s,
+    номера позиций для %s)]
+    """
+    order = []
+    position = 0
+
+    def replace(match):
+        nonlocal position
+        if match.group(0) == '%%':
+            return '%'
+        if match.group(1):
+            if match.group(1) not in order:
+                order.append(match.group(1))
+            return f'${order.index(match.group(1)) + 1}'
+        order.append(position)
+        position += 1
+        return f'${len(order)}'
+
+    return _PLACEHOLDER.sub(replace, query), order
+
+
+class StatementCache:
+    """
+    Кэш запросов DB по ключу (операция, таблица, столбцы, ...).
+
+    Запрос собирается из sql.SQL(...).format(...) и переводится в текст
+    один раз, дальше текст берется из кэша. Если задан prepare_threshold,
+    запрос, выполненный prepare_threshold раз через execute(),
+    подготавливается на сервере (PREPARE) и дальше выполняется через
+    EXECUTE без повторного разбора и планирования. Подготовленные запросы
+    существуют в пределах соединения, поэтому учитываются по соединениям.
+    Кэш общий для потоков пула соединений, изменения кэша выполняются под
+    блокировкой.
+
+    Пример.
+    cache = StatementCache(prepare_threshold=50)
+    cache.execute(cur, ('last_post', 'service_info'),
+                  lambda: sql.SQL("select max(message_id) from {} "
+                                  "where channel_id = %s").format(
+                      sql.Identifier('service_info')),
+                  (1360755573,))
+    cache.stats() -> {'hits': 0, 'misses': 1, 'prepared': 0, ...}
+    """
+
+    def __init__(self, prepare_threshold=None) -> None:
+        self.prepare_threshold = prepare_threshold
+        # {ключ: текст запроса}
+        self._queries = {}
+        # {ключ: число выполнений через execute()}
+        self._uses = {}
+        # {ключ: (имя подготовленного запроса, текст, порядок параметров)}
+        self._statements = {}
+        # {id(соединения): (соединение, множество подготовленных имен)}
+        self._prepared = {}
+        # имена подготовленных запросов не повторяются и после clear()
+        self._names = itertools.count(1)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.executed_prepared = 0
+
+    def __len__(self) -> int:
+        return len(self._queries)
+
+    def query(self, key: tuple, build, con) -> str:
+        """
+        Текст запроса из кэша, при отсутствии - собранный функцией build.
+
+        :param key: ключ запроса (например, ('insert', 'book_books',
+        ('title', 'year')))
+        :param build: функция без параметров, возвращающая sql.Composable
+        :param con: соединение для перевода запроса в текст
+        :return: текст запроса
+        """
+        with self._lock:
+            query = self._queries.get(key)
+            if query is not None:
+                self.hits += 1
+                return query
+            self.misses += 1
+        query = build()
+        if isinstance(query, sql.Composable):
+            query = query.as_string(con)
+        with self._lock:
+            return self._queries.setdefault(key, query)
+
+    def execute(self, cur, key: tuple, build, params=None) -> None:
+        """
+        Выполнить запрос из кэша на курсоре cur. Частые запросы
+        выполняются как подготовленные (см. prepare_threshold).
+
+        :param cur: курсор
+        :param key: ключ запроса
+        :param build: функция без параметров, возвращающая sql.Composable
+        :param params: параметры запроса (кортеж или словарь)
+        """
+        query = self.query(key, build, cur.connection)
+        with self._lock:
+            uses = self._uses.get(key, 0) + 1
+            self._uses[key] = uses
+        if self.prepare_threshold is None or uses < self.prepare_threshold:
+            cur.execute(query, params)
+            return
+
+        name, order = self._prepare(cur, key, query)
+        # order содержит имена (для словаря) или позиции (для кортежа)
+        values = [] if params is None else [params[item] for item in order]
+        placeholders = ', '.join(['%s'] * len(values))
+        with self._lock:
+            self.executed_prepared += 1
+        cur.execute(f'EXECUTE {name} ({placeholders})' if values
+                    else f'EXECUTE {name}', values)
+
+    def _prepare(self, cur, key: tuple, query: str) -> tuple:
+        con = cur.connection
+        with self._lock:
+            statement = self._statements.get(key)
+            if statement is None:
+                text, order = to_server_placeholders(query)
+                statement = (f'db_stmt_{next(self._names)}', text, order)
+                self._statements[key] = statement
+            _, names = self._prepared.setdefault(id(con), (con, set()))
+        name, text, order = statement
+
+        # соединение пула используется одним потоком, поэтому набор имен
+        # соединения изменяется без блокировки
+        if name not in names:
+            cur.execute(f'PREPARE {name} AS {text}')
+            names.add(name)
+        return name, order
+
+    def forget(self, con) -> None:
+        """
+        Забыть подготовленные запросы соединения (вызывается при закрытии
+        или замене соединения).
+
+        :param con: соединение
+        """
+        with self._lock:
+            self._prepared.pop(id(con), None)
+
+    def clear(self) -> None:
+        """
+        Очистить кэш текстов запросов и счетчики выполнений. Уже
+        подготовленные на сервере запросы остаются и переиспользуются.
+        """
+        with self._lock:
+            self._queries.clear()
+            self._uses.clear()
+
+    def stats(self) -> dict:
+        """
+        :return: {'hits', 'misses', 'statements', 'prepared',
+        'executed_prepared'}
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'statements': len(self._queries),
+                    'prepared': sum(len(names) for _, names in
+                                    self._prepared.values()),
+                    'executed_prepared': self.executed_prepared}
@@ -0,0 +1,393 @@
+"""
+Локальный архив сообщений каналов и воспроизведение архива через шаблоны
+без обращения к Telegram.
+"""
+import io
+import logging
+import sqlite3
+import threading
+import zlib
+from typing import AsyncIterator, Iterator, List
+
+from PIL import Image
+from telethon.extensions import BinaryReader
+from telethon.tl.patched import Message
+from telethon.tl.types import InputPeerChannel
+
+from TelegramParser.limiter import RateLimiter
+
+log = logging.getLogger(__name__)
+
+
+def slim_message(message: Message) -> Message:
+    """
+    Копия сообщения только с полями, которые используют шаблоны: id,
+    канал, дата, текст, разметка (ссылки), медиа (документ или фото) и
+    данные о пересылке.
+
+    :param message: сообщение
+    :return: сообщение с теми же типами Telethon
+    """
+    return Message(id=message.id, peer_id=message.peer_id,
+                   date=message.date, message=message.message,
+                   entities=message.entities, media=message.media,
+                   fwd_from=message.fwd_from)
+
+
+def dump_message(message: Message) -> bytes:
+    """
+    Сериализация сообщения (формат TL, как в протоколе Telegram) со
+    сжатием.
+    """
+    return zlib.compress(bytes(slim_message(message)), 1)
+
+
+def load_message(data: bytes) -> Message:
+    """
+    Восстановление сообщения из dump_message() в типы Telethon.
+    """
+    with BinaryReader(zlib.decompress(data)) as reader:
+        return reader.tgread_object()
+
+
+class MessageArchive:
+    """
+    Архив сообщений каналов в локальном файле SQLite.
+
+    Сообщение хранится в сжатом виде в формате TL (см. dump_message),
+    поэтому при чтении восстанавливаются те же типы Telethon (Message,
+    MessageMediaDocument, MessageEntityTextUrl и т.д.), что и при
+    получении из Telegram. Кроме сообщений каналов хранятся сообщения,
+    полученные по ссылкам, и данные каналов (юзернейм, название).
+
+    Запись выполняется пачками: изменения фиксируются каждые commit_every
+    сообщений и при close().
+
+    Пример.
+    archive = MessageArchive('../Media/archive.sqlite')
+    tg = TelegramConnect(api_id, api_hash, archive=archive)  # запись
+    tg = ReplayTelegramConnect(archive)                      # чтение
+    """
+
+    def __init__(self, path='archive.sqlite', commit_every=500) -> None:
+        self.path = path
+        self.commit_every = commit_every
+        self._pending = 0
+        self._lock = threading.Lock()
+        self.con = sqlite3.connect(path, check_same_thread=False)
+        with self.con:
+            self.con.execute(
+                "create table if not exists messages ("
+                "channel_id integer not null, "
+                "message_id integer not null, "
+                "data blob not null, "
+                "primary key (channel_id, message_id)) without rowid")
+            self.con.execute(
+                "create table if not exists channels ("
+                "channel_id integer primary key, "
+                "username text, "
+                "title text)")
+
+        # копия каналов в памяти: {channel_id: dict}, {username: channel_id}
+        self._by_id = {}
+        self._by_username = {}
+        for row in self.con.execute(
+                "select channel_id, username, title from channels"):
+            self._remember(*row)
+
+    def _remember(self, channel_id: int, username: str, title: str) -> dict:
+        info = {'channel_id': channel_id,
+                'username': username,
+                'title': title,
+                'access_hash': 0}
+        self._by_id[channel_id] = info
+        if username:
+            self._by_username[username.lower()] = channel_id
+        return info
+
+    def __enter__(self) -> 'MessageArchive':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self.con.execute(
+                "select count(*) from messages").fetchone()[0]
+
+    def put(self, message: Message) -> None:
+        """
+        Записать сообщение (повторная запись заменяет сообщение).
+
+        :param message: сообщение канала
+        """
+        self.put_many([message])
+
+    def put_many(self, messages: list) -> None:
+        """
+        Записать несколько сообщений.
+
+        :param messages: список сообщений (None пропускаются)
+        """
+        rows = [(message.peer_id.channel_id, message.id,
+                 dump_message(message))
+                for message in messages if message is not None]
+        if not rows:
+            return
+        with self._lock:
+            self.con.executemany(
+                "insert or replace into messages "
+                "(channel_id, message_id, data) values (?, ?, ?)", rows)
+            self._pending += len(rows)
+            if self._pending >= self.commit_every:
+                self.con.commit()
+                self._pending = 0
+
+    def put_channel(self, channel_id: int, username: str,
+                    title: str) -> None:
+        """
+        Записать данные канала, если они изменились.
+
+        :param channel_id: id канала (например, 1360755573)
+        :param username: юзернейм канала или None
+        :param title: название канала
+        """
+        info = self._by_id.get(channel_id)
+        if info and (info['username'], info['title']) == (username, title):
+            return
+        with self._lock:
+            self.con.execute(
+                "insert or replace into channels (channel_id, username, "
+                "title) values (?, ?, ?)", (channel_id, username, title))
+            self._remember(channel_id, username, title)
+
+    def get(self, channel_id: int, message_id: int) -> (Message, None):
+        """
+        :param channel_id: id канала
+        :param message_id: номер сообщения
+        :return: Message | None
+        """
+        with self._lock:
+            row = self.con.execute(
+                "select data from messages "
+                "where channel_id = ? and message_id = ?",
+                (channel_id, message_id)).fetchone()
+        return load_message(row[0]) if row else None
+
+    def get_channel(self, channel_attr) -> (dict, None):
+        """
+        Данные канала по channel_id или username.
+
+        :param channel_attr: id или username канала
+        (например, 1360755573 или 'physics_lib')
+        :return: словарь {'channel_id', 'username', 'title',
+        'access_hash'} или None, access_hash в архиве не хранится (0)
+        """
+        if isinstance(channel_attr, str):
+            channel_id = self._by_username.get(channel_attr.lower())
+        else:
+            channel_id = channel_attr
+        return self._by_id.get(channel_id)
+
+    def iter_messages(self, channel_id: int, min_id=0, limit=None,
+                      batch_size=1000, max_id=0) -> Iterator[Message]:
+        """
+        Сообщения канала с номером больше min_id в порядке возрастания.
+        Читаются пачками по batch_size, поэтому архив не загружается в
+        память целиком.
+
+        :param channel_id: id канала
+        :param min_id: минимальный номер сообщения (не включая)
+        :param limit: максимальное число сообщений (None - все)
+        :param batch_size: размер пачки чтения
+        :param max_id: максимальный номер сообщения (не включая, 0 - без
+        ограничения)
+        :return: итератор сообщений
+        """
+        max_id = max_id or 2 ** 63 - 1
+        count = 0
+        while limit is None or count < limit:
+            size = batch_size if limit is None \
+                else min(batch_size, limit - count)
+            with self._lock:
+                rows = self.con.execute(
+                    "select message_id, data from messages "
+                    "where channel_id = ? and message_id > ? "
+                    "and message_id < ? order by message_id limit ?",
+                    (channel_id, min_id, max_id, size)).fetchall()
+            if not rows:
+                return
+            for message_id, data in rows:
+                yield load_message(data)
+            count += len(rows)
+            min_id = rows[-1][0]
+
+    def last_message_id(self, channel_id: int) -> int:
+        """
+        :param channel_id: id канала
+        :return: номер последнего сообщения канала в архиве или 0
+        """
+        with self._lock:
+            row = self.con.execute(
+                "select max(message_id) from messages where channel_id = ?",
+                (channel_id,)).fetchone()
+        return row[0] or 0
+
+    def channels(self) -> list:
+        """
+        :return: список id каналов, сообщения которых есть в архиве
+        """
+        with self._lock:
+            return [row[0] for row in self.con.execute(
+                "select distinct channel_id from messages")]
+
+    def commit(self) -> None:
+        """
+        Зафиксировать записанные сообщения.
+        """
+        with self._lock:
+            self.con.commit()
+            self._pending = 0
+
+    def close(self) -> None:
+        """
+        Зафиксировать изменения и закрыть файл архива.
+        """
+        self.commit()
+        self.con.close()
+
+
+def _placeholder_photo() -> bytes:
+    buffer = io.BytesIO()
+    Image.new('RGB', (600, 800), (128, 128, 128)).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+class ReplayTelegramConnect:
+    """
+    Замена TelegramConnect, отдающая сообщения из архива MessageArchive.
+    Позволяет пропустить архив через шаблон (например,
+    physics_lib.physics_lib) со скоростью чтения с диска, без обращения к
+    Telegram.
+
+    Файлы не загружаются: при files=True вместо документа создается
+    файл-заглушка с id документа (хеш-суммы разных документов различны),
+    вместо фото - серое изображение, при files=False загрузка считается
+    неудачной.
+
+    Пример.
+    with MessageArchive('../Media/archive.sqlite') as archive:
+        tg = ReplayTelegramConnect(archive)
+        physics_lib.physics_lib(db, tg, table='replay_book_books', ...)
+    """
+
+    _photo = None
+
+    def __init__(self, archive: MessageArchive, files=True) -> None:
+        self.archive = archive
+        self.files = files
+        # совместимость с отчетами run.py
+        self.rate_limiter = RateLimiter()
+
+    def get_entity_info(self, channel_attr) -> dict:
+        info = self.archive.get_channel(channel_attr)
+        if info is None:
+            raise ValueError(f'канала {channel_attr} нет в архиве')
+        return info
+
+    def get_input_entity(self, channel_attr):
+        info = self.get_entity_info(channel_attr)
+        return InputPeerChannel(info['channel_id'], info['access_hash'])
+
+    def get_message(self, channel_attr, message_id: int) -> (Message, None):
+        try:
+            channel_id = self.get_entity_info(channel_attr)['channel_id']
+        except ValueError as exc:
+            log.warning(f'{exc} Возвращено None.')
+            return None
+        return self.archive.get(channel_id, message_id)
+
+    def get_messages_by_ids(self, channel_attr, ids: list) -> List[Message]:
+        messages = [self.get_message(channel_attr, message_id)
+                    for message_id in ids]
+        return [message for message in messages if message]
+
+    def get_messages(self, channel_id: int, min_id: int) -> Iterator[Message]:
+        return self.archive.iter_messages(channel_id, min_id=min_id)
+
+    def get_channel_name(self, channel_id) -> str:
+        return self.get_entity_info(channel_id)['title']
+
+    def get_channel_username(self, channel_id) -> str:
+        return self.get_entity_info(channel_id)['username']
+
+    def download_file(self, msg: Message, path: str, file_name=None) -> bool:
+        if not self.files:
+            return False
+        file_name = file_name or msg.file.name
+        with open(path + file_name, 'wb') as file:
+            file.write(f'replay document {msg.document.id}\n'.encode())
+        return True
+
+    def download_photo(self, msg: Message, path: str) -> (bool, str):
+        name_photo = f'{msg.peer_id.channel_id}_{msg.id}_0.jpg'
+        if self.files:
+            if ReplayTelegramConnect._photo is None:
+                ReplayTelegramConnect._photo = _placeholder_photo()
+            with open(path + name_photo, 'wb') as file:
+                file.write(ReplayTelegramConnect._photo)
+        return True, name_photo
+
+
+class AsyncReplayTelegramConnect:
+    """
+    Замена AsyncTelegramConnect, отдающая сообщения из архива (см.
+    ReplayTelegramConnect).
+    """
+
+    def __init__(self, archive: MessageArchive, files=True) -> None:
+        self.replay = ReplayTelegramConnect(archive, files=files)
+        self.rate_limiter = self.replay.rate_limiter
+
+    async def start(self) -> None:
+        pass
+
+    async def disconnect(self) -> None:
+        pass
+
+    async def get_entity_info(self, channel_attr) -> dict:
+        return self.replay.get_entity_info(channel_attr)
+
+    async def get_input_entity(self, channel_attr):
+        return self.replay.get_input_entity(channel_attr)
+
+    async def get_message(self, channel_attr,
+                          message_id: int) -> (Message, None):
+        return self.replay.get_message(channel_attr, message_id)
+
+    async def get_messages_by_ids(self, channel_attr,
+                                  ids: list) -> List[Message]:
+        return self.replay.get_messages_by_ids(channel_attr, ids)
+
+    async def iter_messages(self, channel_id: int, min_id: int,
+                            limit=None, max_id=0) -> AsyncIterator[Message]:
+        for message in self.replay.archive.iter_messages(
+                channel_id, min_id=min_id, limit=limit, max_id=max_id):
+            yield message
+
+    async def get_last_message_id(self, channel_id: int) -> int:
+        return self.replay.archive.last_message_id(channel_id)
+
+    async def get_channel_name(self, channel_id) -> str:
+        return self.replay.get_channel_name(channel_id)
+
+    async def get_channel_username(self, channel_id) -> str:
+        return self.replay.get_channel_username(channel_id)
+
+    async def download_file(self, msg: Message, path: str,
+                            file_name=None) -> bool:
+        return self.replay.download_file(msg, path, file_name)
+
+    async def download_photo(self, msg: Message, path: str) -> (bool, str):
+        return self.replay.download_photo(msg, path)
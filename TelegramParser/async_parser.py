@@ -0,0 +1,258 @@
+import asyncio
+import logging
+from typing import AsyncIterator, List
+
+from telethon.tl.patched import Message
+from telethon.tl.types import InputPeerChannel
+from datetime import datetime
+from TelegramParser.cache import EntityCache
+from TelegramParser.limiter import LimitedTelegramClient
+from Utils.metrics import METRICS
+from TelegramParser.parser import DOWNLOAD_CHUNK_SIZE, read_part_offset, \
+    write_part_offset, open_part, finish_part, use_parallel, \
+    download_parallel, part_path
+
+log = logging.getLogger(__name__)
+
+
+class AsyncTelegramConnect:
+    """
+    Асинхронный вариант TelegramConnect. Позволяет держать в работе несколько
+    сообщений одновременно: загрузки медиа и получение сообщений по ссылкам
+    ограничиваются отдельными семафорами.
+
+    Данные каналов кэшируются, а файлы загружаются с возможностью
+    продолжения и параллельно (от parallel_threshold байт) так же, как в
+    TelegramConnect. Запросы ограничиваются по частоте через rate_limiter.
+    Полученные сообщения записываются в archive, если он задан.
+
+    Перед использованием необходимо вызвать await start().
+    """
+
+    def __init__(self, api_id, api_hash, session='session_name',
+                 download_limit=4, link_limit=8,
+                 entity_cache_path='entity_cache.sqlite', entity_ttl=86400,
+                 download_retries=3, parallel_threshold=None,
+                 parallel_workers=4, rate_limiter=None, archive=None):
+
+        self.client = LimitedTelegramClient(session, api_id, api_hash,
+                                            rate_limiter=rate_limiter)
+        self.rate_limiter = self.client.rate_limiter
+        self.entity_cache = EntityCache(entity_cache_path, ttl=entity_ttl)
+        self.download_retries = download_retries
+        self.parallel_threshold = parallel_threshold
+        self.parallel_workers = parallel_workers
+        self.archive = archive
+        # ограничение числа одновременных загрузок файлов и фото
+        self.download_semaphore = asyncio.Semaphore(download_limit)
+        # ограничение числа одновременных запросов сообщений/сущностей
+        self.link_semaphore = asyncio.Semaphore(link_limit)
+
+    async def start(self) -> None:
+        """
+        Подключение к Telegram.
+        """
+        await self.client.start()
+
+    async def disconnect(self) -> None:
+        """
+        Отключение от Telegram.
+        """
+        await self.client.disconnect()
+
+    @METRICS.timed('entity_lookup')
+    async def get_entity_info(self, channel_attr) -> dict:
+        """
+        Получить данные канала из кэша, при отсутствии - из Telegram с
+        сохранением в кэш.
+
+        :param channel_attr: id или username канала
+        (например, 12345 или 'physics_lib')
+        :return: словарь {'channel_id', 'username', 'title', 'access_hash',
+        'updated'}
+        """
+        info = self.entity_cache.get(channel_attr)
+        if info is None:
+            async with self.link_semaphore:
+                entity = await self.client.get_entity(channel_attr)
+            info = self.entity_cache.put(entity.id,
+                                         getattr(entity, 'username', None),
+                                         getattr(entity, 'title', None),
+                                         getattr(entity, 'access_hash', None))
+        if self.archive is not None:
+            self.archive.put_channel(info['channel_id'], info['username'],
+                                     info['title'])
+        return info
+
+    async def get_input_entity(self, channel_attr):
+        """
+        Получить InputPeerChannel канала без обращения к Telegram, если
+        канал есть в кэше.
+
+        :param channel_attr: id или username канала
+        :return: InputPeerChannel
+        """
+        info = await self.get_entity_info(channel_attr)
+        return InputPeerChannel(info['channel_id'], info['access_hash'])
+
+    @METRICS.timed('link_resolution')
+    async def get_message(self, channel_attr,
+                          message_id: int) -> (Message, None):
+        """
+        Получить сообщение с заданным id=message_id из
+        канал с id=channel_id
+
+        :param channel_attr: id или username канала
+        :param message_id: номер сообщения в канале (например, 213)
+        :return: Message | None
+        """
+        try:
+            peer_channel = await self.get_input_entity(channel_attr)
+            async with self.link_semaphore:
+                message = await self.client.get_messages(peer_channel,
+                                                         ids=message_id)
+        except Exception as exc:
+            log.warning(f'{exc} Сгенерировано для сообщения {message_id} из '
+                        f'канала {channel_attr}. Возвращено None.')
+            return None
+        if self.archive is not None and message is not None:
+            self.archive.put(message)
+        return message
+
+    @METRICS.timed('link_resolution')
+    async def get_messages_by_ids(self, channel_attr,
+                                  ids: list) -> List[Message]:
+        """
+        Получить несколько сообщений канала одним запросом.
+
+        :param channel_attr: id или username канала
+        :param ids: список номеров сообщений (например, [213, 214, 300])
+        :return: список найденных сообщений (удаленные пропускаются)
+        """
+        try:
+            peer_channel = await self.get_input_entity(channel_attr)
+            async with self.link_semaphore:
+                messages = await self.client.get_messages(peer_channel,
+                                                          ids=list(ids))
+        except Exception as exc:
+            log.warning(f'{exc} Сгенерировано для сообщений {ids} из канала '
+                        f'{channel_attr}. Возвращен пустой список.')
+            return []
+        messages = [message for message in messages if message]
+        if self.archive is not None:
+            self.archive.put_many(messages)
+        return messages
+
+    async def iter_messages(self, channel_id: int, min_id: int,
+                            limit=None, max_id=0) -> AsyncIterator[Message]:
+        """
+        Асинхронный итератор сообщений канала с id=channel_id начиная со
+        следующего после min_id в порядке возрастания номеров.
+
+        :param channel_id: id канала (например, 12345)
+        :param min_id: минимальный номер сообщения (например, 12)
+        :param limit: максимальное число сообщений (None - все)
+        :param max_id: сообщения с номером меньше max_id (0 - до последнего)
+        :return: асинхронный итератор сообщений
+        """
+        peer_channel = await self.get_input_entity(channel_id)
+        async for message in self.client.iter_messages(peer_channel,
+                                                       limit=limit,
+                                                       min_id=min_id,
+                                                       max_id=max_id,
+                                                       reverse=True):
+            if self.archive is not None:
+                self.archive.put(message)
+            yield message
+
+    async def get_last_message_id(self, channel_id: int) -> int:
+        """
+        Получить номер последнего сообщения канала.
+
+        :param channel_id: id канала (например, 12345)
+        :return: номер сообщения или 0, если сообщений нет
+        """
+        peer_channel = await self.get_input_entity(channel_id)
+        messages = await self.client.get_messages(peer_channel, limit=1)
+        return messages[0].id if messages else 0
+
+    async def get_channel_name(self, channel_id) -> str:
+        """
+        Получить имя канала.
+
+        :param channel_id: id канала (например, 12345)
+        :return: название канала
+        """
+        return (await self.get_entity_info(channel_id))['title']
+
+    async def get_channel_username(self, channel_id) -> str:
+        """
+        Получить юзернейм канала.
+        """
+        return (await self.get_entity_info(channel_id))['username']
+
+    @METRICS.timed('download')
+    async def download_file(self, msg: Message, path: str,
+                            file_name=None) -> bool:
+        """
+        Загрузка файла из сообщения по указанному пути с продолжением
+        после обрыва (см. TelegramConnect.download_file).
+
+        :param msg: экземпляр класса Message
+        :param path: путь для загрузки файла (например, '/Media/Downloads/')
+        :param file_name: имя сохраняемого файла (по умолчанию имя файла
+        в сообщении)
+        :return: True/False
+        """
+        file_name = file_name or msg.file.name
+        async with self.download_semaphore:
+            for attempt in range(1, self.download_retries + 1):
+                try:
+                    await self._download_resumable(msg, path + file_name)
+                    log.info(f'Загружен файл {file_name}')
+                    return True
+                except Exception as exc:
+                    log.warning(f'{exc} Проблемы с загрузкой файла '
+                                f'{file_name} из '
+                                f'channel_id:{msg.peer_id.channel_id} '
+                                f'msg_id: {msg.id} '
+                                f'(попытка {attempt}/{self.download_retries})')
+        return False
+
+    async def _download_resumable(self, msg: Message, path_file: str) -> None:
+        size = msg.document.size
+        path_part = part_path(path_file, msg.document)
+        if use_parallel(size, self.parallel_threshold):
+            await download_parallel(self.client, msg.document, path_file,
+                                    workers=self.parallel_workers)
+            return
+        offset = read_part_offset(path_part)
+
+        with open_part(path_part, offset) as file:
+            if offset < size:
+                async for chunk in self.client.iter_download(
+                        msg.document, offset=offset,
+                        request_size=DOWNLOAD_CHUNK_SIZE, file_size=size):
+                    file.write(chunk)
+                    offset += len(chunk)
+                    file.flush()
+                    write_part_offset(path_part, offset)
+
+        finish_part(path_part, path_file, offset, size)
+
+    @METRICS.timed('download')
+    async def download_photo(self, msg: Message, path: str) -> (bool, str):
+        """
+        Сохраняет фото из сообщения по заданному пути.
+        Имя сохраняемого фото в виде:
+        '{msg.peer_id.channel_id}_{msg.id}_{datetime.now().microsecond}.jpg'
+
+        :param msg: экземпляр класса Message
+        :param path: путь для загрузки изображения (например, '/Media/Photo/')
+        :return: Tuple[True, название_файла]
+        """
+        name_photo = '{}_{}_{}.jpg'.format(
+            msg.peer_id.channel_id, msg.id, datetime.now().microsecond)
+        async with self.download_semaphore:
+            await self.client.download_media(msg, file=path + name_photo)
+        return True, name_photo
@@ -0,0 +1,273 @@
+"""
+Историческая загрузка канала несколькими сессиями Telegram.
+"""
+import asyncio
+import logging
+from collections import deque
+
+from DatabaseTools.connect import DB
+from Utils.log import Progress
+
+log = logging.getLogger(__name__)
+
+
+def split_ranges(min_id: int, max_id: int, range_size: int) -> list:
+    """
+    Разбить номера сообщений (min_id, max_id] на диапазоны не больше
+    range_size номеров.
+
+    Пример.
+    split_ranges(0, 12000, 5000) -> [(0, 5000), (5000, 10000),
+                                     (10000, 12000)]
+
+    :param min_id: номер сообщения перед первым диапазоном
+    :param max_id: номер последнего сообщения
+    :param range_size: размер диапазона (например, 5000)
+    :return: список (range_start, range_end)
+    """
+    return [(start, min(start + range_size, max_id))
+            for start in range(min_id, max_id, range_size)]
+
+
+class DBRanges:
+    """
+    Диапазоны исторической загрузки в таблице БД (схема
+    schemas.BACKFILL_RANGES).
+    """
+
+    def __init__(self, db: DB, table: str) -> None:
+        self.db = db
+        self.table = table
+
+    def get(self, channel_id: int) -> list:
+        """
+        :param channel_id: id канала (например, 1360755573)
+        :return: список словарей {'start', 'end', 'message_id',
+        'complete'} по возрастанию start
+        """
+        return [{'start': start, 'end': end, 'message_id': message_id,
+                 'complete': complete}
+                for start, end, message_id, complete in
+                self.db.get_backfill_ranges(self.table, channel_id)]
+
+    def add(self, channel_id: int, ranges: list) -> None:
+        """
+        :param channel_id: id канала (например, 1360755573)
+        :param ranges: список (range_start, range_end)
+        """
+        self.db.add_backfill_ranges(self.table, channel_id, ranges)
+
+    def set(self, channel_id: int, start: int, message_id: int,
+            complete=False) -> None:
+        """
+        :param channel_id: id канала (например, 1360755573)
+        :param start: начало диапазона
+        :param message_id: номер последнего обработанного сообщения
+        :param complete: диапазон обработан полностью
+        """
+        self.db.set_backfill_range(self.table, channel_id, start,
+                                   message_id, complete)
+
+
+class MemoryRanges:
+    """
+    Диапазоны в памяти (для пробных запусков и проверки без БД).
+    """
+
+    def __init__(self) -> None:
+        # {channel_id: {start: dict}}
+        self.ranges = {}
+
+    def get(self, channel_id: int) -> list:
+        return [dict(item) for _, item in
+                sorted(self.ranges.get(channel_id, {}).items())]
+
+    def add(self, channel_id: int, ranges: list) -> None:
+        channel = self.ranges.setdefault(channel_id, {})
+        for start, end in ranges:
+            channel.setdefault(start, {'start': start, 'end': end,
+                                       'message_id': start,
+                                       'complete': False})
+
+    def set(self, channel_id: int, start: int, message_id: int,
+            complete=False) -> None:
+        item = self.ranges[channel_id][start]
+        item['message_id'] = max(item['message_id'], message_id)
+        item['complete'] = item['complete'] or complete
+
+
+class Backfill:
+    """
+    Историческая загрузка канала несколькими сессиями Telegram.
+
+    Номера сообщений канала от контрольной точки до последнего сообщения
+    делятся на диапазоны по range_size (см. split_ranges), диапазоны
+    записываются в ranges (DBRanges) и раздаются сессиям по мере
+    освобождения: быстрая сессия берет больше диапазонов. У каждой сессии
+    свой клиент (отдельный файл сессии, свой RateLimiter и кэш каналов,
+    так как access_hash у каждой учетной записи свой) и свой шаблон,
+    через который идут загрузки и сообщения по ссылкам, поэтому частота
+    запросов ограничивается для каждой сессии отдельно.
+
+    Диапазон обрабатывается ходами по quota сообщений, после каждого хода
+    в ranges записывается номер последнего обработанного сообщения,
+    поэтому после перезапуска загрузка продолжается с него, а уже
+    завершенные диапазоны пропускаются. Результаты записываются шаблонами
+    в те же таблицы, что и при обычном парсинге (повторные сообщения
+    пропускаются по уникальному ключу). Когда все диапазоны завершены,
+    контрольная точка канала в checkpoints (scheduler.DBCheckpoints)
+    сдвигается на конец последнего диапазона, и обычный парсинг
+    продолжает канал с него.
+
+    Ошибка в диапазоне останавливает сессию (например, сессия
+    разлогинена), диапазон возвращается в очередь другим сессиям.
+
+    От клиента требуются методы get_last_message_id(channel_id) и
+    iter_messages(channel_id, min_id, limit, max_id), от шаблона - open(),
+    close(), db_call(func, *args) и process(channel_id, messages) (см.
+    ChannelScheduler). Шаблоны сессий должны получать общий db_executor.
+
+    Пример.
+    backfill = Backfill([(tg_1, parser_1), (tg_2, parser_2)],
+                        DBRanges(db, 'backfill_ranges'),
+                        checkpoints=DBCheckpoints(db, 'parser_checkpoints',
+                                                  'service_info'))
+    await backfill.run(1360755573) -> {0: {'ranges': 5, 'messages': 9120},
+                                       1: {'ranges': 4, ...}}
+    """
+
+    def __init__(self, sessions: list, ranges, range_size=5000, quota=100,
+                 checkpoints=None) -> None:
+        if not sessions:
+            raise ValueError('нет сессий для загрузки')
+        self.sessions = sessions
+        self.ranges = ranges
+        self.range_size = range_size
+        self.quota = quota
+        self.checkpoints = checkpoints
+
+    async def plan(self, channel_id: int) -> list:
+        """
+        Диапазоны канала. При первом запуске диапазоны от контрольной
+        точки канала до последнего сообщения создаются и записываются в
+        ranges, при повторном - читаются из ranges.
+
+        :param channel_id: id канала (например, 1360755573)
+        :return: список словарей {'start', 'end', 'message_id', 'complete'}
+        """
+        tg, template = self.sessions[0]
+        ranges = await template.db_call(self.ranges.get, channel_id)
+        if ranges:
+            return ranges
+        min_id = 0
+        if self.checkpoints is not None:
+            min_id = await template.db_call(self.checkpoints.get,
+                                            channel_id)
+        max_id = await tg.get_last_message_id(channel_id)
+        await template.db_call(self.ranges.add, channel_id,
+                               split_ranges(min_id, max_id, self.range_size))
+        return await template.db_call(self.ranges.get, channel_id)
+
+    async def run(self, channel_id: int) -> dict:
+        """
+        Загрузка всех незавершенных диапазонов канала.
+
+        :param channel_id: id канала (например, 1360755573)
+        :return: {номер сессии: {'ranges': число завершенных диапазонов,
+        'messages': число полученных сообщений}}
+        """
+        templates = []
+        for _, template in self.sessions:
+            if template not in templates:
+                templates.append(template)
+        report = {index: {'ranges': 0, 'messages': 0}
+                  for index in range(len(self.sessions))}
+
+        try:
+            for template in templates:
+                await template.open()
+            ranges = await self.plan(channel_id)
+            queue = deque(item for item in ranges if not item['complete'])
+            log.info(f'Канал {channel_id}: диапазонов {len(ranges)}, '
+                     f'осталось {len(queue)}, сессий {len(self.sessions)}.')
+            with Progress(f'BACKFILL:: канал {channel_id}',
+                          unit='msg') as progress:
+                await asyncio.gather(
+                    *(self._worker(channel_id, index, queue, report,
+                                   progress)
+                      for index in range(len(self.sessions))))
+        finally:
+            for template in templates:
+                await template.close()
+
+        if all(item['complete'] for item in ranges):
+            if ranges and self.checkpoints is not None:
+                await templates[0].db_call(self.checkpoints.set, channel_id,
+                                           ranges[-1]['end'])
+            log.info(f'Канал {channel_id}: историческая загрузка '
+                     f'завершена.')
+        else:
+            log.warning(f'Канал {channel_id}: историческая загрузка не '
+                        f'завершена, осталось диапазонов '
+                        f'{sum(not item["complete"] for item in ranges)}.')
+        return report
+
+    async def _worker(self, channel_id: int, index: int, queue: deque,
+                      report: dict, progress: Progress) -> None:
+        tg, template = self.sessions[index]
+        while queue:
+            item = queue.popleft()
+            try:
+                count = await self.fill(channel_id, item, tg, template,
+                                        progress)
+            except Exception as exc:
+                log.error(f'{exc} Сессия {index}: диапазон ({item["start"]}, '
+                          f'{item["end"]}] канала {channel_id} возвращен в '
+                          f'очередь, сессия остановлена.')
+                queue.append(item)
+                return
+            report[index]['ranges'] += 1
+            report[index]['messages'] += count
+            log.info(f'Сессия {index}: диапазон ({item["start"]}, '
+                     f'{item["end"]}] канала {channel_id} загружен, '
+                     f'сообщений {count}.')
+
+    async def fill(self, channel_id: int, item: dict, tg, template,
+                   progress=None) -> int:
+        """
+        Загрузка диапазона от последнего обработанного сообщения ходами по
+        quota сообщений с записью хода после каждого из них.
+
+        :param channel_id: id канала (например, 1360755573)
+        :param item: диапазон {'start', 'end', 'message_id', 'complete'}
+        :param tg: клиент сессии
+        :param template: шаблон сессии
+        :param progress: индикатор выполнения или None
+        :return: число полученных сообщений
+        """
+        total = 0
+        while not item['complete']:
+            min_id = item['message_id']
+            seen = {'count': 0, 'last': min_id}
+
+            async def messages():
+                async for message in tg.iter_messages(
+                        channel_id, min_id=min_id, limit=self.quota,
+                        max_id=item['end'] + 1):
+                    seen['count'] += 1
+                    seen['last'] = max(seen['last'], message.id)
+                    yield message
+
+            # process() записывает буфер в БД до возврата, поэтому ход
+            # диапазона не опережает записанные данные
+            await template.process(channel_id, messages())
+            complete = seen['count'] < self.quota
+            if seen['last'] > min_id or complete:
+                await template.db_call(self.ranges.set, channel_id,
+                                       item['start'], seen['last'], complete)
+            item['message_id'] = seen['last']
+            item['complete'] = complete
+            total += seen['count']
+            if progress is not None:
+                progress.update(seen['count'])
+        return total
@@ -0,0 +1,127 @@
+import sqlite3
+import time
+
+
+class EntityCache:
+    """
+    Кэш сущностей (каналов) Telegram с хранением в локальном файле SQLite.
+
+    Для каждого канала хранит channel_id, username, название и access_hash.
+    Поиск возможен по channel_id или по username. Записи старше ttl секунд
+    считаются устаревшими и удаляются. Благодаря файлу кэш сохраняется между
+    запусками.
+
+    Пример.
+    cache = EntityCache('entity_cache.sqlite', ttl=86400)
+    cache.put(1360755573, 'physics_lib', 'Physics Library', 123456789)
+    cache.get('physics_lib') -> {'channel_id': 1360755573, ...}
+    """
+
+    def __init__(self, path='entity_cache.sqlite', ttl=86400) -> None:
+        self.ttl = ttl
+        self.con = sqlite3.connect(path)
+        with self.con:
+            self.con.execute(
+                "create table if not exists entities ("
+                "channel_id integer primary key, "
+                "username text, "
+                "title text, "
+                "access_hash integer, "
+                "updated real not null)")
+            self.con.execute(
+                "create index if not exists entities_username "
+                "on entities (username)")
+        self.evict_expired()
+
+        # копия кэша в памяти: {channel_id: dict}, {username: channel_id}
+        self._by_id = {}
+        self._by_username = {}
+        for row in self.con.execute(
+                "select channel_id, username, title, access_hash, updated "
+                "from entities"):
+            self._remember(*row)
+
+    def _remember(self, channel_id: int, username: str, title: str,
+                  access_hash: int, updated: float) -> dict:
+        info = {'channel_id': channel_id,
+                'username': username,
+                'title': title,
+                'access_hash': access_hash,
+                'updated': updated}
+        self._by_id[channel_id] = info
+        if username:
+            self._by_username[username.lower()] = channel_id
+        return info
+
+    def get(self, channel_attr) -> (dict, None):
+        """
+        Получить данные канала по channel_id или username.
+
+        :param channel_attr: id или username канала
+        (например, 1360755573 или 'physics_lib')
+        :return: словарь {'channel_id', 'username', 'title', 'access_hash',
+        'updated'} или None, если записи нет или она устарела
+        """
+        if isinstance(channel_attr, str):
+            channel_id = self._by_username.get(channel_attr.lower())
+        else:
+            channel_id = channel_attr
+        info = self._by_id.get(channel_id)
+        if info is None:
+            return None
+        if time.time() - info['updated'] > self.ttl:
+            self.delete(channel_id)
+            return None
+        return info
+
+    def put(self, channel_id: int, username: str, title: str,
+            access_hash: int) -> dict:
+        """
+        Записать данные канала в кэш.
+
+        :param channel_id: id канала (например, 1360755573)
+        :param username: юзернейм канала или None
+        :param title: название канала
+        :param access_hash: access_hash канала
+        :return: словарь с данными канала
+        """
+        self.delete(channel_id)
+        updated = time.time()
+        with self.con:
+            self.con.execute(
+                "insert or replace into entities "
+                "(channel_id, username, title, access_hash, updated) "
+                "values (?, ?, ?, ?, ?)",
+                (channel_id, username, title, access_hash, updated))
+        return self._remember(channel_id, username, title, access_hash,
+                              updated)
+
+    def delete(self, channel_id: int) -> None:
+        """
+        Удалить канал из кэша.
+
+        :param channel_id: id канала (например, 1360755573)
+        """
+        info = self._by_id.pop(channel_id, None)
+        if info and info['username']:
+            self._by_username.pop(info['username'].lower(), None)
+        with self.con:
+            self.con.execute("delete from entities where channel_id = ?",
+                             (channel_id,))
+
+    def evict_expired(self) -> int:
+        """
+        Удалить из файла кэша устаревшие записи.
+
+        :return: число удаленных записей
+        """
+        with self.con:
+            cur = self.con.execute("delete from entities where updated < ?",
+                                   (time.time() - self.ttl,))
+        return cur.rowcount
+
+    def close(self) -> None:
+        """
+        Закрыть файл кэша.
+        """
+        self.con.close()
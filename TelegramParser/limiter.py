@@ -0,0 +1,235 @@
+"""
+Ограничение частоты запросов к Telegram с учетом FloodWait.
+"""
+import asyncio
+import logging
+import time
+
+from telethon import TelegramClient, errors, utils
+
+from Utils.metrics import METRICS, DOWNLOAD_BYTES
+
+log = logging.getLogger(__name__)
+
+# Классы запросов: {имя класса запроса Telethon: класс}
+REQUEST_CLASSES = {
+    'GetHistoryRequest': 'history',
+    'SearchRequest': 'history',
+    'GetMessagesRequest': 'messages',
+    'ResolveUsernameRequest': 'entity',
+    'GetChannelsRequest': 'entity',
+    'GetFullChannelRequest': 'entity',
+    'GetUsersRequest': 'entity',
+    'GetFileRequest': 'download',
+}
+
+# Начальная (она же максимальная) частота запросов в секунду и допустимая
+# пачка запросов для каждого класса
+DEFAULT_RATES = {
+    'history': (2.0, 5),
+    'messages': (1.0, 5),
+    'entity': (0.5, 3),
+    'download': (10.0, 20),
+    'other': (2.0, 5),
+}
+
+
+def request_class(request) -> str:
+    """
+    Класс запроса для ограничения частоты.
+
+    :param request: запрос Telethon или список запросов
+    (например, GetHistoryRequest(...))
+    :return: класс запроса (например, 'history')
+    """
+    if utils.is_list_like(request):
+        request = request[0]
+    return REQUEST_CLASSES.get(type(request).__name__, 'other')
+
+
+class TokenBucket:
+    """
+    Маркерная корзина: в среднем rate запросов в секунду, не больше
+    capacity подряд.
+
+    Частота подстраивается под ответы Telegram: после FloodWait частота
+    уменьшается в decrease раз (но не ниже min_rate) и запросы
+    приостанавливаются на время ожидания, после каждого успешного запроса
+    частота увеличивается на increase * max_rate, но не выше max_rate.
+    """
+
+    def __init__(self, rate: float, capacity: int, min_rate=0.05,
+                 decrease=0.5, increase=0.01) -> None:
+        self.rate = self.max_rate = rate
+        self.capacity = capacity
+        self.min_rate = min_rate
+        self.decrease = decrease
+        self.increase = increase
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def reserve(self) -> float:
+        """
+        Занять маркер.
+
+        :return: сколько секунд нужно подождать перед запросом
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(delay, self.blocked_until - now)
+
+    def success(self) -> None:
+        """
+        Учесть успешный запрос.
+        """
+        self.rate = min(self.max_rate,
+                        self.rate + self.max_rate * self.increase)
+
+    def flood(self, seconds: float) -> None:
+        """
+        Учесть FloodWait.
+
+        :param seconds: время ожидания из FloodWait, сек
+        """
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        self.tokens = min(self.tokens, 0.0)
+        self.blocked_until = max(self.blocked_until,
+                                 time.monotonic() + seconds)
+
+
+class RateLimiter:
+    """
+    Ограничение частоты запросов к Telegram с отдельной маркерной корзиной
+    на каждый класс запросов (см. REQUEST_CLASSES и DEFAULT_RATES).
+
+    После FloodWait запрос повторяется по истечении ожидания (не больше
+    retries раз). Ожидания дольше max_flood_wait секунд не выжидаются -
+    FloodWaitError передается вызывающему.
+
+    Время ожидания учитывается по классам: 'paced' - ожидание маркера,
+    'throttled' - ожидание после FloodWait.
+
+    Пример.
+    limiter = RateLimiter(rates={'entity': (0.2, 2)})
+    client = LimitedTelegramClient('session_name', api_id, api_hash,
+                                   rate_limiter=limiter)
+    ...
+    log.info(limiter.summary())
+    """
+
+    def __init__(self, rates=None, retries=5, max_flood_wait=600) -> None:
+        rates = dict(DEFAULT_RATES, **(rates or {}))
+        self.buckets = {name: TokenBucket(rate, capacity)
+                        for name, (rate, capacity) in rates.items()}
+        self.retries = retries
+        self.max_flood_wait = max_flood_wait
+        self.stats = {name: {'calls': 0, 'floods': 0, 'paced': 0.0,
+                             'throttled': 0.0}
+                      for name in self.buckets}
+
+    async def call(self, request_class_: str, func, *args, **kwargs):
+        """
+        Выполнить запрос с ограничением частоты и повтором после
+        FloodWait.
+
+        :param request_class_: класс запроса (например, 'history')
+        :param func: асинхронная функция запроса
+        :return: результат func
+        """
+        bucket = self.buckets.get(request_class_, self.buckets['other'])
+        stats = self.stats.get(request_class_, self.stats['other'])
+        attempt = 0
+        while True:
+            blocked = bucket.blocked_until - time.monotonic()
+            delay = bucket.reserve()
+            if delay > 0:
+                throttled = min(max(blocked, 0.0), delay)
+                stats['throttled'] += throttled
+                stats['paced'] += delay - throttled
+                await asyncio.sleep(delay)
+            stats['calls'] += 1
+            try:
+                result = await func(*args, **kwargs)
+            except errors.FloodWaitError as exc:
+                attempt += 1
+                stats['floods'] += 1
+                bucket.flood(exc.seconds)
+                if attempt > self.retries or \
+                        exc.seconds > self.max_flood_wait:
+                    raise
+                log.warning(f'FloodWait {exc.seconds} с для запросов '
+                            f'{request_class_}, частота снижена до '
+                            f'{bucket.rate:.2f}/с',
+                            extra={'flood_wait': exc.seconds,
+                                   'request_class': request_class_})
+                # ожидание выполняется в reserve() следующей попытки
+                continue
+            bucket.success()
+            return result
+
+    def throttled_time(self) -> float:
+        """
+        :return: суммарное время ожидания после FloodWait, сек
+        """
+        return sum(stats['throttled'] for stats in self.stats.values())
+
+    def report(self) -> dict:
+        """
+        :return: {класс: {'calls', 'floods', 'paced', 'throttled', 'rate'}}
+        """
+        return {name: dict(stats, rate=self.buckets[name].rate)
+                for name, stats in self.stats.items()}
+
+    def summary(self) -> str:
+        """
+        :return: текстовый отчет по классам запросов
+        """
+        lines = []
+        for name, stats in self.report().items():
+            if stats['calls']:
+                lines.append(
+                    f'{name}: запросов {stats["calls"]}, '
+                    f'FloodWait {stats["floods"]}, '
+                    f'ожидание {stats["paced"]:.1f} с + '
+                    f'{stats["throttled"]:.1f} с после FloodWait, '
+                    f'частота {stats["rate"]:.2f}/с')
+        return '\n'.join(lines)
+
+
+class LimitedTelegramClient(TelegramClient):
+    """
+    TelegramClient, все запросы которого (в том числе внутри
+    iter_messages, get_entity и загрузок) проходят через RateLimiter.
+    Встроенное ожидание FloodWait в Telethon отключается, чтобы ожидания
+    учитывались ограничителем.
+
+    Длительность каждого запроса (без ожидания ограничителя) учитывается
+    в METRICS как операция 'telegram_{класс запроса}', полученные при
+    загрузке файлов байты - в счетчике DOWNLOAD_BYTES.
+    """
+
+    def __init__(self, *args, rate_limiter=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.flood_sleep_threshold = 0
+
+    async def _call(self, sender, request, ordered=False,
+                    flood_sleep_threshold=None):
+        class_ = request_class(request)
+        return await self.rate_limiter.call(
+            class_, self._timed_call, class_, sender, request,
+            ordered=ordered, flood_sleep_threshold=flood_sleep_threshold)
+
+    async def _timed_call(self, class_: str, sender, request, **kwargs):
+        with METRICS.timer('telegram_' + class_):
+            result = await super()._call(sender, request, **kwargs)
+        if class_ == 'download':
+            data = getattr(result, 'bytes', None)
+            if data:
+                METRICS.inc(DOWNLOAD_BYTES, len(data))
+        return result
@@ -1,12 +1,34 @@
+import asyncio
+import contextlib
+import logging
 from typing import List
 
-from telethon.sync import TelegramClient
+from telethon import errors, utils
+# синхронные методы клиента для TelegramConnect
+import telethon.sync  # noqa: F401
+from telethon.tl.functions.upload import GetFileRequest
 from telethon.tl.patched import Message
 from telethon.tl.types import MessageEntityTextUrl, MessageMediaPhoto
-from telethon.tl.types import MessageMediaDocument
+from telethon.tl.types import MessageMediaDocument, InputPeerChannel
+from TelegramParser.cache import EntityCache
+from TelegramParser.limiter import LimitedTelegramClient
+from Utils.log import Progress
+from Utils.metrics import METRICS
 from datetime import datetime
-from tqdm import tqdm
+import os
 import re
+import threading
+import time
+
+# Размер запрашиваемой части файла при загрузке (максимум для Telegram)
+DOWNLOAD_CHUNK_SIZE = 512 * 1024
+
+log = logging.getLogger(__name__)
+
+# Имена файлов, занятые загрузками в процессе (полные пути), см.
+# local_file_name() и release_file_name()
+_reserved_names = set()
+_reserved_lock = threading.Lock()
 
 
 class TelegramConnect:
@@ -14,15 +36,76 @@ class TelegramConnect:
     Класс для подключения к Telegram и набором методов для работы
     с сообщениями.
 
-    """
+    Данные каналов (название, юзернейм, access_hash) кэшируются в файле
+    entity_cache_path на entity_ttl секунд, чтобы не запрашивать их
+    повторно в том числе между запусками.
+
+    Файлы загружаются частями во временный файл '{id документа}.part' с
+    возможностью продолжить загрузку после обрыва (download_retries
+    попыток).
+    Документы размером от parallel_threshold байт загружаются
+    parallel_workers параллельными запросами (см. download_parallel),
+    parallel_threshold=None отключает параллельную загрузку.
 
-    def __init__(self, api_id, api_hash, session='session_name'):
+    Все запросы к Telegram проходят через rate_limiter (см.
+    limiter.RateLimiter): частота ограничивается по классам запросов,
+    после FloodWait запрос повторяется. Отчет - self.rate_limiter.summary().
 
-        self.client = TelegramClient(session, api_id, api_hash)
-        self.pbar = None
-        self.prev_current = 0
+    Если задан archive (archive.MessageArchive), полученные сообщения и
+    данные каналов записываются в локальный архив для последующего
+    воспроизведения через archive.ReplayTelegramConnect.
+    """
+
+    def __init__(self, api_id, api_hash, session='session_name',
+                 entity_cache_path='entity_cache.sqlite', entity_ttl=86400,
+                 download_retries=3, parallel_threshold=None,
+                 parallel_workers=4, rate_limiter=None, archive=None):
+
+        self.client = LimitedTelegramClient(session, api_id, api_hash,
+                                            rate_limiter=rate_limiter)
+        self.rate_limiter = self.client.rate_limiter
+        self.entity_cache = EntityCache(entity_cache_path, ttl=entity_ttl)
+        self.download_retries = download_retries
+        self.parallel_threshold = parallel_threshold
+        self.parallel_workers = parallel_workers
+        self.archive = archive
         self.client.start()
 
+    @METRICS.timed('entity_lookup')
+    def get_entity_info(self, channel_attr) -> dict:
+        """
+        Получить данные канала из кэша, при отсутствии - из Telegram с
+        сохранением в кэш.
+
+        :param channel_attr: id или username канала
+        (например, 12345 или 'physics_lib')
+        :return: словарь {'channel_id', 'username', 'title', 'access_hash',
+        'updated'}
+        """
+        info = self.entity_cache.get(channel_attr)
+        if info is None:
+            entity = self.client.get_entity(channel_attr)
+            info = self.entity_cache.put(entity.id,
+                                         getattr(entity, 'username', None),
+                                         getattr(entity, 'title', None),
+                                         getattr(entity, 'access_hash', None))
+        if self.archive is not None:
+            self.archive.put_channel(info['channel_id'], info['username'],
+                                     info['title'])
+        return info
+
+    def get_input_entity(self, channel_attr):
+        """
+        Получить InputPeerChannel канала без обращения к Telegram, если
+        канал есть в кэше.
+
+        :param channel_attr: id или username канала
+        :return: InputPeerChannel
+        """
+        info = self.get_entity_info(channel_attr)
+        return InputPeerChannel(info['channel_id'], info['access_hash'])
+
+    @METRICS.timed('link_resolution')
     def get_message(self, channel_attr, message_id: int) -> (Message, None):
         """
         Получить сообщение с заданным id=message_id из
@@ -33,14 +116,37 @@ class TelegramConnect:
         :return: Message | None
         """
         try:
-            message = self.client.iter_messages(channel_attr, ids=message_id)
-            return message.__next__()
+            message = self.client.iter_messages(
+                self.get_input_entity(channel_attr), ids=message_id)
+            message = message.__next__()
         except Exception as exc:
-            print(exc,
-                  f'\nСгенерировано для сообщения {message_id} из канала '
-                  f'{channel_attr}\n',
-                  'Возвращено None.')
+            log.warning(f'{exc} Сгенерировано для сообщения {message_id} из '
+                        f'канала {channel_attr}. Возвращено None.')
             return None
+        if self.archive is not None and message is not None:
+            self.archive.put(message)
+        return message
+
+    @METRICS.timed('link_resolution')
+    def get_messages_by_ids(self, channel_attr, ids: list) -> List[Message]:
+        """
+        Получить несколько сообщений канала одним запросом.
+
+        :param channel_attr: id или username канала
+        :param ids: список номеров сообщений (например, [213, 214, 300])
+        :return: список найденных сообщений (удаленные пропускаются)
+        """
+        try:
+            messages = self.client.get_messages(
+                self.get_input_entity(channel_attr), ids=list(ids))
+        except Exception as exc:
+            log.warning(f'{exc} Сгенерировано для сообщений {ids} из канала '
+                        f'{channel_attr}. Возвращен пустой список.')
+            return []
+        messages = [message for message in messages if message]
+        if self.archive is not None:
+            self.archive.put_many(messages)
+        return messages
 
     def get_messages(self, channel_id: int, min_id: int) -> List[Message]:
         """
@@ -53,11 +159,18 @@ class TelegramConnect:
         :return: список сообщений
         """
 
-        peer_channel = self.client.get_entity(channel_id)
+        peer_channel = self.get_input_entity(channel_id)
         messages = self.client.iter_messages(peer_channel, min_id=min_id,
                                              reverse=True)
+        if self.archive is not None:
+            return self._archived(messages)
         return messages
 
+    def _archived(self, messages):
+        for message in messages:
+            self.archive.put(message)
+            yield message
+
     def get_channel_name(self, channel_id) -> str:
         """
         Получить имя канала.
@@ -65,37 +178,70 @@ class TelegramConnect:
         :param channel_id: id канала (например, 12345)
         :return: название канала
         """
-        return self.client.get_entity(channel_id).title
+        return self.get_entity_info(channel_id)['title']
 
     def get_channel_username(self, channel_id) -> str:
         """
         Получить юзернейм канала.
         """
-        return self.client.get_entity(channel_id).username
+        return self.get_entity_info(channel_id)['username']
 
-    def download_file(self, msg: Message, path: str) -> bool:
+    @METRICS.timed('download')
+    def download_file(self, msg: Message, path: str, file_name=None) -> bool:
         """
         Загрузка файла из сообщения по указанному пути.
 
+        Файл загружается частями в '{id документа}.part' (см. part_path),
+        смещение загруженной части записывается в
+        '{id документа}.part.offset'. При обрыве загрузка продолжается с
+        сохраненного смещения (в том числе при следующем запуске, даже если
+        итоговое имя файла будет другим). Готовый файл проверяется по
+        размеру документа и переименовывается в итоговое имя.
+
         :param msg: экземпляр класса Message
         :param path: путь для загрузки файла (например, '/Media/Downloads/')
+        :param file_name: имя сохраняемого файла (по умолчанию имя файла
+        в сообщении)
         :return: True/False
         """
-        try:
-            self.prev_current = 0
-            self.pbar = tqdm(total=msg.document.size, desc=msg.file.name,
-                             unit='B', unit_scale=True, colour='green')
-            self.client.download_media(msg, file=path + msg.file.name,
-                                       progress_callback=self.__callback)
-            self.pbar.close()
-            del self.pbar
-            return True
-        except Exception as exc:
-            print(exc, f'Проблемы с загрузкой файла {msg.file.name} из '
-                  f'channel_id:{msg.peer_id.channel_id} msg_id: {msg.id}')
-            # дописать проверку на недогруженный файл
-            return False
-
+        file_name = file_name or msg.file.name
+        for attempt in range(1, self.download_retries + 1):
+            try:
+                self._download_resumable(msg, path + file_name)
+                return True
+            except Exception as exc:
+                log.warning(f'{exc} Проблемы с загрузкой файла {file_name} '
+                            f'из channel_id:{msg.peer_id.channel_id} '
+                            f'msg_id: {msg.id} '
+                            f'(попытка {attempt}/{self.download_retries})')
+        return False
+
+    def _download_resumable(self, msg: Message, path_file: str) -> None:
+        size = msg.document.size
+        path_part = part_path(path_file, msg.document)
+        offset = read_part_offset(path_part)
+
+        with Progress(os.path.basename(path_file), total=size, unit='B',
+                      logger=log, initial=offset) as progress:
+            if use_parallel(size, self.parallel_threshold):
+                self.client.loop.run_until_complete(download_parallel(
+                    self.client, msg.document, path_file,
+                    workers=self.parallel_workers, progress=progress.update))
+                return
+            with open_part(path_part, offset) as file:
+                if offset < size:
+                    for chunk in self.client.iter_download(
+                            msg.document, offset=offset,
+                            request_size=DOWNLOAD_CHUNK_SIZE, file_size=size):
+                        file.write(chunk)
+                        offset += len(chunk)
+                        file.flush()
+                        write_part_offset(path_part, offset)
+                        progress.update(len(chunk))
+
+        finish_part(path_part, path_file, offset, size)
+
+    @METRICS.timed('download')
     def download_photo(self, msg: Message, path: str) -> (bool, str):
         """
         Сохраняет фото из сообщения по заданному пути.
@@ -114,9 +260,211 @@ class TelegramConnect:
         self.client.download_media(msg, file=path + name_photo)
         return True, name_photo
 
-    def __callback(self, current, total):
-        self.pbar.update(current - self.prev_current)
-        self.prev_current = current
+
+def part_path(path_file: str, document) -> str:
+    """
+    Путь к временному файлу загрузки документа. Имя временного файла
+    задается id документа, а не итоговым именем, поэтому незавершенная
+    загрузка продолжается при следующем запуске и не занимает имя для
+    других документов.
+
+    :param path_file: путь к итоговому файлу (например, 'Downloads/book.pdf')
+    :param document: документ из сообщения (msg.document)
+    :return: путь (например, 'Downloads/5345345345.part')
+    """
+    return os.path.join(os.path.dirname(path_file), f'{document.id}.part')
+
+
+def remove_stale_parts(path: str, max_age: float) -> int:
+    """
+    Удаляет временные файлы загрузок ('.part' и '.part.offset'), которые
+    не изменялись больше max_age секунд (загрузки, которые не будут
+    продолжены).
+
+    :param path: путь к папке загрузок (например, '/Media/Downloads/')
+    :param max_age: возраст в секундах (например, 604800)
+    :return: число удаленных файлов
+    """
+    deadline = time.time() - max_age
+    removed = 0
+    for entry in os.scandir(path):
+        if not entry.is_file() or \
+                not entry.name.endswith(('.part', '.part.offset')):
+            continue
+        try:
+            if entry.stat().st_mtime < deadline:
+                os.remove(entry.path)
+                removed += 1
+        except FileNotFoundError:
+            pass
+    if removed:
+        log.info(f'OS:: удалено незавершенных загрузок {removed} в {path}')
+    return removed
+
+
+def read_part_offset(path_part: str) -> int:
+    """
+    Смещение, с которого можно продолжить загрузку во временный файл.
+    Берется меньшее из записанного смещения и размера файла, выровненное
+    вниз до DOWNLOAD_CHUNK_SIZE.
+
+    :param path_part: путь к временному файлу (например, '5345345345.part')
+    :return: смещение в байтах (0, если загрузка не начиналась)
+    """
+    try:
+        with open(path_part + '.offset', encoding='utf-8') as file:
+            offset = int(file.read().strip() or 0)
+        offset = min(offset, os.path.getsize(path_part))
+    except (OSError, ValueError):
+        return 0
+    return offset - offset % DOWNLOAD_CHUNK_SIZE
+
+
+def write_part_offset(path_part: str, offset: int) -> None:
+    """
+    Записывает смещение загруженной части временного файла.
+
+    :param path_part: путь к временному файлу (например, '5345345345.part')
+    :param offset: смещение в байтах
+    """
+    with open(path_part + '.offset', 'w', encoding='utf-8') as file:
+        file.write(str(offset))
+
+
+def open_part(path_part: str, offset: int):
+    """
+    Открывает временный файл для записи с заданного смещения, отбрасывая
+    данные после смещения.
+
+    :param path_part: путь к временному файлу (например, '5345345345.part')
+    :param offset: смещение в байтах
+    :return: файловый объект
+    """
+    file = open(path_part, 'r+b' if offset else 'wb')
+    file.truncate(offset)
+    file.seek(offset)
+    return file
+
+
+def finish_part(path_part: str, path_file: str, offset: int,
+                size: int) -> None:
+    """
+    Проверяет размер загруженного временного файла и переименовывает его в
+    итоговый файл.
+
+    :param path_part: путь к временному файлу (например, '5345345345.part')
+    :param path_file: путь к итоговому файлу (например, 'book.pdf')
+    :param offset: число загруженных байт
+    :param size: ожидаемый размер файла
+    """
+    if offset != size:
+        raise IOError(f'файл {path_file} загружен не полностью: '
+                      f'{offset} из {size} байт')
+    os.replace(path_part, path_file)
+    # у пустого документа смещение не записывается
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(path_part + '.offset')
+
+
+def use_parallel(size: int, threshold) -> bool:
+    """
+    Проверяет, нужно ли загружать документ параллельно.
+
+    :param size: размер документа в байтах
+    :param threshold: минимальный размер для параллельной загрузки в байтах
+    (например, 10485760) или None
+    :return: True/False
+    """
+    return threshold is not None and size >= threshold
+
+
+async def download_parallel(client, document, path_file: str, workers=4,
+                            part_size=DOWNLOAD_CHUNK_SIZE,
+                            progress=None) -> None:
+    """
+    Параллельная загрузка документа частями.
+
+    Документ делится на части по part_size байт, которые запрашиваются
+    workers одновременными запросами GetFileRequest через отправителя
+    того дата-центра, где хранится файл. Части записываются по своим
+    смещениям в заранее созданный временный файл нужного размера (см.
+    part_path). В '{id документа}.part.offset' записывается граница
+    непрерывно загруженного начала файла, поэтому после обрыва загрузку
+    можно продолжить как параллельно, так и последовательно (см.
+    TelegramConnect.download_file).
+
+    :param client: подключенный TelegramClient
+    :param document: документ из сообщения (msg.document)
+    :param path_file: путь к итоговому файлу (например, 'book.pdf')
+    :param workers: число одновременных запросов (например, 4)
+    :param part_size: размер части, кратный 4096 и делитель 1048576
+    :param progress: функция, принимающая число загруженных байт
+    """
+    size = document.size
+    path_part = part_path(path_file, document)
+    offset = read_part_offset(path_part)
+    parts = iter(range(offset, size, part_size))
+    done = set()
+    dc_id, location = utils.get_input_location(document)
+    borrowed = []
+
+    async def get_sender(new_dc_id):
+        if not new_dc_id or new_dc_id == client.session.dc_id:
+            return client._sender
+        sender = await client._borrow_exported_sender(new_dc_id)
+        borrowed.append(sender)
+        return sender
+
+    state = {'sender': await get_sender(dc_id), 'offset': offset}
+
+    async def request(start):
+        request_ = GetFileRequest(location, offset=start, limit=part_size)
+        timed_out = False
+        while True:
+            try:
+                return (await client._call(state['sender'], request_)).bytes
+            except errors.FileMigrateError as exc:
+                state['sender'] = await get_sender(exc.new_dc)
+            except errors.TimeoutError:
+                # как и в Telethon, одна повторная попытка после таймаута
+                if timed_out:
+                    raise
+                timed_out = True
+
+    async def worker(file):
+        for start in parts:
+            data = await request(start)
+            if len(data) != min(part_size, size - start):
+                raise IOError(f'часть файла {path_file} со смещения {start} '
+                              f'загружена не полностью: {len(data)} байт')
+            # между seek и write нет await, поэтому части не смешиваются
+            file.seek(start)
+            file.write(data)
+            done.add(start)
+            if progress:
+                progress(len(data))
+            while state['offset'] in done:
+                done.remove(state['offset'])
+                state['offset'] = min(state['offset'] + part_size, size)
+            file.flush()
+            write_part_offset(path_part, state['offset'])
+
+    try:
+        with open_part(path_part, offset) as file:
+            file.truncate(size)
+            tasks = [asyncio.ensure_future(worker(file)) for _ in range(
+                max(min(workers, -(-(size - offset) // part_size)), 1))]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        for sender in borrowed:
+            await client._return_exported_sender(sender)
+
+    finish_part(path_part, path_file, state['offset'], size)
 
 
 def get_links_from_message(msg: Message, pattern: str) -> list:
@@ -140,6 +488,22 @@ def get_links_from_message(msg: Message, pattern: str) -> list:
     return message_entity
 
 
+def group_links(links: list) -> dict:
+    """
+    Группирует ссылки на сообщения по юзернейму канала. Повторяющиеся
+    ссылки отбрасываются, порядок сохраняется.
+
+    :param links: list({'username': username, "message_id": message_id}, ...)
+    :return: {username: [message_id, ...], ...}
+    """
+    grouped = {}
+    for link in links:
+        ids = grouped.setdefault(link['username'], [])
+        if link['message_id'] not in ids:
+            ids.append(link['message_id'])
+    return grouped
+
+
 def delete_emoji(text: str) -> str:
     """
     Удаляет emoji из текста.
@@ -237,6 +601,50 @@ def check_file_size(msg: Message, limit_file_size: int) -> bool:
     return True if msg.document.size <= limit_file_size else False
 
 
+def local_file_name(msg: Message, path: str) -> str:
+    """
+    Имя файла для сохранения документа из сообщения. Имя занимается до
+    вызова release_file_name(), поэтому одновременные загрузки разных
+    документов с одинаковым именем (в том числе из разных шаблонов одного
+    процесса) не пишут в один файл. Если имя из сообщения занято
+    загрузкой или существующим файлом, к имени добавляется id документа, а
+    если занято и оно - номер. Временные файлы загрузок имя не занимают
+    (см. part_path).
+
+    :param msg: экземпляр класса Message
+    :param path: путь для загрузки файла (например, '/Media/Downloads/')
+    :return: имя файла (например, 'book.pdf' или 'book_5345345345.pdf')
+    """
+    file_name = msg.file.name
+    name, dot, ext = file_name.rpartition('.')
+    if not dot:
+        name, ext = ext, ''
+    candidates = [file_name, f'{name}_{msg.document.id}{dot}{ext}']
+    with _reserved_lock:
+        number = 2
+        while True:
+            for candidate in candidates:
+                path_file = os.path.abspath(path + candidate)
+                if path_file not in _reserved_names and \
+                        not os.path.exists(path_file):
+                    _reserved_names.add(path_file)
+                    return candidate
+            candidates = [f'{name}_{msg.document.id}_{number}{dot}{ext}']
+            number += 1
+
+
+def release_file_name(path: str, file_name: str) -> None:
+    """
+    Освободить имя, занятое local_file_name(), после окончания загрузки
+    (успешной или нет).
+
+    :param path: путь для загрузки файла (например, '/Media/Downloads/')
+    :param file_name: имя файла
+    """
+    with _reserved_lock:
+        _reserved_names.discard(os.path.abspath(path + file_name))
+
+
 def type_file(file_name: str) -> str:
     """
     Вытаскивает тип файла.
@@ -0,0 +1,289 @@
+"""
+Планировщик парсинга нескольких каналов через один клиент Telegram.
+"""
+import asyncio
+import logging
+from collections import deque
+
+from DatabaseTools.connect import DB
+
+log = logging.getLogger(__name__)
+
+
+class DBCheckpoints:
+    """
+    Контрольные точки парсинга каналов в таблице БД (схема
+    schemas.CHECKPOINTS). Для канала без контрольной точки берется номер
+    последнего сообщения из сервисной таблицы, если она задана.
+    """
+
+    def __init__(self, db: DB, table: str, service_table=None) -> None:
+        self.db = db
+        self.table = table
+        self.service_table = service_table
+
+    def get(self, channel_id: int) -> int:
+        """
+        :param channel_id: id канала (например, 1360755573)
+        :return: номер последнего обработанного сообщения или 0
+        """
+        message_id = self.db.get_checkpoint(self.table, channel_id)
+        if message_id is None and self.service_table:
+            message_id = self.db.get_last_post(self.service_table, channel_id)
+        return message_id or 0
+
+    def set(self, channel_id: int, message_id: int) -> None:
+        """
+        :param channel_id: id канала (например, 1360755573)
+        :param message_id: номер последнего обработанного сообщения
+        """
+        self.db.set_checkpoint(self.table, channel_id, message_id)
+
+
+class MemoryCheckpoints:
+    """
+    Контрольные точки в памяти (для пробных запусков и проверки
+    планировщика без БД).
+    """
+
+    def __init__(self, initial=None) -> None:
+        self.points = dict(initial or {})
+
+    def get(self, channel_id: int) -> int:
+        return self.points.get(channel_id, 0)
+
+    def set(self, channel_id: int, message_id: int) -> None:
+        self.points[channel_id] = max(self.points.get(channel_id, 0),
+                                      message_id)
+
+
+class ServiceCheckpoints:
+    """
+    Контрольные точки по сервисной таблице: номер последнего сообщения
+    канала в ней. set() ничего не делает, точка сдвигается записью
+    сообщений в сервисную таблицу.
+    """
+
+    def __init__(self, db: DB, service_table: str) -> None:
+        self.db = db
+        self.service_table = service_table
+
+    def get(self, channel_id: int) -> int:
+        return self.db.get_last_post(self.service_table, channel_id)
+
+    def set(self, channel_id: int, message_id: int) -> None:
+        pass
+
+
+class DBFailures:
+    """
+    Число неудачных попыток обработки сообщений в таблице БД (схема
+    schemas.PARSER_FAILURES).
+    """
+
+    def __init__(self, db: DB, table: str) -> None:
+        self.db = db
+        self.table = table
+
+    def add(self, channel_id: int, message_id: int, stage: str,
+            error: str) -> int:
+        """
+        :param channel_id: id канала (например, 1360755573)
+        :param message_id: номер сообщения
+        :param stage: стадия обработки (например, 'image')
+        :param error: текст ошибки
+        :return: число неудачных попыток, включая эту
+        """
+        return self.db.add_failure(self.table, channel_id, message_id, stage,
+                                   error)
+
+
+class MemoryFailures:
+    """
+    Число неудачных попыток в памяти (учитываются только попытки текущего
+    запуска).
+    """
+
+    def __init__(self) -> None:
+        self.attempts = {}
+
+    def add(self, channel_id: int, message_id: int, stage: str,
+            error: str) -> int:
+        key = (channel_id, message_id)
+        self.attempts[key] = self.attempts.get(key, 0) + 1
+        return self.attempts[key]
+
+
+class ChannelScheduler:
+    """
+    Параллельный парсинг нескольких каналов через один клиент Telegram.
+
+    Каждому каналу сопоставляется шаблон (например,
+    physics_lib_async.PhysicsLibParser). Каналы обрабатываются по кругу:
+    за один ход канал получает не больше quota новых сообщений, после чего
+    уступает очередь следующему. Одновременно обрабатывается не больше
+    concurrency каналов. После каждого хода контрольная точка канала
+    сдвигается на последнее обработанное сообщение, поэтому каналы
+    продолжаются независимо друг от друга, в том числе после перезапуска.
+
+    От клиента требуется только метод
+    iter_messages(channel_id, min_id, limit), поэтому вместо
+    AsyncTelegramConnect можно передать тестовый клиент, отдающий заранее
+    подготовленные сообщения.
+
+    От шаблона требуются методы open(), close(), db_call(func, *args) и
+    process(channel_id, messages). Обращения к контрольным точкам
+    выполняются через db_call шаблона канала.
+
+    Пример.
+    scheduler = ChannelScheduler(tg, DBCheckpoints(db, 'parser_checkpoints',
+                                                   'service_info'))
+    scheduler.add(1360755573, parser)
+    await scheduler.run() -> {1360755573: 120}
+    """
+
+    def __init__(self, telegram_connect, checkpoints, concurrency=4,
+                 quota=100) -> None:
+        self.tg = telegram_connect
+        self.checkpoints = checkpoints
+        self.concurrency = concurrency
+        self.quota = quota
+        # [(channel_id, шаблон), ...] в порядке добавления
+        self.jobs = []
+
+    def add(self, channel_id: int, template) -> None:
+        """
+        Добавить канал в расписание.
+
+        :param channel_id: id канала (например, 1360755573)
+        :param template: шаблон парсинга канала
+        """
+        if any(channel_id == job[0] for job in self.jobs):
+            raise ValueError(f'канал {channel_id} уже добавлен')
+        self.jobs.append((channel_id, template))
+
+    async def run(self) -> dict:
+        """
+        Обрабатывает все каналы до последнего сообщения. Ошибка в одном
+        канале не останавливает остальные: канал исключается из текущего
+        запуска, его контрольная точка остается на последнем успешном ходе.
+
+        :return: {channel_id: число обработанных сообщений}
+        """
+        templates = []
+        for _, template in self.jobs:
+            if template not in templates:
+                templates.append(template)
+        queue = deque(self.jobs)
+        processed = {channel_id: 0 for channel_id, _ in self.jobs}
+
+        try:
+            for template in templates:
+                await template.open()
+            await asyncio.gather(
+                *(self._worker(queue, processed)
+                  for _ in range(min(self.concurrency, len(queue)))))
+        finally:
+            for template in templates:
+                await template.close()
+        return processed
+
+    async def _worker(self, queue: deque, processed: dict) -> None:
+        while queue:
+            channel_id, template = job = queue.popleft()
+            try:
+                count = await self.turn(channel_id, template)
+            except Exception as exc:
+                log.error(f'{exc} Парсинг канала {channel_id} остановлен.')
+                continue
+            processed[channel_id] += count
+            if count >= self.quota:
+                queue.append(job)
+            else:
+                log.info(f'Канал {channel_id}: новых сообщений нет, '
+                         f'обработано {processed[channel_id]}.')
+
+    async def stream(self):
+        """
+        Сообщения всех каналов одним асинхронным потоком (например, для
+        источника конвейера PhysicsLibParser.pipeline()). Каналы
+        чередуются так же, как в run(): за ход канал дает не больше quota
+        сообщений, одновременно читается не больше concurrency каналов.
+        Контрольные точки только читаются (в начале), сдвигает их
+        потребитель после записи сообщений в БД.
+
+        :return: асинхронный итератор (channel_id, сообщение)
+        """
+        queue = deque(self.jobs)
+        cursors = {}
+        output = asyncio.Queue(maxsize=self.quota)
+        # признак окончания работы обработчика
+        finished = object()
+
+        async def worker():
+            try:
+                while queue:
+                    channel_id, template = job = queue.popleft()
+                    count = 0
+                    try:
+                        if channel_id not in cursors:
+                            cursors[channel_id] = await template.db_call(
+                                self.checkpoints.get, channel_id)
+                        async for message in self.tg.iter_messages(
+                                channel_id, min_id=cursors[channel_id],
+                                limit=self.quota):
+                            count += 1
+                            cursors[channel_id] = max(cursors[channel_id],
+                                                      message.id)
+                            await output.put((channel_id, message))
+                    except Exception as exc:
+                        log.error(f'{exc} Парсинг канала {channel_id} '
+                                  f'остановлен.')
+                        continue
+                    if count >= self.quota:
+                        queue.append(job)
+                    else:
+                        log.info(f'Канал {channel_id}: новых сообщений нет.')
+            finally:
+                await output.put(finished)
+
+        workers = [asyncio.ensure_future(worker())
+                   for _ in range(min(self.concurrency, len(queue)))]
+        running = len(workers)
+        try:
+            while running:
+                item = await output.get()
+                if item is finished:
+                    running -= 1
+                else:
+                    yield item
+        finally:
+            for task in workers:
+                task.cancel()
+
+    async def turn(self, channel_id: int, template) -> int:
+        """
+        Один ход канала: обработка до quota сообщений после контрольной
+        точки и сдвиг контрольной точки.
+
+        :param channel_id: id канала (например, 1360755573)
+        :param template: шаблон парсинга канала
+        :return: число полученных сообщений
+        """
+        min_id = await template.db_call(self.checkpoints.get, channel_id)
+        seen = {'count': 0, 'last': min_id}
+
+        async def messages():
+            async for message in self.tg.iter_messages(
+                    channel_id, min_id=min_id, limit=self.quota):
+                seen['count'] += 1
+                seen['last'] = max(seen['last'], message.id)
+                yield message
+
+        # process() записывает буфер в БД до возврата, поэтому контрольная
+        # точка не опережает записанные данные
+        await template.process(channel_id, messages())
+        if seen['last'] > min_id:
+            await template.db_call(self.checkpoints.set, channel_id,
+                                   seen['last'])
+        return seen['count']
@@ -1,15 +1,23 @@
 """
 Шаблоны для парсинга телеграм каналов
 """
+import logging
+import os
+
 from TelegramParser.parser import check_repost, check_document, check_photo, \
     get_text, get_links_from_message, check_type_file, check_file_size, \
-    type_file, get_year
+    type_file, get_year, group_links, local_file_name, release_file_name
 
-from DatabaseTools.connect import DB
+from DatabaseTools.connect import DB, BulkWriter
+from DatabaseTools.index import ProcessedIndex, DocumentIndex
+from DatabaseTools.schemas import CONFLICT_KEY
 from TelegramParser.parser import TelegramConnect
 from telethon.tl.patched import Message
 from datetime import datetime
-from Utils.plugins import image_thumbnail, image_resize_height
+from Utils.images import ImagePipeline
+from Utils.plugins import checksum_md5
+
+log = logging.getLogger(__name__)
 
 
 def checker_physics_lib(message: Message,
@@ -31,6 +39,45 @@ def checker_physics_lib(message: Message,
     return flag_check
 
 
+def resolve_links_physics_lib(links: list,
+                              telegram_connect: TelegramConnect,
+                              friendly_channels: list) -> list:
+    """
+    Функция получает сообщения по списку ссылок (например, по ссылкам
+    из нескольких сообщений). Ссылки группируются по каналу, сообщения
+    каждого канала запрашиваются одним запросом. Каналы не входящие в
+    friendly_channels отбрасываются до запроса сообщений по
+    закэшированному соответствию username -> channel_id.
+
+    :param links: list({'username': username, "message_id": message_id}, ...)
+    :param telegram_connect: класс с подключеным Telegram
+    :param friendly_channels: список id разрешенных каналов
+    :return: список сообщений в порядке ссылок
+    """
+    friendly_channels = set(friendly_channels)
+    found = {}
+    for username, ids in group_links(links).items():
+        try:
+            channel_id = telegram_connect.get_entity_info(
+                username)['channel_id']
+        except Exception as exc:
+            log.warning(f'{exc} Канал {username} не найден.')
+            continue
+        if channel_id not in friendly_channels:
+            continue
+        for message_link in telegram_connect.get_messages_by_ids(username,
+                                                                 ids):
+            found[(username, message_link.id)] = message_link
+
+    filter_links = []
+    for link in links:
+        message_link = found.pop((link['username'], link['message_id']),
+                                 None)
+        if message_link:
+            filter_links.append(message_link)
+    return filter_links
+
+
 def filtering_links_physics_lib(message: Message,
                                 telegram_connect: TelegramConnect,
                                 friendly_channels: list,
@@ -38,61 +85,114 @@ def filtering_links_physics_lib(message: Message,
     """
     Функция проверяет находятся ли в теле сообщения ссылки на разрешенные
     Вами список разрешенных каналов. Соответственно в friendly_channels
-    передается список этих ресурсов(username). Переменная pattern содержит
+    передается список этих ресурсов(channel_id). Переменная pattern содержит
     шаблон по которому происходит отбор(для телеграма он един)
 
     :param message: сообщение
     :param telegram_connect: класс с подключеным Telegram
     :param friendly_channels: список разрешенных каналов (
-    например, ['channel1', 'ch3'])
+    например, [1360755573, 1234567890])
     :param pattern: шаблон отбора ссылок, (например, 'https://t.me/\S+/\d+')
     :return: список отфильтрованных ссылок
     """
     links = get_links_from_message(message, pattern=pattern)
-    filter_links = []
-    if len(links):
-        for link in links:
-            message_link = telegram_connect.get_message(link['username'],
-                                                        link['message_id']
-                                                        )
-            if message_link:
-                channel_id = message_link.peer_id.channel_id
-                if channel_id in friendly_channels:
-                    filter_links.append(message_link)
-    return filter_links
+    return resolve_links_physics_lib(links, telegram_connect,
+                                     friendly_channels)
 
 
 def downloader_physics_lib(message: Message, telegram_connect: TelegramConnect,
-                           path_download: str) -> (str, bool):
+                           path_download: str,
+                           documents: DocumentIndex = None,
+                           record: dict = None) -> (str, bool):
     """
     Функция загрузки файла из сообщения. Использует метод
     TelegramConnect.download_file(). Возвращает название загруженного файла и
     статус загрузки.
 
+    Если передан индекс документов, то документ, загруженный ранее (по
+    document.id), повторно не загружается, а после загрузки файл с уже
+    известной хеш-суммой удаляется и заменяется ссылкой на имеющийся файл.
+    В record записываются хеш-сумма и ссылка на ЯндексДиск имеющегося файла.
+
     :param message: сообщение
     :param telegram_connect: класс с подключеным Telegram
     :param path_download: путь для сохранения файла,
     (например, r'../Media/Downloads/')
+    :param documents: индекс загруженных документов или None
+    :param record: словарь данных для записи или None
     :return: список отфильтрованных ссылок
     """
     file_name = None
     corresponds_params = False
-
-    if telegram_connect.download_file(message, path_download):
-        file_name = message.file.name
-        corresponds_params = True
+    record = {} if record is None else record
+
+    if documents is not None:
+        known = documents.get_by_document(message.document.id)
+        if known:
+            log.debug(f'Документ {message.document.id} уже загружен: '
+                      f'{known["file_name"]}')
+            record['file_hash'] = known['file_hash']
+            record['yadisk'] = known['yadisk']
+            return known['file_name'], True
+
+    record['file_hash'] = None
+    record['yadisk'] = None
+    local_name = local_file_name(message, path_download)
+    try:
+        if telegram_connect.download_file(message, path_download,
+                                          local_name):
+            file_name = local_name
+            corresponds_params = True
+            if documents is not None:
+                file_name = register_document_physics_lib(
+                    message, documents, path_download, file_name, record)
+    finally:
+        release_file_name(path_download, local_name)
 
     return file_name, corresponds_params
 
 
+def register_document_physics_lib(message: Message, documents: DocumentIndex,
+                                  path_download: str, file_name: str,
+                                  record: dict) -> str:
+    """
+    Функция добавляет загруженный файл в индекс документов. Если файл с
+    такой же хеш-суммой уже есть, новый файл удаляется и используется
+    имеющийся.
+
+    :param message: сообщение
+    :param documents: индекс загруженных документов
+    :param path_download: путь к загруженным файлам
+    :param file_name: имя загруженного файла
+    :param record: словарь данных для записи
+    :return: имя файла, на который ссылается запись
+    """
+    file_hash = checksum_md5(path_download + file_name)
+    known = documents.get_by_hash(file_hash)
+    if known and known['file_name'] != file_name and (
+            known['yadisk'] or
+            os.path.exists(path_download + known['file_name'])):
+        log.info(f'Файл {file_name} совпадает с {known["file_name"]}, '
+                 f'копия удалена')
+        os.remove(path_download + file_name)
+        file_name = known['file_name']
+        record['yadisk'] = known['yadisk']
+    documents.add(message.document.id, file_name, file_hash,
+                  record.get('yadisk'))
+    record['file_hash'] = file_hash
+    return file_name
+
+
 def write_db_physics_lib(message: Message, database_connect: DB,
                          telegram_connect: TelegramConnect,
                          channel_id: int, record: dict,
-                         table: str, t_me_link: str) -> bool:
+                         table: str, t_me_link: str,
+                         writer: BulkWriter = None) -> bool:
     """
     Функция для первичной записи данных в основную таблицу БД. Функция
     извлекает текст, название канала год и остальные данные из сообщения и
-    записывает их в заданную таблицу БД.
+    записывает их в заданную таблицу БД. Если передан writer, запись
+    помещается в его буфер.
 
     :param message: сообщение
     :param database_connect: класс для работы с БД
@@ -101,6 +201,7 @@ def write_db_physics_lib(message: Message, database_connect: DB,
     :param record: словарь данных для записи
     :param table: название основной таблицы
     :param t_me_link: шаблон адреса, 'https://t.me'
+    :param writer: буферизованный писатель BulkWriter или None
     :return: True/False
     """
 
@@ -120,23 +221,29 @@ def write_db_physics_lib(message: Message, database_connect: DB,
         record['date'] = datetime.now()
         record['year'] = get_year(record['description'])
 
-        print(record)
-        database_connect.insert_record(table=table, dictionary=record)
-        print(f'Сообщение {message.id} добавлено в базу данных {table}!')
+        if writer is not None:
+            writer.add(table, dict(record))
+        else:
+            database_connect.insert_record(table=table, dictionary=record)
+        log.debug(f'Сообщение {message.id} добавлено в базу данных {table}!',
+                  extra={'channel_id': channel_id, 'message_id': message.id,
+                         'file_name': record['file_name']})
 
         return True
     except Exception as ex:
-        print(ex)
-        print(f'Сообщение {message.id} сохранить в {table} не удалось!')
+        log.warning(f'{ex} Сообщение {message.id} сохранить в {table} не '
+                    f'удалось!')
         return False
 
 
 def write_service_info_db_physics_lib(message: Message, database_connect: DB,
-                                      channel_id: int, info: dict, table: str):
+                                      channel_id: int, info: dict, table: str,
+                                      writer: BulkWriter = None):
     """
     Функция для записи статуса по сообщению сервис таблицу БД. Функция
     извлекает текст, название канала год и остальные данные из сообщения и
-    записывает их в заданную таблицу БД.
+    записывает их в заданную таблицу БД. Если передан writer, запись
+    помещается в его буфер.
     Словарь со статусами операций над сообщением вида
     {"corresponds_params": bool, "complete": bool}
 
@@ -145,23 +252,27 @@ def write_service_info_db_physics_lib(message: Message, database_connect: DB,
     :param channel_id: id канала
     :param info: словарь содержащий
     :param table: название сервисной таблицы
+    :param writer: буферизованный писатель BulkWriter или None
     """
     try:
         info["channel_id"] = channel_id
         info["message_id"] = message.id
         info["date"] = datetime.now()
 
-        database_connect.insert_record(table=table, dictionary=info)
-        print(
-            f'Запись {channel_id} {message.id} '
-            f'добавлено в базу данных {table}!')
+        if writer is not None:
+            # если строки сообщения не будут записаны (например, запись в
+            # основную таблицу не пройдет проверку БД), статус записывается
+            # с complete=False
+            writer.add(table, dict(info),
+                       on_failure=dict(info, complete=False))
+        else:
+            database_connect.insert_record(table=table, dictionary=info)
+        log.debug(f'Запись {channel_id} {message.id} '
+                  f'добавлено в базу данных {table}!')
 
     except Exception as ex:
-        print(ex)
-        print(info)
-        print(
-            f'Запись {channel_id} {message.id} в базу '
-            f'данных {table} незавершена!')
+        log.warning(f'{ex} Запись {channel_id} {message.id} в базу '
+                    f'данных {table} незавершена!', extra={'info': info})
 
 
 def physics_lib(database_connect: DB, telegram_connect: TelegramConnect,
@@ -169,7 +280,8 @@ def physics_lib(database_connect: DB, telegram_connect: TelegramConnect,
                 path_photo: str, path_download: str,
                 limit_file_size: int, type_file_download: list,
                 t_me_link: str, pattern: str,
-                channel_id=1360755573):
+                channel_id=1360755573, batch_size=100, flush_interval=5.0,
+                image_workers=None):
     """
     Функция шаблон для парсинга сообщений телеграмм канала
     с channel_id=1360755573. Содержит пример логики отбора и фильтраций
@@ -186,8 +298,36 @@ def physics_lib(database_connect: DB, telegram_connect: TelegramConnect,
     :param t_me_link: стандартный адрес телеграмма
     :param pattern: шаблон фильтрации ссылок
     :param channel_id: id канала парсинга
+    :param batch_size: число строк для пакетной записи в БД
+    :param flush_interval: максимальный интервал между записями в БД, сек
+    :param image_workers: число процессов обработки изображений
     :return:
     """
+    # повторная запись сообщения (например, при пересекающихся запусках)
+    # пропускается по уникальному ключу (channel_id, message_id)
+    conflicts = database_connect.conflict_keys([table, service_table],
+                                               CONFLICT_KEY)
+    with ImagePipeline(workers=image_workers) as images, \
+            database_connect.bulk_writer(batch_size=batch_size,
+                                         flush_interval=flush_interval,
+                                         returning={table: 'id'},
+                                         conflicts=conflicts) as writer:
+        _physics_lib(database_connect, telegram_connect, table,
+                     service_table, path_photo, path_download,
+                     limit_file_size, type_file_download, t_me_link, pattern,
+                     channel_id, writer, images)
+
+
+def _physics_lib(database_connect: DB, telegram_connect: TelegramConnect,
+                 table: str, service_table: str,
+                 path_photo: str, path_download: str,
+                 limit_file_size: int, type_file_download: list,
+                 t_me_link: str, pattern: str,
+                 channel_id: int, writer: BulkWriter, images: ImagePipeline):
+    """
+    Тело шаблона physics_lib. Все записи в БД идут через writer,
+    производные изображений создаются в пуле процессов images.
+    """
 
     # получаем последнее спарсенное сообщение
     last_post = database_connect.get_last_post(service_table, channel_id)
@@ -197,11 +337,21 @@ def physics_lib(database_connect: DB, telegram_connect: TelegramConnect,
         'friendly_channels', column='channel_id')
     friendly_chs = [elems[0] for elems in friendly_chs]
 
+    # индекс обработанных сообщений, записи в буфере writer добавляются в
+    # индекс сразу, до записи в БД
+    processed = ProcessedIndex(database_connect, service_table)
+    processed.load(channel_id)
+
+    # индекс загруженных документов для исключения повторных загрузок
+    documents = DocumentIndex(database_connect, table)
+    documents.load()
+
     # получаем все сообщения после последнего спарсенного сообщения
-    messages = telegram_connect.client.iter_messages(channel_id,
-                                                     min_id=last_post,
-                                                     reverse=True)
+    messages = telegram_connect.get_messages(channel_id, min_id=last_post)
     for message in messages:
+        # все строки сообщения (включая сообщения по ссылкам) попадают в
+        # буфер writer только вместе, после полной обработки сообщения
+        writer.begin()
         # создаем словари с полями соответсвующими полям БД.
         record = {
             "name": None,
@@ -226,7 +376,8 @@ def physics_lib(database_connect: DB, telegram_connect: TelegramConnect,
             "date_site": None,
             "category": None,
             "yadisk": None,
-            "type_file": None
+            "type_file": None,
+            "file_hash": None
         }
 
         service_info = {
@@ -241,8 +392,8 @@ def physics_lib(database_connect: DB, telegram_connect: TelegramConnect,
         # в останых случаях False
 
         # проверяем сообщение на репост и на наличие записи в БД.
-        if check_repost(message) and not database_connect.check_record(
-                channel_id, message.id, service_table):
+        if check_repost(message) and \
+                (channel_id, message.id) not in processed:
 
             # проверяем наличие документа в сообщении
             if check_document(message):
@@ -254,7 +405,8 @@ def physics_lib(database_connect: DB, telegram_connect: TelegramConnect,
 
                     record['file_name'], service_info["corresponds_params"] \
                         = downloader_physics_lib(message, telegram_connect,
-                                                 path_download)
+                                                 path_download, documents,
+                                                 record)
                     record['type_file'] = type_file(record['file_name'])
 
                 # заполняем необходимые ключи в словаре и записываем в БД,
@@ -267,7 +419,8 @@ def physics_lib(database_connect: DB, telegram_connect: TelegramConnect,
                     channel_id,
                     record,
                     table,
-                    t_me_link
+                    t_me_link,
+                    writer
                 )
 
             elif check_photo(message):
@@ -287,19 +440,18 @@ def physics_lib(database_connect: DB, telegram_connect: TelegramConnect,
                     record['photo'], record['photo_link'] \
                         = telegram_connect.download_photo(message, path_photo)
 
-                    # создаем thumbnail
-                    path_photoname = path_photo + record['photo_link']
-                    record["photo_thumbnail"] = image_thumbnail(
-                        path_photoname)
-                    record["photo_resize"] = image_resize_height(
-                        path_photoname)
+                    # создаем thumbnail и уменьшенную копию в фоне,
+                    # имена файлов известны сразу
+                    derivatives = images.submit(
+                        path_photo + record['photo_link'])
+                    record["photo_thumbnail"] = derivatives['thumbnail']
+                    record["photo_resize"] = derivatives['resize']
 
                     for f_message in f_messages:
                         f_channel_id = f_message.peer_id.channel_id
-                        # проверяем запись в БД
-                        if not database_connect.check_record(f_channel_id,
-                                                             f_message.id,
-                                                             service_table):
+                        # проверяем запись в индексе
+                        if (f_channel_id, f_message.id) not in processed:
+                            processed.add(f_channel_id, f_message.id)
 
                             # проверяем наличие документа в сообщении
                             if check_document(f_message):
@@ -314,7 +466,9 @@ def physics_lib(database_connect: DB, telegram_connect: TelegramConnect,
                                         = downloader_physics_lib(
                                         f_message,
                                         telegram_connect,
-                                        path_download)
+                                        path_download,
+                                        documents,
+                                        record)
 
                                     record['type_file'] = type_file(
                                         record['file_name'])
@@ -328,14 +482,19 @@ def physics_lib(database_connect: DB, telegram_connect: TelegramConnect,
                                                            telegram_connect,
                                                            f_channel_id,
                                                            record, table,
-                                                           t_me_link)
+                                                           t_me_link, writer)
                             # записать в базу со парсенными сообщениями
                             # сообщением
                             write_service_info_db_physics_lib(f_message,
                                                               database_connect,
                                                               f_channel_id,
                                                               service_info,
-                                                              service_table)
+                                                              service_table,
+                                                              writer)
         write_service_info_db_physics_lib(message, database_connect,
                                           channel_id, service_info,
-                                          service_table)
+                                          service_table, writer)
+        processed.add(channel_id, message.id)
+        # сообщение обработано полностью - можно записать буфер в БД
+        writer.end()
+        writer.maybe_flush()
@@ -0,0 +1,776 @@
+"""
+Асинхронный шаблон парсинга телеграм канала physics_lib.
+
+Логика отбора и фильтрации сообщений совпадает с physics_lib.physics_lib,
+но сетевые операции (загрузка файлов, фото и сообщений по ссылкам)
+выполняются для нескольких сообщений одновременно. Запись в БД производится
+строго в порядке следования сообщений в канале.
+
+PhysicsLibParser.pipeline() выполняет тот же парсинг конвейером стадий
+(отбор, загрузка, изображения, SFTP, ЯндексДиск, БД), в котором каждое
+сообщение публикуется сразу после обработки.
+"""
+import asyncio
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+
+from TelegramParser.parser import check_repost, check_document, check_photo, \
+    get_text, get_links_from_message, type_file, get_year, group_links, \
+    local_file_name, release_file_name
+
+from DatabaseTools.connect import DB
+from DatabaseTools.index import ProcessedIndex, DocumentIndex
+from DatabaseTools.schemas import CONFLICT_KEY
+from TelegramParser.async_parser import AsyncTelegramConnect
+from TelegramParser.scheduler import ChannelScheduler, MemoryFailures, \
+    ServiceCheckpoints
+from TelegramParser.templates.physics_lib import checker_physics_lib, \
+    register_document_physics_lib
+from telethon.tl.patched import Message
+from YandexDiskKeeper.keeper import YaDiskUploader
+from Utils.images import ImagePipeline, derivative_names
+from Utils.plugins import SftpPusher
+from Utils.pipeline import Pipeline, Stage
+
+log = logging.getLogger(__name__)
+
+# Число обработчиков стадий конвейера по умолчанию
+PIPELINE_WORKERS = {
+    'select': 4,
+    'download': 4,
+    'image': 2,
+    'sftp': 4,
+    'yadisk': 4,
+}
+
+
+def new_record(t_me_link: str) -> dict:
+    """
+    Словарь с полями соответствующими полям основной таблицы БД.
+
+    :param t_me_link: шаблон адреса, 'https://t.me'
+    :return: словарь записи
+    """
+    return {
+        "name": None,
+        "author": None,
+        "description": None,
+        "tags": None,
+        "channel": None,
+        "channel_id": None,
+        "message_id": None,
+        "document_id": None,
+        "date": None,
+        "name_link": f'{t_me_link}/',
+        "file_name": None,
+        "file_size": None,
+        "photo": False,
+        "photo_link": None,
+        "photo_resize": None,
+        "photo_thumbnail": None,
+        "public_tg": False,
+        "date_tg": None,
+        "public_site": False,
+        "date_site": None,
+        "category": None,
+        "yadisk": None,
+        "type_file": None,
+        "file_hash": None
+    }
+
+
+class Job:
+    """
+    Исходное сообщение канала и результаты его обработки, передаваемые
+    между стадиями.
+
+    targets - сообщения для записи [(сообщение, channel_id, есть ли
+    документ)], photo - нужно ли загрузить фото сообщения, tail - нужна ли
+    отдельная запись статуса исходного сообщения, writes - операции записи
+    в БД (см. PhysicsLibParser.prepare()), error - (стадия, исключение),
+    если обработка завершилась ошибкой.
+    """
+
+    def __init__(self, message: Message, channel_id: int,
+                 record: dict) -> None:
+        self.message = message
+        self.channel_id = channel_id
+        self.record = record
+        self.targets = []
+        self.photo = False
+        self.tail = True
+        self.writes = []
+        self.error = None
+
+    def __repr__(self) -> str:
+        return f'<Job {self.channel_id} {self.message.id}>'
+
+
+class PhysicsLibParser:
+    """
+    Асинхронный парсер канала physics_lib.
+
+    Одновременно обрабатывается до in_flight сообщений. Для каждого
+    сообщения формируется список операций записи, которые выполняются
+    последовательно в отдельном потоке в порядке сообщений канала.
+
+    Один экземпляр может обрабатывать несколько каналов одновременно
+    (см. ChannelScheduler): между open() и close() буфер записи, пул
+    обработки изображений и индексы общие для всех вызовов process().
+    Несколько шаблонов, работающих с одним подключением к БД, должны
+    получать общий db_executor.
+    """
+
+    def __init__(self, database_connect: DB,
+                 telegram_connect: AsyncTelegramConnect,
+                 table: str, service_table: str,
+                 path_photo: str, path_download: str,
+                 limit_file_size: int, type_file_download: list,
+                 t_me_link: str, pattern: str, in_flight=8,
+                 batch_size=100, flush_interval=5.0, image_workers=None,
+                 db_executor=None):
+        self.db = database_connect
+        self.tg = telegram_connect
+        self.table = table
+        self.service_table = service_table
+        self.path_photo = path_photo
+        self.path_download = path_download
+        self.limit_file_size = limit_file_size
+        self.type_file_download = type_file_download
+        self.t_me_link = t_me_link
+        self.pattern = pattern
+        self.in_flight = in_flight
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.image_workers = image_workers
+
+        self.friendly_chs = set()
+        self.writer = None
+        self.images = None
+        # индекс обработанных и взятых в работу сообщений
+        self.processed = ProcessedIndex(database_connect, service_table)
+        # индекс загруженных документов
+        self.documents = DocumentIndex(database_connect, table)
+        # загрузки в процессе: {document_id: asyncio.Future}
+        self._downloads = {}
+        # каналы, контрольные точки которых не сдвигаются (см. store())
+        self._stalled = set()
+        # DB берет соединение из пула для каждого потока, но буфер записи
+        # (BulkWriter) и индексы сообщений не защищены блокировками, а
+        # порядок записи пачек важен для контрольных точек, поэтому
+        # обращения шаблона к БД идут через один поток
+        self._db_executor = db_executor or ThreadPoolExecutor(max_workers=1)
+
+    async def db_call(self, func, *args, **kwargs):
+        """
+        Выполнить метод БД в отдельном потоке, не блокируя цикл событий.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._db_executor,
+                                          partial(func, *args, **kwargs))
+
+    async def is_processed(self, channel_id: int, message_id: int) -> bool:
+        """
+        Проверяет было ли сообщение обработано ранее или взято в работу
+        в текущем запуске. Если нет - помечает сообщение взятым в работу.
+
+        :param channel_id: id канала
+        :param message_id: id сообщения
+        :return: True/False
+        """
+        if not self.processed.is_loaded(channel_id):
+            await self.db_call(self.processed.load, channel_id)
+        if (channel_id, message_id) in self.processed:
+            return True
+        self.processed.add(channel_id, message_id)
+        return False
+
+    async def filtering_links(self, message: Message) -> list:
+        """
+        Получает сообщения по ссылкам из тела сообщения и оставляет только
+        сообщения из дружественных каналов. Сообщения каждого канала
+        запрашиваются одним запросом, каналы не входящие в дружественные
+        отбрасываются до запроса.
+
+        :param message: сообщение
+        :return: список отфильтрованных сообщений
+        """
+        links = get_links_from_message(message, pattern=self.pattern)
+        grouped = group_links(links)
+        batches = await asyncio.gather(
+            *(self._resolve_channel_links(username, ids)
+              for username, ids in grouped.items()))
+        found = {}
+        for username, messages in zip(grouped, batches):
+            for message_link in messages:
+                found[(username, message_link.id)] = message_link
+        return [found.pop((link['username'], link['message_id']))
+                for link in links
+                if (link['username'], link['message_id']) in found]
+
+    async def _resolve_channel_links(self, username: str, ids: list) -> list:
+        try:
+            info = await self.tg.get_entity_info(username)
+        except Exception as exc:
+            log.warning(f'{exc} Канал {username} не найден.')
+            return []
+        if info['channel_id'] not in self.friendly_chs:
+            return []
+        return await self.tg.get_messages_by_ids(username, ids)
+
+    async def download(self, message: Message, record: dict) -> (str, bool):
+        """
+        Загрузка файла из сообщения. Документ, загруженный ранее, повторно
+        не загружается, файл-дубликат по хеш-сумме заменяется имеющимся.
+
+        :param message: сообщение
+        :param record: словарь данных для записи
+        :return: Tuple[название файла, статус загрузки]
+        """
+        known = self.documents.get_by_document(message.document.id)
+        if known:
+            log.debug(f'Документ {message.document.id} уже загружен: '
+                      f'{known["file_name"]}')
+            record['file_hash'] = known['file_hash']
+            record['yadisk'] = known['yadisk']
+            return known['file_name'], True
+
+        # тот же документ уже загружается для другого сообщения
+        document_id = message.document.id
+        if document_id in self._downloads:
+            file_name, corresponds_params, file_hash, yadisk = \
+                await asyncio.shield(self._downloads[document_id])
+            record['file_hash'] = file_hash
+            record['yadisk'] = yadisk
+            return file_name, corresponds_params
+
+        future = asyncio.get_running_loop().create_future()
+        self._downloads[document_id] = future
+        try:
+            result = await self._download(message, record)
+            future.set_result(result + (record.get('file_hash'),
+                                        record.get('yadisk')))
+            return result
+        except Exception as exc:
+            future.set_exception(exc)
+            raise
+        finally:
+            if not future.done():
+                future.cancel()
+            del self._downloads[document_id]
+
+    async def _download(self, message: Message, record: dict) -> tuple:
+        local_name = local_file_name(message, self.path_download)
+        try:
+            if await self.tg.download_file(message, self.path_download,
+                                           local_name):
+                loop = asyncio.get_running_loop()
+                file_name = await loop.run_in_executor(
+                    None, register_document_physics_lib, message,
+                    self.documents, self.path_download, local_name, record)
+                return file_name, True
+            return None, False
+        finally:
+            release_file_name(self.path_download, local_name)
+
+    async def fill_record(self, message: Message, channel_id: int,
+                          record: dict) -> bool:
+        """
+        Заполняет словарь записи данными из сообщения.
+
+        :param message: сообщение
+        :param channel_id: id канала
+        :param record: словарь данных для записи
+        :return: True/False
+        """
+        try:
+            channel = await self.tg.get_channel_name(channel_id)
+            username = await self.tg.get_channel_username(channel_id)
+
+            record['name'], record['description'] = get_text(message)
+            record["channel"] = channel
+            record["channel_id"] = channel_id
+            record['message_id'] = message.id
+            record['document_id'] = message.document.id
+            record['file_size'] = message.document.size
+            record["name_link"] = f'{self.t_me_link}/{username}/{message.id}'
+            record['date'] = datetime.now()
+            record['year'] = get_year(record['description'])
+            return True
+        except Exception as ex:
+            log.warning(f'{ex} Сообщение {message.id} подготовить не '
+                        f'удалось!')
+            return False
+
+    async def prepare_document(self, message: Message, channel_id: int,
+                               record: dict, service_info: dict) -> tuple:
+        """
+        Загружает документ из сообщения (если он удовлетворяет условиям) и
+        заполняет запись.
+
+        :return: операция записи (сообщение, channel_id, запись, статус)
+        """
+        if checker_physics_lib(message, self.type_file_download,
+                               self.limit_file_size):
+            record['file_name'], service_info["corresponds_params"] \
+                = await self.download(message, record)
+            record['type_file'] = type_file(record['file_name']) \
+                if record['file_name'] else None
+
+        filled = await self.fill_record(message, channel_id, record)
+        return (message, channel_id, record if filled else None,
+                dict(service_info))
+
+    async def prepare(self, message: Message, channel_id: int) -> list:
+        """
+        Сетевая часть обработки сообщения. Возвращает список операций
+        записи в БД в порядке их выполнения.
+
+        :param message: сообщение
+        :param channel_id: id канала
+        :return: list(Tuple[сообщение, channel_id, запись | None, статус])
+        """
+        job = await self.select(Job(message, channel_id,
+                                    new_record(self.t_me_link)))
+        await self.fetch(job)
+        if job.photo:
+            # производные изображения создаются в пуле процессов
+            self.images.submit(self.path_photo + job.record['photo_link'])
+        return job.writes
+
+    async def select(self, job: Job) -> Job:
+        """
+        Отбор сообщения: проверка репоста и повторной обработки, для
+        сообщения с фото - получение сообщений по ссылкам из дружественных
+        каналов.
+
+        :param job: задание исходного сообщения
+        :return: job с заполненными targets и photo
+        """
+        message, channel_id = job.message, job.channel_id
+        if check_repost(message) and not await self.is_processed(
+                channel_id, message.id):
+
+            if check_document(message):
+                job.targets.append((message, channel_id, True))
+                # статус исходного сообщения берется из операции записи
+                job.tail = False
+
+            elif check_photo(message):
+                f_messages = await self.filtering_links(message)
+                if len(f_messages):
+                    job.photo = True
+                    for f_message in f_messages:
+                        f_channel_id = f_message.peer_id.channel_id
+                        if not await self.is_processed(f_channel_id,
+                                                       f_message.id):
+                            job.targets.append((f_message, f_channel_id,
+                                                check_document(f_message)))
+        return job
+
+    async def fetch(self, job: Job) -> Job:
+        """
+        Загрузка фото и документов отобранного сообщения и формирование
+        операций записи в БД. Имена производных изображений заполняются
+        сразу, сами производные создаются отдельно.
+
+        :param job: задание после select()
+        :return: job с заполненными writes
+        """
+        record = job.record
+        service_info = {"corresponds_params": False, "complete": False}
+        if job.photo:
+            record['photo'], record['photo_link'] \
+                = await self.tg.download_photo(job.message, self.path_photo)
+            names = derivative_names(self.path_photo + record['photo_link'],
+                                     self.images.derivatives)
+            record["photo_thumbnail"] = names['thumbnail']
+            record["photo_resize"] = names['resize']
+
+        tasks = []
+        for message, channel_id, has_document in job.targets:
+            if has_document:
+                tasks.append(self.prepare_document(
+                    message, channel_id, dict(record), dict(service_info)))
+            else:
+                tasks.append(self._service_only(message, channel_id,
+                                                service_info))
+        job.writes = list(await asyncio.gather(*tasks))
+        if job.tail:
+            job.writes.append((job.message, job.channel_id, None, None))
+        return job
+
+    @staticmethod
+    async def _service_only(message: Message, channel_id: int,
+                            service_info: dict) -> tuple:
+        return message, channel_id, None, dict(service_info)
+
+    def write(self, writes: list) -> None:
+        """
+        Запись результатов обработки одного сообщения в буфер БД.
+        Выполняется в потоке БД. Статус последней операции переносится на
+        исходное сообщение, как и в синхронном шаблоне. Строки сообщения
+        добавляются в буфер одной единицей записи и записываются в БД в
+        одной транзакции.
+
+        :param writes: список операций записи из prepare()
+        """
+        self._add(writes)
+        self.writer.maybe_flush()
+
+    def _add(self, writes: list) -> None:
+        status = {"corresponds_params": False, "complete": False}
+        with self.writer.unit():
+            for message, channel_id, record, info in writes:
+                if info is not None:
+                    status = info
+                if record is not None:
+                    self.writer.add(self.table, record)
+                    status["complete"] = True
+                    log.debug(f'Сообщение {message.id} добавлено в базу '
+                              f'данных {self.table}!')
+                self.write_service_info(message, channel_id, status)
+
+    def write_service_info(self, message: Message, channel_id: int,
+                           status: dict) -> None:
+        """
+        Запись статуса по сообщению в буфер сервисной таблицы БД. Если
+        строки сообщения не будут записаны в БД, статус записывается с
+        complete=False (см. BulkWriter.add()).
+
+        :param message: сообщение
+        :param channel_id: id канала
+        :param status: словарь {"corresponds_params": bool, "complete": bool}
+        """
+        info = {
+            "channel_id": channel_id,
+            "message_id": message.id,
+            "corresponds_params": status["corresponds_params"],
+            "complete": status["complete"],
+            "date": datetime.now()
+        }
+        self.writer.add(self.service_table, info,
+                        on_failure=dict(info, complete=False))
+        log.debug(f'Запись {channel_id} {message.id} '
+                  f'добавлено в базу данных {self.service_table}!')
+
+    async def run(self, channel_id: int) -> None:
+        """
+        Парсинг всех новых сообщений канала с channel_id.
+
+        :param channel_id: id канала парсинга
+        """
+        last_post = await self.db_call(self.db.get_last_post,
+                                       self.service_table, channel_id)
+        await self.process(channel_id,
+                           self.tg.iter_messages(channel_id, min_id=last_post))
+
+    async def open(self) -> None:
+        """
+        Подготовка к обработке: загрузка дружественных каналов и индекса
+        документов, создание буфера записи и пула обработки изображений.
+        Повторный вызов ничего не делает.
+        """
+        if self.writer is not None:
+            return
+        friendly_chs = await self.db_call(
+            self.db.get_friendly_channels, 'friendly_channels',
+            column='channel_id')
+        self.friendly_chs = {elems[0] for elems in friendly_chs}
+        if not len(self.documents):
+            await self.db_call(self.documents.load)
+
+        # повторная запись сообщения (например, при пересекающихся
+        # запусках) пропускается по уникальному ключу (channel_id, message_id)
+        conflicts = await self.db_call(self.db.conflict_keys,
+                                       [self.table, self.service_table],
+                                       CONFLICT_KEY)
+        self.writer = self.db.bulk_writer(batch_size=self.batch_size,
+                                          flush_interval=self.flush_interval,
+                                          returning={self.table: 'id'},
+                                          conflicts=conflicts)
+        self.images = ImagePipeline(workers=self.image_workers)
+
+    async def close(self) -> None:
+        """
+        Запись остатка буфера в БД и остановка пула обработки изображений.
+        """
+        if self.writer is None:
+            return
+        try:
+            await self.db_call(self.writer.flush)
+        finally:
+            images, self.writer, self.images = self.images, None, None
+            await asyncio.get_running_loop().run_in_executor(
+                None, images.close)
+
+    async def process(self, channel_id: int, messages) -> None:
+        """
+        Обработка потока сообщений канала. Держит в работе до in_flight
+        сообщений и записывает результаты в порядке поступления. Перед
+        возвратом буфер записывается в БД.
+
+        Если open() не был вызван заранее, он вызывается здесь, а close() -
+        по окончании обработки.
+
+        :param channel_id: id канала
+        :param messages: асинхронный итератор сообщений
+        """
+        opened = self.writer is None
+        await self.open()
+        window = deque()
+        try:
+            async for message in messages:
+                window.append(asyncio.ensure_future(
+                    self.prepare(message, channel_id)))
+                if len(window) >= self.in_flight:
+                    await self.db_call(self.write, await window.popleft())
+            while window:
+                await self.db_call(self.write, await window.popleft())
+        finally:
+            for task in window:
+                task.cancel()
+            if opened:
+                await self.close()
+            else:
+                await self.db_call(self.writer.flush)
+
+    async def render(self, job: Job) -> Job:
+        """
+        Стадия конвейера: создание производных изображений сообщения в пуле
+        процессов с ожиданием их готовности.
+        """
+        if job.photo:
+            await asyncio.wrap_future(self.images.render(
+                self.path_photo + job.record['photo_link']))
+        return job
+
+    def push_photos(self, sftp: SftpPusher, job: Job) -> Job:
+        """
+        Стадия конвейера: загрузка производных изображений на удаленный
+        сервер. Ошибка загрузки не останавливает сообщение - файлы будут
+        загружены следующим вызовом Sftp.upload_files_parallel.
+        """
+        if job.photo:
+            try:
+                sftp.push([job.record['photo_resize'],
+                           job.record['photo_thumbnail']])
+            except Exception as exc:
+                log.warning(f'{exc} SFTP:: изображения сообщения '
+                            f'{job.message.id} не загружены')
+        return job
+
+    def upload_files(self, uploader: YaDiskUploader, job: Job) -> Job:
+        """
+        Стадия конвейера: загрузка файлов сообщения на ЯндексДиск, ссылка
+        записывается в запись до ее записи в БД. Файлы, которые загрузить
+        не удалось, остаются без ссылки и загружаются после парсинга (см.
+        DB.iter_null_yadisk).
+        """
+        for _, _, record, _ in job.writes:
+            if record is None or not record['file_name'] or \
+                    record['yadisk']:
+                continue
+            try:
+                record['yadisk'] = uploader.upload(record['file_name'])
+            except Exception as exc:
+                log.warning(f'{exc} YADISK:: файл {record["file_name"]} не '
+                            f'загружен')
+        return job
+
+    def store(self, checkpoints, jobs: list) -> list:
+        """
+        Стадия конвейера: запись пачки сообщений в БД и сдвиг контрольных
+        точек каналов в одной транзакции. Выполняется в потоке БД, пачки
+        приходят в порядке сообщений каналов.
+
+        Попытка обработки сообщения, которое не прошло одну из стадий,
+        учитывается в failures. Пока попыток меньше max_attempts,
+        контрольная точка канала не сдвигается до конца запуска, чтобы
+        следующий запуск начался с этого сообщения. После max_attempts
+        попыток сообщение записывается в сервисную таблицу с
+        complete=False, и контрольная точка идет дальше.
+        """
+        last = {}
+        with self.db.transaction():
+            for job in jobs:
+                if job.error is not None and not self._give_up(job):
+                    self._stalled.add(job.channel_id)
+                    continue
+                self._add(job.writes)
+                last[job.channel_id] = max(last.get(job.channel_id, 0),
+                                           job.message.id)
+            self.writer.flush()
+            for channel_id, message_id in last.items():
+                if channel_id not in self._stalled:
+                    checkpoints.set(channel_id, message_id)
+        return jobs
+
+    def _give_up(self, job: Job) -> bool:
+        stage, exc = job.error
+        attempts = self._failures.add(job.channel_id, job.message.id, stage,
+                                      f'{type(exc).__name__}: {exc}')
+        if attempts < self._max_attempts:
+            return False
+        log.error(f'Сообщение {job.message.id} канала {job.channel_id} не '
+                  f'обработано за {attempts} попыток (стадия {stage}), '
+                  f'записано с complete=False.')
+        job.writes = [(job.message, job.channel_id, None,
+                       {"corresponds_params": False, "complete": False})]
+        return True
+
+    def _stall(self, stage: str, job: Job, exc: Exception) -> None:
+        self._stalled.add(job.channel_id)
+
+    def _guard(self, stage: str, func):
+        """
+        Обертка стадии конвейера: ошибка записывается в job.error, и
+        задание без обработки проходит остальные стадии до store().
+        """
+        def failed(job: Job, exc: Exception) -> Job:
+            log.warning(f'{exc} Стадия {stage}: сообщение {job.message.id} '
+                        f'канала {job.channel_id} не обработано.')
+            job.error = (stage, exc)
+            return job
+
+        if asyncio.iscoroutinefunction(func):
+            async def guarded(job: Job) -> Job:
+                if job.error is not None:
+                    return job
+                try:
+                    return await func(job)
+                except Exception as exc:
+                    return failed(job, exc)
+        else:
+            def guarded(job: Job) -> Job:
+                if job.error is not None:
+                    return job
+                try:
+                    return func(job)
+                except Exception as exc:
+                    return failed(job, exc)
+        return guarded
+
+    async def pipeline(self, channels: list, checkpoints, sftp=None,
+                       uploader=None, workers=None, concurrency=4,
+                       quota=100, failures=None, max_attempts=3) -> dict:
+        """
+        Парсинг каналов конвейером стадий, связанных ограниченными
+        очередями: получение сообщений -> отбор -> загрузка -> изображения
+        -> SFTP -> ЯндексДиск -> БД. Каждая стадия обрабатывает несколько
+        сообщений одновременно (см. workers), поэтому работа с Telegram,
+        процессором, SFTP и ЯндексДиском идет параллельно, а сообщение
+        попадает в БД уже опубликованным.
+
+        Каналы чередуются через ChannelScheduler.stream(): за ход канал
+        дает не больше quota сообщений, одновременно читается не больше
+        concurrency каналов, поэтому последние каналы списка не ждут
+        окончания первых. Запись в БД выполняется пачками до batch_size
+        сообщений (не реже раза в flush_interval сек) в порядке
+        поступления сообщений.
+
+        Пример.
+        await parser.pipeline([1360755573], DBCheckpoints(db, ...),
+                              sftp=SftpPusher(...),
+                              uploader=YaDiskUploader(...))
+
+        :param channels: список id каналов
+        :param checkpoints: контрольные точки каналов (DBCheckpoints или
+        MemoryCheckpoints). Точки по сервисной таблице (ServiceCheckpoints)
+        не подходят: следующие сообщения канала сдвигают их за сообщение с
+        ошибкой, и оно не обрабатывается повторно (см. store())
+        :param sftp: SftpPusher или None - без загрузки изображений
+        :param uploader: YaDiskUploader или None - без загрузки файлов
+        :param workers: {стадия: число обработчиков} (см. PIPELINE_WORKERS)
+        :param concurrency: число одновременно читаемых каналов
+        :param quota: число сообщений канала за один ход
+        :param failures: учет неудачных попыток (например, DBFailures),
+        None - только попытки текущего запуска
+        :param max_attempts: число попыток обработки сообщения, после
+        которого оно записывается с complete=False (см. store())
+        :return: статистика стадий (см. Pipeline.report())
+        """
+        if checkpoints is None or isinstance(checkpoints, ServiceCheckpoints):
+            raise ValueError('для конвейера нужны контрольные точки '
+                             'DBCheckpoints или MemoryCheckpoints')
+        workers = dict(PIPELINE_WORKERS, **(workers or {}))
+        executors = []
+
+        def stage(name, func, **kwargs):
+            if name != 'db':
+                func = self._guard(name, func)
+            if not asyncio.iscoroutinefunction(func) and \
+                    'executor' not in kwargs:
+                executor = ThreadPoolExecutor(max_workers=workers[name])
+                executors.append(executor)
+                kwargs['executor'] = executor
+            return Stage(name, func, workers=workers.get(name, 1), **kwargs)
+
+        stages = [stage('select', self.select),
+                  stage('download', self.fetch),
+                  stage('image', self.render)]
+        if sftp is not None:
+            stages.append(stage('sftp', partial(self.push_photos, sftp)))
+        if uploader is not None:
+            stages.append(stage('yadisk',
+                                partial(self.upload_files, uploader)))
+        stages.append(stage('db', partial(self.store, checkpoints),
+                            ordered=True, batch_size=self.batch_size,
+                            batch_timeout=self.flush_interval,
+                            queue_size=self.batch_size,
+                            executor=self._db_executor))
+
+        scheduler = ChannelScheduler(self.tg, checkpoints,
+                                     concurrency=concurrency, quota=quota)
+        for channel_id in channels:
+            scheduler.add(channel_id, self)
+
+        async def source():
+            async for channel_id, message in scheduler.stream():
+                yield Job(message, channel_id, new_record(self.t_me_link))
+
+        self._stalled = set()
+        self._failures = failures or MemoryFailures()
+        self._max_attempts = max_attempts
+        pipeline = Pipeline(stages, on_error=self._stall)
+        await self.open()
+        try:
+            return await pipeline.run(source())
+        finally:
+            try:
+                await self.close()
+            finally:
+                for executor in executors:
+                    executor.shutdown()
+                log.info(pipeline.summary())
+
+
+async def physics_lib(database_connect: DB,
+                      telegram_connect: AsyncTelegramConnect,
+                      table: str, service_table: str,
+                      path_photo: str, path_download: str,
+                      limit_file_size: int, type_file_download: list,
+                      t_me_link: str, pattern: str,
+                      channel_id=1360755573, in_flight=8,
+                      batch_size=100, flush_interval=5.0, image_workers=None):
+    """
+    Асинхронная функция шаблон для парсинга сообщений телеграмм канала
+    с channel_id=1360755573. Параметры совпадают с physics_lib.physics_lib.
+
+    :param in_flight: число одновременно обрабатываемых сообщений
+    :param batch_size: число строк для пакетной записи в БД
+    :param flush_interval: максимальный интервал между записями в БД, сек
+    :param image_workers: число процессов обработки изображений
+    :return:
+    """
+    parser = PhysicsLibParser(database_connect, telegram_connect,
+                              table, service_table, path_photo,
+                              path_download, limit_file_size,
+                              type_file_download, t_me_link, pattern,
+                              in_flight=in_flight, batch_size=batch_size,
+                              flush_interval=flush_interval,
+                              image_workers=image_workers)
+    await parser.run(channel_id)
@@ -0,0 +1,186 @@
+"""
+Создание производных изображений (thumbnail, уменьшенная копия и т.д.)
+с однократным декодированием исходника и выполнением в пуле процессов.
+"""
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+
+from Utils.metrics import METRICS, OPERATION_ERRORS, OPERATION_SECONDS
+
+log = logging.getLogger(__name__)
+
+# Производные изображения: {суффикс: (вид, параметр)}.
+# Вид 'thumbnail' - вписать в прямоугольник (ширина, высота) с сохранением
+# пропорций, вид 'height' - уменьшить до заданной высоты с сохранением
+# пропорций. Имя файла производной: '{имя}_{суффикс}.{расширение}'.
+DERIVATIVES = {
+    'thumbnail': ('thumbnail', (300, 300)),
+    'resize': ('height', 400),
+}
+
+
+def derivative_path(path: str, suffix: str) -> str:
+    """
+    Путь к файлу производной изображения.
+
+    :param path: путь к исходнику (например, '../Media/Photo/1234.jpg')
+    :param suffix: суффикс производной (например, 'thumbnail')
+    :return: путь (например, '../Media/Photo/1234_thumbnail.jpg')
+    """
+    path_split = path.rsplit('.', maxsplit=1)
+    return path_split[0] + '_' + suffix + '.' + path_split[1]
+
+
+def derivative_names(path: str, derivatives=None) -> dict:
+    """
+    Имена файлов производных изображения. Не требует чтения исходника.
+
+    :param path: путь к исходнику (например, '../Media/Photo/1234.jpg')
+    :param derivatives: словарь производных (по умолчанию DERIVATIVES)
+    :return: {суффикс: имя файла} (например, {'thumbnail':
+    '1234_thumbnail.jpg', 'resize': '1234_resize.jpg'})
+    """
+    derivatives = DERIVATIVES if derivatives is None else derivatives
+    return {suffix: derivative_path(path, suffix).rsplit('/', maxsplit=1)[-1]
+            for suffix in derivatives}
+
+
+def target_size(kind: str, value, width: int, height: int) -> tuple:
+    """
+    Размер производной для исходника заданного размера.
+
+    :param kind: вид производной ('thumbnail' или 'height')
+    :param value: параметр производной ((300, 300) или 400)
+    :param width: ширина исходника
+    :param height: высота исходника
+    :return: Tuple[ширина, высота]
+    """
+    if kind == 'thumbnail':
+        scale = min(value[0] / width, value[1] / height, 1)
+        return max(round(width * scale), 1), max(round(height * scale), 1)
+    if kind == 'height':
+        return int(value * width / height), value
+    raise ValueError(f'неизвестный вид производной: {kind}')
+
+
+def make_derivatives(path: str, derivatives=None) -> dict:
+    """
+    Создает все производные изображения за одно декодирование исходника.
+    Для JPEG используется режим draft(): изображение уменьшается уже при
+    декодировании до наименьшего размера, достаточного для всех
+    производных. Производные сохраняются рядом с исходником.
+
+    :param path: путь к исходнику (например, '../Media/Photo/1234.jpg')
+    :param derivatives: словарь производных (по умолчанию DERIVATIVES)
+    :return: {суффикс: имя файла}
+    """
+    derivatives = DERIVATIVES if derivatives is None else derivatives
+    with Image.open(path) as img:
+        width, height = img.size
+        sizes = {suffix: target_size(kind, value, width, height)
+                 for suffix, (kind, value) in derivatives.items()}
+        img.draft(img.mode if img.mode in ('RGB', 'L') else 'RGB',
+                  (max(size[0] for size in sizes.values()),
+                   max(size[1] for size in sizes.values())))
+        img.load()
+        source = img if img.mode in ('RGB', 'L') else img.convert('RGB')
+        for suffix, size in sizes.items():
+            if size == source.size:
+                output = source
+            else:
+                output = source.resize(size, Image.LANCZOS)
+            output.save(derivative_path(path, suffix))
+    return derivative_names(path, derivatives)
+
+
+def _observer(started: float):
+    # время обработки в пуле процессов учитывается от постановки в очередь
+    def observe(future) -> None:
+        METRICS.observe(OPERATION_SECONDS, time.perf_counter() - started,
+                        operation='image_processing', method='derivatives')
+        if future.cancelled() or future.exception() is not None:
+            METRICS.inc(OPERATION_ERRORS, operation='image_processing',
+                        method='derivatives')
+    return observe
+
+
+class ImagePipeline:
+    """
+    Создание производных изображений в пуле процессов, чтобы обработка
+    изображений не блокировала работу с сетью.
+
+    Имена производных известны сразу, поэтому submit() не ждет окончания
+    обработки. Ошибки обработки выводятся в wait() и close().
+
+    Пример.
+    with ImagePipeline(workers=2) as images:
+        names = images.submit('../Media/Photo/1234.jpg')
+        names['thumbnail'] -> '1234_thumbnail.jpg'
+    """
+
+    def __init__(self, workers=None, derivatives=None) -> None:
+        self.derivatives = DERIVATIVES if derivatives is None \
+            else derivatives
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self._futures = {}
+
+    def __enter__(self) -> 'ImagePipeline':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def submit(self, path: str) -> dict:
+        """
+        Поставить изображение в очередь обработки.
+
+        :param path: путь к исходнику (например, '../Media/Photo/1234.jpg')
+        :return: {суффикс: имя файла}
+        """
+        self._futures[path] = self.render(path)
+        self._collect(block=False)
+        return derivative_names(path, self.derivatives)
+
+    def render(self, path: str):
+        """
+        Поставить изображение в очередь обработки и получить Future,
+        которая завершается после создания файлов производных (например,
+        перед их загрузкой на сервер).
+
+        :param path: путь к исходнику (например, '../Media/Photo/1234.jpg')
+        :return: concurrent.futures.Future с {суффикс: имя файла}
+        """
+        future = self.executor.submit(make_derivatives, path,
+                                      self.derivatives)
+        future.add_done_callback(_observer(time.perf_counter()))
+        return future
+
+    def wait(self) -> int:
+        """
+        Дождаться обработки всех изображений в очереди.
+
+        :return: число изображений с ошибками обработки
+        """
+        return self._collect(block=True)
+
+    def close(self) -> None:
+        """
+        Дождаться обработки изображений и остановить пул процессов.
+        """
+        self.wait()
+        self.executor.shutdown()
+
+    def _collect(self, block: bool) -> int:
+        errors = 0
+        for path, future in list(self._futures.items()):
+            if not block and not future.done():
+                continue
+            del self._futures[path]
+            exc = future.exception()
+            if exc is not None:
+                errors += 1
+                log.warning(f'{exc} Не удалось обработать изображение '
+                            f'{path}')
+        return errors
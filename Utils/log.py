@@ -0,0 +1,177 @@
+"""
+Журналирование без блокировки рабочих потоков: записи передаются через
+очередь фоновому потоку, который пишет их в файл в виде JSON-строк и
+в терминал.
+"""
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+# Атрибуты LogRecord, которые не считаются дополнительными полями записи
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None)))
+_RECORD_ATTRS.update(('message', 'asctime'))
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Запись журнала в виде JSON-строки: время, уровень, логгер, сообщение,
+    дополнительные поля из extra и текст исключения.
+
+    Пример.
+    log.info('Файл загружен', extra={'file': 'a.pdf', 'size': 1024})
+    -> {"time": "...", "level": "INFO", "logger": "...",
+        "message": "Файл загружен", "file": "a.pdf", "size": 1024}
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc)
+            .isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                data[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exc'] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    # в очередь передается сообщение без текста исключения, чтобы
+    # JsonFormatter записал исключение отдельным полем
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging(path=None, level=logging.INFO, console_level=logging.INFO):
+    """
+    Настроить корневой логгер: записи помещаются в очередь
+    (QueueHandler), фоновый поток (QueueListener) пишет их в файл path
+    JSON-строками и в терминал в текстовом виде. Рабочие потоки и цикл
+    событий не ждут ввода-вывода.
+
+    Пример.
+    listener = setup_logging('../Media/parser.log.jsonl')
+    ...
+    listener.stop()
+
+    :param path: путь к файлу журнала или None - только терминал (папка
+    создается, если ее нет)
+    :param level: минимальный уровень записей
+    :param console_level: минимальный уровень записей в терминале
+    :return: запущенный QueueListener, остановить - listener.stop()
+    """
+    handlers = []
+    console = logging.StreamHandler(sys.stdout)
+    console.setLevel(console_level)
+    console.setFormatter(logging.Formatter('%(asctime)s %(levelname)s '
+                                           '%(name)s: %(message)s'))
+    handlers.append(console)
+    if path is not None:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        file = logging.FileHandler(path, encoding='utf-8')
+        file.setFormatter(JsonFormatter())
+        handlers.append(file)
+
+    records = queue.Queue(-1)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, logging.handlers.QueueHandler):
+            root.removeHandler(handler)
+    root.addHandler(_QueueHandler(records))
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(
+        records, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+class Progress:
+    """
+    Сводный индикатор выполнения вместо индикатора на каждую операцию:
+    update() только увеличивает счетчики, а запись в журнал делается не
+    чаще раза в interval секунд. Можно вызывать из нескольких потоков.
+
+    Пример.
+    progress = Progress('YADISK:: загрузка', total=120, unit='files')
+    progress.update(1)
+    progress.close()
+    -> YADISK:: загрузка: 120/120 files, 3.1 files/с, 38.7 с
+    """
+
+    def __init__(self, name: str, total=None, unit='', interval=5.0,
+                 logger=None, initial=0) -> None:
+        self.name = name
+        self.total = total
+        self.unit = unit
+        self.interval = interval
+        self.log = logger or logging.getLogger(__name__)
+        self.done = initial
+        self._initial = initial
+        self._lock = threading.Lock()
+        self._started = self._reported = time.monotonic()
+
+    def __enter__(self) -> 'Progress':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def update(self, n=1) -> None:
+        """
+        Учесть n выполненных единиц (файлов, байт и т.д.).
+        """
+        with self._lock:
+            self.done += n
+            now = time.monotonic()
+            if now - self._reported < self.interval:
+                return
+            self._reported = now
+        self._report(now)
+
+    def close(self) -> None:
+        """
+        Записать итог.
+        """
+        self._report(time.monotonic())
+
+    def _report(self, now: float) -> None:
+        elapsed = now - self._started
+        rate = (self.done - self._initial) / elapsed if elapsed else 0.0
+        done = _format(self.done, self.unit)
+        if self.total is not None:
+            done += '/' + _format(self.total, self.unit)
+        self.log.info(f'{self.name}: {done} {self.unit}, '
+                      f'{_format(rate, self.unit)} {self.unit}/с, '
+                      f'{elapsed:.1f} с',
+                      extra={'progress': self.name, 'done': self.done,
+                             'total': self.total, 'rate': rate})
+
+
+def _format(value: float, unit: str) -> str:
+    if unit == 'B':
+        for prefix in ('', 'K', 'M', 'G'):
+            if abs(value) < 1024 or prefix == 'G':
+                return f'{value:.1f}{prefix}'
+            value /= 1024
+    return f'{value:.1f}' if isinstance(value, float) else str(value)
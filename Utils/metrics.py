@@ -0,0 +1,332 @@
+"""
+Счетчики и гистограммы длительности операций с выгрузкой в текстовом
+формате Prometheus или в JSON.
+"""
+import asyncio
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+# Границы корзин гистограмм длительности, сек
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0, 300.0)
+
+# Имена метрик
+OPERATION_SECONDS = 'operation_seconds'
+OPERATION_ERRORS = 'operation_errors_total'
+DOWNLOAD_BYTES = 'download_bytes_total'
+
+
+class Histogram:
+    """
+    Гистограмма с фиксированными границами корзин (как в Prometheus).
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS) -> None:
+        self.buckets = tuple(buckets)
+        # последняя корзина - значения больше всех границ (+Inf)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """
+        Оценка квантиля по корзинам (верхняя граница корзины).
+
+        :param q: квантиль (например, 0.95)
+        :return: значение, для корзины +Inf - последняя граница
+        """
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return self.buckets[-1]
+
+
+class Metrics:
+    """
+    Набор метрик: счетчики и гистограммы с метками. Безопасен для
+    использования из нескольких потоков.
+
+    Длительности операций собираются в гистограмму OPERATION_SECONDS с
+    метками operation (класс операции, например 'db_query') и method,
+    ошибки - в счетчик OPERATION_ERRORS.
+
+    Пример.
+    @METRICS.timed('db_query')
+    def get_last_post(self, table, channel_id): ...
+
+    with METRICS.timer('sftp_put'):
+        sftp.put(path, file)
+
+    METRICS.export('../Media/metrics.prom')
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS) -> None:
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # {(имя, метки): значение}
+        self._counters = {}
+        # {(имя, метки): Histogram}
+        self._histograms = {}
+
+    def inc(self, name: str, value=1, **labels) -> None:
+        """
+        Увеличить счетчик.
+
+        :param name: имя счетчика (например, 'download_bytes_total')
+        :param value: приращение
+        :param labels: метки (например, operation='download')
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """
+        Добавить значение в гистограмму.
+
+        :param name: имя гистограммы (например, 'operation_seconds')
+        :param value: значение
+        :param labels: метки
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, operation: str, **labels):
+        """
+        Замер длительности блока как операции operation. Ошибка в блоке
+        учитывается в OPERATION_ERRORS.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.inc(OPERATION_ERRORS, operation=operation, **labels)
+            raise
+        finally:
+            self.observe(OPERATION_SECONDS, time.perf_counter() - started,
+                         operation=operation, **labels)
+
+    def timed(self, operation: str, **labels):
+        """
+        Декоратор замера длительности функции или корутины. Метка method
+        по умолчанию - имя функции.
+
+        :param operation: класс операции (например, 'db_query')
+        :param labels: дополнительные метки
+        """
+        def decorator(func):
+            method_labels = dict({'method': func.__name__}, **labels)
+            if asyncio.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def wrapper(*args, **kwargs):
+                    with self.timer(operation, **method_labels):
+                        return await func(*args, **kwargs)
+            else:
+                @functools.wraps(func)
+                def wrapper(*args, **kwargs):
+                    with self.timer(operation, **method_labels):
+                        return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def snapshot(self) -> dict:
+        """
+        :return: {'counters': [{'name', 'labels', 'value'}, ...],
+        'histograms': [{'name', 'labels', 'buckets', 'counts', 'sum',
+        'count'}, ...]}
+        """
+        with self._lock:
+            counters = [{'name': name, 'labels': dict(labels),
+                         'value': value}
+                        for (name, labels), value in
+                        sorted(self._counters.items())]
+            histograms = [{'name': name, 'labels': dict(labels),
+                           'buckets': list(histogram.buckets),
+                           'counts': list(histogram.counts),
+                           'sum': histogram.sum, 'count': histogram.count}
+                          for (name, labels), histogram in
+                          sorted(self._histograms.items())]
+        return {'counters': counters, 'histograms': histograms}
+
+    def to_json(self) -> str:
+        """
+        :return: снимок метрик в JSON (см. snapshot())
+        """
+        return json.dumps(dict(self.snapshot(), time=time.time()),
+                          ensure_ascii=False)
+
+    def to_prometheus(self) -> str:
+        """
+        :return: метрики в текстовом формате Prometheus
+        """
+        snapshot = self.snapshot()
+        lines = []
+        declared = set()
+        for counter in snapshot['counters']:
+            if counter['name'] not in declared:
+                declared.add(counter['name'])
+                lines.append(f'# TYPE {counter["name"]} counter')
+            lines.append(f'{counter["name"]}{_labels(counter["labels"])} '
+                         f'{counter["value"]}')
+        for histogram in snapshot['histograms']:
+            name, labels = histogram['name'], histogram['labels']
+            if name not in declared:
+                declared.add(name)
+                lines.append(f'# TYPE {name} histogram')
+            total = 0
+            for bound, count in zip(histogram['buckets'] + ['+Inf'],
+                                    histogram['counts']):
+                total += count
+                lines.append(f'{name}_bucket'
+                             f'{_labels(dict(labels, le=bound))} {total}')
+            lines.append(f'{name}_sum{_labels(labels)} {histogram["sum"]}')
+            lines.append(f'{name}_count{_labels(labels)} '
+                         f'{histogram["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path: str) -> None:
+        """
+        Записать метрики в файл (через временный файл): JSON для путей с
+        расширением '.json', иначе текстовый формат Prometheus (например,
+        для node_exporter textfile collector).
+
+        :param path: путь к файлу (например, '../Media/metrics.prom')
+        """
+        text = self.to_json() if path.endswith('.json') \
+            else self.to_prometheus()
+        path_tmp = path + '.tmp'
+        with open(path_tmp, 'w', encoding='utf-8') as file:
+            file.write(text)
+        os.replace(path_tmp, path)
+
+    def summary(self) -> str:
+        """
+        :return: текстовый отчет по операциям: число, ошибки, суммарное и
+        среднее время, оценка 95-го процентиля, скорость загрузки
+        """
+        with self._lock:
+            operations = {}
+            for (name, labels), histogram in self._histograms.items():
+                if name != OPERATION_SECONDS:
+                    continue
+                operation = dict(labels).get('operation')
+                merged = operations.setdefault(operation,
+                                               Histogram(self.buckets))
+                merged.counts = [a + b for a, b in zip(merged.counts,
+                                                       histogram.counts)]
+                merged.sum += histogram.sum
+                merged.count += histogram.count
+            errors = {}
+            downloaded = 0
+            for (name, labels), value in self._counters.items():
+                if name == OPERATION_ERRORS:
+                    operation = dict(labels).get('operation')
+                    errors[operation] = errors.get(operation, 0) + value
+                elif name == DOWNLOAD_BYTES:
+                    downloaded += value
+
+        lines = []
+        for operation, histogram in sorted(operations.items()):
+            lines.append(
+                f'{operation}: {histogram.count} операций, ошибок '
+                f'{errors.get(operation, 0)}, всего {histogram.sum:.1f} с, '
+                f'в среднем {histogram.sum / histogram.count * 1000:.1f} мс, '
+                f'95% до {histogram.quantile(0.95)} с')
+        download = operations.get('telegram_download')
+        if downloaded and download is not None and download.sum:
+            lines.append(f'загружено {downloaded / 1048576:.1f} МБ, '
+                         f'{downloaded / 1048576 / download.sum:.2f} МБ/с '
+                         f'на запрос')
+        return '\n'.join(lines)
+
+    def clear(self) -> None:
+        """
+        Сбросить все метрики.
+        """
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+
+class MetricsExporter:
+    """
+    Периодическая выгрузка метрик в файл из фонового потока и
+    окончательная выгрузка при остановке.
+
+    Пример.
+    with MetricsExporter(METRICS, '../Media/metrics.prom', interval=60):
+        main()
+    """
+
+    def __init__(self, metrics: Metrics, path: str, interval=60.0) -> None:
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self) -> 'MetricsExporter':
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='metrics-exporter')
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Остановить поток и выгрузить метрики.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.metrics.export(self.path)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.metrics.export(self.path)
+            except OSError as exc:
+                log.warning(f'{exc} Метрики не выгружены в {self.path}')
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    escaped = (f'{key}="{_escape(value)}"' for key, value in labels.items())
+    return '{' + ','.join(escaped) + '}'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+# Общий набор метрик процесса
+METRICS = Metrics()
@@ -0,0 +1,283 @@
+"""
+Конвейер обработки: стадии, связанные ограниченными очередями.
+"""
+import asyncio
+import heapq
+import logging
+import time
+from functools import partial
+
+log = logging.getLogger(__name__)
+
+# Состояния элемента в очереди между стадиями
+_OK = 'ok'
+_DROPPED = 'dropped'
+_FAILED = 'failed'
+# Признак конца потока элементов
+_END = None
+
+
+class Stage:
+    """
+    Стадия конвейера.
+
+    func - асинхронная или обычная функция одного аргумента (элемента),
+    обычная выполняется в executor (None - пул потоков по умолчанию).
+    Возвращаемое значение передается следующей стадии, None - элемент
+    отбрасывается. Ошибка в func отбрасывает только этот элемент.
+
+    Параметры:
+    workers - число одновременно обрабатываемых элементов;
+    queue_size - размер входной очереди (по умолчанию workers * 2), при
+    заполнении очереди предыдущая стадия ждет (обратное давление);
+    ordered - передавать элементы в func в порядке поступления в конвейер
+    (для сохранения порядка результатов нужен workers=1);
+    batch_size - передавать в func списки до batch_size элементов, func
+    возвращает список результатов той же длины;
+    batch_timeout - сколько ждать заполнения пачки, сек (None - не ждать,
+    пачка собирается из уже готовых элементов).
+
+    Пример.
+    Stage('download', download, workers=4)
+    Stage('db', store, batch_size=100, batch_timeout=5.0, ordered=True,
+          executor=db_executor)
+    """
+
+    def __init__(self, name: str, func, workers=1, queue_size=None,
+                 ordered=False, batch_size=None, batch_timeout=None,
+                 executor=None) -> None:
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue_size = queue_size or workers * 2
+        self.ordered = ordered
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.executor = executor
+        self.stats = {'in': 0, 'out': 0, 'dropped': 0, 'failed': 0,
+                      'busy': 0.0, 'blocked': 0.0}
+
+    async def call(self, arg):
+        """
+        Вызов func с учетом ее вида.
+        """
+        if asyncio.iscoroutinefunction(self.func):
+            return await self.func(arg)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor,
+                                          partial(self.func, arg))
+
+
+class Pipeline:
+    """
+    Конвейер из стадий Stage, связанных ограниченными очередями. Каждый
+    элемент переходит к следующей стадии, как только предыдущая его
+    обработала, поэтому стадии (сеть, процессор, диск, удаленные
+    хранилища) работают одновременно над разными элементами.
+
+    Порядковый номер элемента сохраняется на всех стадиях, отброшенные и
+    завершившиеся ошибкой элементы проходят дальше как пропуски, поэтому
+    упорядоченные стадии не ждут их бесконечно. on_error(имя стадии,
+    элемент, исключение) вызывается до того, как пропуск попадет в
+    следующую стадию.
+
+    Пример.
+    pipeline = Pipeline([Stage('download', download, workers=4),
+                         Stage('upload', upload, workers=2)])
+    await pipeline.run(files) -> {'download': {'in': 10, ...}, ...}
+    log.info(pipeline.summary())
+    """
+
+    def __init__(self, stages: list, on_error=None) -> None:
+        if not stages:
+            raise ValueError('конвейер без стадий')
+        self.stages = stages
+        self.on_error = on_error
+        self.completed = 0
+
+    async def run(self, source) -> dict:
+        """
+        Пропустить все элементы source через конвейер.
+
+        :param source: итерируемый или асинхронно итерируемый объект
+        :return: статистика стадий (см. report())
+        """
+        queues = [asyncio.Queue(maxsize=stage.queue_size)
+                  for stage in self.stages]
+        feeder = asyncio.ensure_future(self._feed(source, queues[0]))
+        tasks = [feeder]
+        for index, stage in enumerate(self.stages):
+            output = queues[index + 1] if index + 1 < len(queues) else None
+            tasks.append(asyncio.ensure_future(
+                self._run_stage(stage, queues[index], output)))
+        try:
+            # при ошибке источника уже полученные элементы дообрабатываются,
+            # после чего ошибка передается вызывающему
+            await asyncio.gather(*tasks[1:])
+            await feeder
+        finally:
+            for task in tasks:
+                task.cancel()
+        return self.report()
+
+    @staticmethod
+    async def _feed(source, queue: asyncio.Queue) -> None:
+        seq = 0
+        try:
+            if hasattr(source, '__aiter__'):
+                async for item in source:
+                    await queue.put((seq, _OK, item))
+                    seq += 1
+            else:
+                for item in source:
+                    await queue.put((seq, _OK, item))
+                    seq += 1
+        finally:
+            await queue.put(_END)
+
+    async def _run_stage(self, stage: Stage, queue: asyncio.Queue,
+                         output) -> None:
+        if stage.ordered:
+            ordered = asyncio.Queue(maxsize=stage.queue_size)
+            reorder = asyncio.ensure_future(self._reorder(queue, ordered))
+            queue = ordered
+        try:
+            await asyncio.gather(*(self._worker(stage, queue, output)
+                                   for _ in range(stage.workers)))
+        finally:
+            if stage.ordered:
+                reorder.cancel()
+        if output is not None:
+            await output.put(_END)
+
+    @staticmethod
+    async def _reorder(queue: asyncio.Queue, ordered: asyncio.Queue) -> None:
+        # буфер держит только элементы, обогнавшие ожидаемый номер
+        pending = []
+        expected = 0
+        while True:
+            envelope = await queue.get()
+            if envelope is _END:
+                for envelope in sorted(pending):
+                    await ordered.put(envelope)
+                await ordered.put(_END)
+                return
+            heapq.heappush(pending, envelope)
+            while pending and pending[0][0] == expected:
+                await ordered.put(heapq.heappop(pending))
+                expected += 1
+
+    async def _worker(self, stage: Stage, queue: asyncio.Queue,
+                      output) -> None:
+        while True:
+            envelopes = await self._take(stage, queue)
+            if not envelopes:
+                return
+            items = [item for _, state, item in envelopes if state == _OK]
+            stage.stats['in'] += len(items)
+            results = iter(await self._process(stage, items))
+
+            for envelope in envelopes:
+                seq, state, item = envelope
+                if state == _OK:
+                    result = next(results)
+                    if isinstance(result, _Failure):
+                        stage.stats['failed'] += 1
+                        envelope = (seq, _FAILED, None)
+                    elif result is None:
+                        stage.stats['dropped'] += 1
+                        envelope = (seq, _DROPPED, None)
+                    else:
+                        stage.stats['out'] += 1
+                        envelope = (seq, _OK, result)
+                if output is None:
+                    self.completed += envelope[1] == _OK
+                    continue
+                started = time.monotonic()
+                await output.put(envelope)
+                stage.stats['blocked'] += time.monotonic() - started
+
+    @staticmethod
+    async def _take(stage: Stage, queue: asyncio.Queue) -> list:
+        envelope = await queue.get()
+        if envelope is _END:
+            # конец потока видят все обработчики стадии
+            queue.put_nowait(_END)
+            return []
+        envelopes = [envelope]
+        if not stage.batch_size:
+            return envelopes
+
+        deadline = None if stage.batch_timeout is None \
+            else time.monotonic() + stage.batch_timeout
+        while len(envelopes) < stage.batch_size:
+            if not queue.empty():
+                envelope = queue.get_nowait()
+            elif deadline is None or time.monotonic() >= deadline:
+                break
+            else:
+                try:
+                    envelope = await asyncio.wait_for(
+                        queue.get(), deadline - time.monotonic())
+                except asyncio.TimeoutError:
+                    break
+            if envelope is _END:
+                queue.put_nowait(_END)
+                break
+            envelopes.append(envelope)
+        return envelopes
+
+    async def _process(self, stage: Stage, items: list) -> list:
+        if not items:
+            return []
+        started = time.monotonic()
+        try:
+            if stage.batch_size:
+                try:
+                    results = await stage.call(items)
+                    if len(results) != len(items):
+                        raise ValueError(f'стадия вернула {len(results)} '
+                                         f'результатов на {len(items)} '
+                                         f'элементов')
+                    return results
+                except Exception as exc:
+                    return [self._fail(stage, item, exc) for item in items]
+            try:
+                return [await stage.call(items[0])]
+            except Exception as exc:
+                return [self._fail(stage, items[0], exc)]
+        finally:
+            stage.stats['busy'] += time.monotonic() - started
+
+    def _fail(self, stage: Stage, item, exc: Exception) -> '_Failure':
+        log.warning(f'{exc} Стадия {stage.name}: элемент {item} пропущен.')
+        if self.on_error is not None:
+            self.on_error(stage.name, item, exc)
+        return _Failure()
+
+    def report(self) -> dict:
+        """
+        :return: {стадия: {'in', 'out', 'dropped', 'failed', 'busy',
+        'blocked'}}, где busy - время обработки, blocked - время ожидания
+        места в очереди следующей стадии, сек
+        """
+        return {stage.name: dict(stage.stats) for stage in self.stages}
+
+    def summary(self) -> str:
+        """
+        :return: текстовый отчет по стадиям
+        """
+        lines = []
+        for name, stats in self.report().items():
+            lines.append(f'{name}: принято {stats["in"]}, передано '
+                         f'{stats["out"]}, отброшено {stats["dropped"]}, '
+                         f'ошибок {stats["failed"]}, обработка '
+                         f'{stats["busy"]:.1f} с, ожидание очереди '
+                         f'{stats["blocked"]:.1f} с')
+        return '\n'.join(lines)
+
+
+class _Failure:
+    """
+    Результат обработки элемента, завершившейся ошибкой.
+    """
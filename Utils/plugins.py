@@ -1,21 +1,46 @@
 from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
 import hashlib
+import json
+import logging
 import os
+import queue
 import re
+import threading
 import pysftp
-from tqdm import tqdm
+
+from Utils.log import Progress
+from Utils.metrics import METRICS
+
+log = logging.getLogger(__name__)
 
 
 class Sftp:
     """
     Класс для работы с удаленным сервером по протоколу sftp.
 
+    Параметр cnopts (pysftp.CnOpts) позволяет задать проверку ключа хоста,
+    например для подключения к локальному тестовому серверу.
     """
-    def __init__(self, username: str, password: str, host: str, port: int):
+    def __init__(self, username: str, password: str, host: str, port: int,
+                 cnopts=None):
         self.user = username
         self.pswd = password
         self.host = host
         self.port = port
+        self.cnopts = cnopts
+
+    def connect(self) -> pysftp.Connection:
+        """
+        Открывает новое подключение к удаленному серверу.
+
+        :return: pysftp.Connection
+        """
+        return pysftp.Connection(username=self.user,
+                                 password=self.pswd,
+                                 host=self.host,
+                                 port=self.port,
+                                 cnopts=self.cnopts)
 
     @staticmethod
     def get_local_list(path_files: str, find_pattern='') -> set:
@@ -53,10 +78,7 @@ class Sftp:
         """
 
         # подключаемся к удаленному серверу
-        with pysftp.Connection(username=self.user,
-                               password=self.pswd,
-                               host=self.host,
-                               port=self.port) as sftp:
+        with self.connect() as sftp:
 
             # меняем директорию на заданную
             with sftp.cd(path_remote_dir):
@@ -70,14 +92,238 @@ class Sftp:
                 # которые уже имеются на удаленной
                 transfer_list = local_list - remote_list
 
-                # бар загрузки
-                pbar = tqdm(transfer_list, unit='files', colour='green')
+                # сводный индикатор загрузки
+                progress = Progress('SFTP:: загрузка',
+                                    total=len(transfer_list), unit='files',
+                                    logger=log)
 
                 # в цикле по одному файлу загружаем на удаленный сервер
-                for file in pbar:
+                for file in transfer_list:
                     path_local_file = path_local_dir + file
-                    pbar.set_description(f"Processing '{path_local_file}'")
-                    sftp.put(path_local_file, file)
+                    log.debug(f"SFTP:: загрузка '{path_local_file}'")
+                    with METRICS.timer('sftp_put'):
+                        sftp.put(path_local_file, file)
+                    progress.update(1)
+                progress.close()
+
+    def reconcile(self, path_local_dir: str, path_remote_dir: str,
+                  manifest: 'SftpManifest') -> int:
+        """
+        Сверяет манифест с удаленной директорией: файлы, которые есть на
+        сервере с тем же размером, что и локально, отмечаются загруженными,
+        остальные удаляются из манифеста.
+
+        :param path_local_dir: путь к локальной директории с файлами
+        :param path_remote_dir: путь к директории на удаленном сервере
+        :param manifest: манифест загруженных файлов
+        :return: число файлов в манифесте после сверки
+        """
+        with self.connect() as sftp:
+            remote_sizes = {attr.filename: attr.st_size
+                            for attr in sftp.listdir_attr(path_remote_dir)}
+
+        manifest.clear()
+        for file, size in remote_sizes.items():
+            path_local_file = path_local_dir + file
+            if os.path.isfile(path_local_file):
+                stat = os.stat(path_local_file)
+                if stat.st_size == size:
+                    manifest.add(file, stat.st_size, stat.st_mtime)
+        manifest.save()
+        log.info(f'SFTP:: сверка с {path_remote_dir}, '
+                 f'файлов на сервере: {len(manifest)}')
+        return len(manifest)
+
+    def upload_files_parallel(self, path_local_dir: str,
+                              path_remote_dir: str,
+                              find_pattern='',
+                              manifest_path='sftp_manifest.json',
+                              workers=4,
+                              reconcile=False) -> int:
+        """
+        Параллельная загрузка файлов на удаленный сервер несколькими
+        SFTP-сессиями. Вместо получения списка файлов удаленной директории
+        используется локальный манифест загруженных файлов (имя, размер,
+        время изменения). Сверка манифеста с сервером выполняется при
+        reconcile=True или при отсутствии файла манифеста.
+
+        :param path_local_dir: путь к локальной директории с файлами для
+        загрузки (например, '../Media/Photo/')
+        :param path_remote_dir: путь к директории на удаленном сервере
+        (например, './Photo_media/Photo')
+        :param find_pattern: паттерн для отбора файлов
+        (например, '\d+_\d+_\d+_resize.jpg') по умолчанию ''
+        :param manifest_path: путь к файлу манифеста
+        :param workers: число одновременных SFTP-сессий
+        :param reconcile: сверить манифест с удаленной директорией
+        :return: число загруженных файлов
+        """
+        manifest = SftpManifest(manifest_path)
+        if reconcile or not manifest.exists():
+            self.reconcile(path_local_dir, path_remote_dir, manifest)
+
+        # отбираем новые и измененные файлы
+        transfer = queue.Queue()
+        for file in sorted(self.get_local_list(path_local_dir,
+                                               find_pattern)):
+            stat = os.stat(path_local_dir + file)
+            if not manifest.contains(file, stat.st_size, stat.st_mtime):
+                transfer.put((file, stat.st_size, stat.st_mtime))
+
+        total = transfer.qsize()
+        if not total:
+            return 0
+        progress = Progress('SFTP:: загрузка', total=total, unit='files',
+                            logger=log)
+        lock = threading.Lock()
+
+        def worker():
+            uploaded = 0
+            with self.connect() as sftp:
+                with sftp.cd(path_remote_dir):
+                    while True:
+                        try:
+                            file, size, mtime = transfer.get_nowait()
+                        except queue.Empty:
+                            return uploaded
+                        with METRICS.timer('sftp_put'):
+                            sftp.put(path_local_dir + file, file)
+                        uploaded += 1
+                        with lock:
+                            manifest.add(file, size, mtime)
+                        progress.update(1)
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(worker)
+                           for _ in range(min(workers, total))]
+            uploaded = sum(future.result() for future in futures)
+        finally:
+            progress.close()
+            manifest.save()
+        return uploaded
+
+
+class SftpPusher:
+    """
+    Загрузка отдельных файлов на удаленный сервер по мере их готовности
+    (например, из стадии конвейера), без ожидания окончания парсинга.
+    После close() не используется.
+
+    Каждый поток держит свое SFTP-подключение, поэтому push() можно
+    вызывать из нескольких потоков одновременно. Загруженные файлы
+    отмечаются в манифесте SftpManifest, и upload_files_parallel повторно
+    их не загружает.
+
+    Пример.
+    pusher = SftpPusher(sftp_upload, '../Media/Photo/', './Media/Files/Photo',
+                        '../Media/sftp_manifest.json')
+    pusher.push(['1234_resize.jpg', '1234_thumbnail.jpg'])
+    pusher.close()
+    """
+    def __init__(self, sftp: Sftp, path_local_dir: str,
+                 path_remote_dir: str, manifest_path='sftp_manifest.json'):
+        self.sftp = sftp
+        self.path_local_dir = path_local_dir
+        self.path_remote_dir = path_remote_dir
+        self.manifest = SftpManifest(manifest_path)
+        if not self.manifest.exists():
+            sftp.reconcile(path_local_dir, path_remote_dir, self.manifest)
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _connection(self) -> pysftp.Connection:
+        con = getattr(self._local, 'con', None)
+        if con is None:
+            con = self.sftp.connect()
+            con.chdir(self.path_remote_dir)
+            self._local.con = con
+            with self._lock:
+                self._connections.append(con)
+        return con
+
+    def push(self, files: list) -> int:
+        """
+        Загрузить файлы, которых нет в манифесте.
+
+        :param files: имена файлов в локальной директории
+        (например, ['1234_resize.jpg', '1234_thumbnail.jpg'])
+        :return: число загруженных файлов
+        """
+        uploaded = 0
+        for file in files:
+            stat = os.stat(self.path_local_dir + file)
+            with self._lock:
+                if self.manifest.contains(file, stat.st_size, stat.st_mtime):
+                    continue
+            con = self._connection()
+            with METRICS.timer('sftp_put'):
+                con.put(self.path_local_dir + file, file)
+            uploaded += 1
+            with self._lock:
+                self.manifest.add(file, stat.st_size, stat.st_mtime)
+        return uploaded
+
+    def close(self) -> None:
+        """
+        Закрыть подключения и сохранить манифест.
+        """
+        with self._lock:
+            connections, self._connections = self._connections, []
+            for con in connections:
+                con.close()
+            self.manifest.save()
+
+
+class SftpManifest:
+    """
+    Локальный манифест файлов, загруженных на удаленный сервер.
+    Хранится в json-файле вида {имя файла: [размер, время изменения]}.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.files = {}
+        if self.exists():
+            with open(path, encoding='utf-8') as file:
+                self.files = json.load(file)
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+    def exists(self) -> bool:
+        """
+        Проверяет наличие файла манифеста.
+        """
+        return os.path.isfile(self.path)
+
+    def contains(self, file: str, size: int, mtime: float) -> bool:
+        """
+        Проверяет, что файл с заданными размером и временем изменения уже
+        загружен.
+        """
+        return self.files.get(file) == [size, mtime]
+
+    def add(self, file: str, size: int, mtime: float) -> None:
+        """
+        Отмечает файл загруженным.
+        """
+        self.files[file] = [size, mtime]
+
+    def clear(self) -> None:
+        """
+        Очищает манифест.
+        """
+        self.files = {}
+
+    def save(self) -> None:
+        """
+        Сохраняет манифест в файл (через временный файл).
+        """
+        path_tmp = self.path + '.tmp'
+        with open(path_tmp, 'w', encoding='utf-8') as file:
+            json.dump(self.files, file)
+        os.replace(path_tmp, self.path)
 
 
 def checksum_md5(path_file: str) -> str:
@@ -101,10 +347,10 @@ def create_path(path: str) -> None:
     :return:
     """
     if os.path.exists(path):
-        print(f'OS:: путь существует: {path}')
+        log.info(f'OS:: путь существует: {path}')
     else:
         os.makedirs(path)
-        print(f'OS:: путь создан: {path}')
+        log.info(f'OS:: путь создан: {path}')
 
 
 def image_thumbnail(path: str, size=(300, 300), ) -> str:
@@ -1,5 +1,34 @@
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from requests.adapters import HTTPAdapter
+from yadisk.exceptions import PathNotFoundError
 from yadisk.yadisk import YaDisk
 
+from Utils.log import Progress
+from Utils.metrics import METRICS
+
+log = logging.getLogger(__name__)
+
+# Адрес REST API ЯндексДиска
+YADISK_API_URL = 'https://cloud-api.yandex.net'
+
+
+class _ApiUrlAdapter(HTTPAdapter):
+    """
+    Транспорт requests, перенаправляющий запросы к REST API ЯндексДиска на
+    другой адрес (например, на локальный тестовый сервер).
+    """
+    def __init__(self, api_url: str, **kwargs):
+        super().__init__(**kwargs)
+        self.api_url = api_url.rstrip('/')
+
+    def send(self, request, **kwargs):
+        request.url = self.api_url + request.url[len(YADISK_API_URL):]
+        return super().send(request, **kwargs)
+
 
 class YaDiskStorage(YaDisk):
     """
@@ -8,10 +37,20 @@ class YaDiskStorage(YaDisk):
 
     Для получения токена нужно иметь ЯндексДиск.
     Далее по инструкции  https://yandex.ru/dev/direct/doc/start/token.html
+
+    Параметр api_url позволяет направить запросы к REST API на другой адрес,
+    например на локальный сервер, имитирующий API ЯндексДиска.
     """
-    def __init__(self, ya_token):
+    def __init__(self, ya_token, api_url=None):
         super().__init__()
         self.token = ya_token
+        self.api_url = api_url
+
+    def make_session(self, token=None):
+        session = super().make_session(token)
+        if self.api_url:
+            session.mount(YADISK_API_URL, _ApiUrlAdapter(self.api_url))
+        return session
 
     def create_dirs(self, path: str):
         """
@@ -27,7 +66,7 @@ class YaDiskStorage(YaDisk):
         """
 
         if self.exists(path):
-            print(f'YADISK:: путь существует: {path}')
+            log.info(f'YADISK:: путь существует: {path}')
 
         else:
             tree_dirs = [dir_ for dir_ in path.split('/') if dir_]
@@ -37,14 +76,19 @@ class YaDiskStorage(YaDisk):
                 path_ = path_ + dir_ + '/'
                 if not self.exists(path_):
                     self.mkdir(path_)
-                    print(f'YADISK:: создана директория: {path_}')
+                    log.info(f'YADISK:: создана директория: {path_}')
 
-            print(f'YADISK:: путь создан: {path_}')
+            log.info(f'YADISK:: путь создан: {path_}')
 
+    @METRICS.timed('yadisk_upload')
     def upload_file(self, os_path: str, ya_path: str, file: str) -> str:
         """
         Загружает файл на диск по указанному пути и делает его публичным.
 
+        Если файл того же размера уже есть на диске (например, загружен до
+        аварийного завершения), повторно он не загружается, а если он уже
+        опубликован - сразу возвращается его публичная ссылка.
+
         :param os_path:путь к файлу в ОС
         (например, "/Media/Downloads/file1.pdf")
         :param ya_path:путь к папке яндекс диска, куда необходимо
@@ -54,9 +98,124 @@ class YaDiskStorage(YaDisk):
         :return:публичная ссылка на загруженный файл
         """
         upload_path = ya_path + file
-        if not self.is_file(upload_path):
-            self.upload(os_path, upload_path, timeout=None)
+        try:
+            meta = self.get_meta(upload_path)
+        except PathNotFoundError:
+            meta = None
+
+        if meta is not None and meta.size == os.path.getsize(os_path):
+            if meta.public_url:
+                return meta.public_url
+        else:
+            self.upload(os_path, upload_path, overwrite=meta is not None,
+                        timeout=None)
 
         self.publish(upload_path)
         href = self.get_meta(upload_path)['public_url']
         return href
+
+
+class YaDiskUploader:
+    """
+    Параллельная загрузка файлов на ЯндексДиск пулом потоков.
+
+    Каждый файл загружается методом YaDiskStorage.upload_file с повторными
+    попытками и экспоненциально растущей паузой между ними. Результаты
+    передаются в on_batch пачками по batch_size, что позволяет записывать
+    ссылки в БД пакетно. Вызовы on_batch выполняются в вызывающем потоке.
+    Ход загрузки записывается в журнал сводно (см. Utils.log.Progress).
+
+    Возобновление после аварийного завершения обеспечивается тем, что
+    на вход подаются только записи без ссылки, а уже загруженные файлы
+    upload_file повторно не загружает.
+
+    Пример.
+    uploader = YaDiskUploader(storage, '../Media/Downloads/',
+                              '/Media/Downloads/', workers=4)
+    uploader.run(db.iter_null_yadisk('book_books'), on_batch=save_links)
+    """
+
+    def __init__(self, storage: YaDiskStorage, os_dir: str, ya_dir: str,
+                 workers=4, retries=3, backoff=2.0) -> None:
+        self.storage = storage
+        self.os_dir = os_dir
+        self.ya_dir = ya_dir
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+
+    def upload(self, file: str) -> str:
+        """
+        Загружает файл с повторными попытками.
+
+        :param file: имя файла (например, "file1.pdf")
+        :return: публичная ссылка на загруженный файл
+        """
+        os_path = self.os_dir + file
+        attempt = 0
+        while True:
+            try:
+                return self.storage.upload_file(os_path, self.ya_dir, file)
+            except FileNotFoundError:
+                raise
+            except Exception as exc:
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                delay = self.backoff * 2 ** (attempt - 1)
+                log.warning(f'{exc} YADISK:: повтор загрузки {file} через '
+                            f'{delay} с')
+                time.sleep(delay)
+
+    def run(self, rows, on_batch, batch_size=50, total=None) -> tuple:
+        """
+        Загружает файлы из rows и передает результаты в on_batch.
+
+        :param rows: итерируемый объект кортежей (id, file_name, yadisk)
+        :param on_batch: функция, принимающая список [(id, href), ...]
+        :param batch_size: размер пачки результатов
+        :param total: число файлов для индикатора (по умолчанию len(rows))
+        :return: Tuple[число загруженных файлов, число ошибок]
+        """
+        if total is None and hasattr(rows, '__len__'):
+            total = len(rows)
+        progress = Progress('YADISK:: загрузка', total=total, unit='files',
+                            logger=log)
+        batch = []
+        uploaded = failed = 0
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = {}
+            rows = iter(rows)
+            exhausted = False
+            while pending or not exhausted:
+                # держим в очереди не больше двух файлов на поток
+                while not exhausted and len(pending) < self.workers * 2:
+                    row = next(rows, None)
+                    if row is None:
+                        exhausted = True
+                        break
+                    pk, file = row[0], row[1]
+                    pending[pool.submit(self.upload, file)] = (pk, file)
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pk, file = pending.pop(future)
+                    progress.update(1)
+                    try:
+                        batch.append((pk, future.result()))
+                        uploaded += 1
+                    except Exception as exc:
+                        failed += 1
+                        log.warning(f'{exc} YADISK:: файл {file} не '
+                                    f'загружен')
+                if len(batch) >= batch_size:
+                    on_batch(batch)
+                    batch = []
+
+        if batch:
+            on_batch(batch)
+        progress.close()
+        return uploaded, failed
@@ -0,0 +1,91 @@
+"""
+Бенчмарк кэша запросов DB.
+
+Выполняет частые запросы цикла парсинга (check_record, insert_record,
+get_last_post, check_friendly_channel) на локальном Postgres в трех
+режимах: сборка запроса при каждом вызове (как до кэша), кэш текстов
+запросов и подготовленные на сервере запросы (PREPARE).
+
+Пример запуска:
+python bench_db.py --database pyapp --user postgres --password postgres \
+--sslmode disable --count 2000
+"""
+import argparse
+import time
+
+from DatabaseTools.connect import DB
+from DatabaseTools import schemas
+
+SERVICE_TABLE = 'bench_service_info'
+FRIENDLY_TABLE = 'bench_friendly_channels'
+
+
+def prepare_tables(db: DB) -> None:
+    with db.connection() as con:
+        with con.cursor() as cur:
+            cur.execute(f'drop table if exists {SERVICE_TABLE}, '
+                        f'{FRIENDLY_TABLE}')
+    db.create_table(SERVICE_TABLE, schemas.SERVICE_INFO,
+                    schemas.SERVICE_INFO_INDEXES)
+    db.create_table(FRIENDLY_TABLE, schemas.FRIENDLY_CHANNELS,
+                    schemas.FRIENDLY_CHANNELS_INDEXES)
+
+
+def hot_loop(db: DB, count: int, clear: bool) -> None:
+    for message_id in range(1, count + 1):
+        if clear:
+            db.statements.clear()
+        db.check_record(1, message_id, SERVICE_TABLE)
+        db.insert_record(SERVICE_TABLE, {
+            'channel_id': 1, 'message_id': message_id,
+            'corresponds_params': True, 'complete': True,
+            'date': '2023-01-01T00:00:00+00:00'})
+        db.get_last_post(SERVICE_TABLE, 1)
+        db.check_friendly_channel(FRIENDLY_TABLE, message_id)
+
+
+def measure(name: str, db: DB, count: int, repeat: int,
+            clear=False) -> None:
+    best = None
+    for _ in range(repeat):
+        prepare_tables(db)
+        start = time.perf_counter()
+        hot_loop(db, count, clear)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f'{name:<12} {best:8.3f} с  {count * 4 / best:9.1f} запр./с  '
+          f'{db.statements.stats()}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк кэша запросов DB')
+    parser.add_argument('--database', default='postgres')
+    parser.add_argument('--user', default='postgres')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5432)
+    parser.add_argument('--sslmode', default='disable')
+    parser.add_argument('--count', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    def connect(prepare_threshold=None) -> DB:
+        return DB(database=args.database, user=args.user,
+                  password=args.password, host=args.host, port=args.port,
+                  sslmode=args.sslmode, prepare_threshold=prepare_threshold)
+
+    print(f'Сообщений: {args.count}, запросов на сообщение: 4')
+    measure('compose', connect(), args.count, args.repeat, clear=True)
+    measure('cache', connect(), args.count, args.repeat)
+    measure('prepared', connect(prepare_threshold=1), args.count,
+            args.repeat)
+
+    db = connect()
+    with db.connection() as con:
+        with con.cursor() as cur:
+            cur.execute(f'drop table {SERVICE_TABLE}, {FRIENDLY_TABLE}')
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
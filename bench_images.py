@@ -0,0 +1,90 @@
+"""
+Бенчмарк создания производных изображений.
+
+Сравнивает прежнюю обработку (image_thumbnail + image_resize_height, два
+декодирования исходника в одном процессе), make_derivatives в одном
+процессе и ImagePipeline в пуле процессов.
+
+Пример запуска:
+python bench_images.py ../Media/Photo/ --workers 4 --repeat 3
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from Utils.images import make_derivatives, ImagePipeline
+from Utils.plugins import image_thumbnail, image_resize_height
+
+
+def sample_files(path_dir: str, tmp_dir: str) -> list:
+    """
+    Копирует исходные JPEG во временную папку, чтобы не засорять исходную
+    папку производными.
+
+    :param path_dir: папка с JPEG (например, '../Media/Photo/')
+    :param tmp_dir: временная папка
+    :return: список путей к копиям
+    """
+    files = []
+    for file in sorted(os.listdir(path_dir)):
+        name, _, ext = file.rpartition('.')
+        if ext.lower() not in ('jpg', 'jpeg') or \
+                name.endswith(('_thumbnail', '_resize')):
+            continue
+        shutil.copy(os.path.join(path_dir, file), tmp_dir)
+        files.append(tmp_dir + '/' + file)
+    return files
+
+
+def legacy(files: list) -> None:
+    for path in files:
+        image_thumbnail(path)
+        image_resize_height(path)
+
+
+def single_decode(files: list) -> None:
+    for path in files:
+        make_derivatives(path)
+
+
+def pool(files: list, workers: int) -> None:
+    with ImagePipeline(workers=workers) as images:
+        for path in files:
+            images.submit(path)
+
+
+def measure(name: str, func, repeat: int, count: int) -> None:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f'{name:<24} {best:8.3f} с  {count / best:8.1f} изобр./с')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Бенчмарк создания производных изображений')
+    parser.add_argument('path', help='папка с JPEG')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        files = sample_files(args.path, tmp_dir)
+        if not files:
+            print(f'В папке {args.path} нет JPEG')
+            return
+        print(f'Изображений: {len(files)}, процессов: {args.workers}')
+        measure('legacy', lambda: legacy(files), args.repeat, len(files))
+        measure('single decode', lambda: single_decode(files), args.repeat,
+                len(files))
+        measure(f'pool x{args.workers}', lambda: pool(files, args.workers),
+                args.repeat, len(files))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,29 @@
-from TelegramParser.parser import TelegramConnect
-from TelegramParser.templates import physics_lib
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from TelegramParser.parser import TelegramConnect, remove_stale_parts
+from TelegramParser.async_parser import AsyncTelegramConnect
+from TelegramParser.archive import MessageArchive, ReplayTelegramConnect
+from TelegramParser.scheduler import ChannelScheduler, DBCheckpoints, \
+    DBFailures
+from TelegramParser.backfill import Backfill, DBRanges
+from TelegramParser.templates import physics_lib, physics_lib_async
 
 from DatabaseTools.connect import DB
 from DatabaseTools import schemas
 
-from YandexDiskKeeper.keeper import YaDiskStorage
+from YandexDiskKeeper.keeper import YaDiskStorage, YaDiskUploader
 
-from Utils.plugins import create_path, Sftp
+from Utils.plugins import create_path, Sftp, SftpPusher
+from Utils.metrics import METRICS, MetricsExporter
+from Utils.log import setup_logging
 
 from decouple import config
-from tqdm import tqdm
+from psycopg2 import sql
+
 
+log = logging.getLogger('run')
 
 T_ME_LINK = 'https://t.me'
 
@@ -21,13 +34,32 @@ PATH_PHOTO = r'../Media/Photo/'
 # Путь для сохранения изображений на удаленном сервере
 PATH_REMOTE_PHOTO = './Media/Files/Photo'
 
+# Манифест загруженных на удаленный сервер изображений и число SFTP-сессий
+SFTP_MANIFEST = r'../Media/sftp_manifest.json'
+SFTP_WORKERS = 4
+
 # Путь для сохранения файлов на ЯндексДиске
 YADISK_DOWNLOAD = r'/Media/Downloads/'
 
+# Число потоков загрузки на ЯндексДиск, число повторов при ошибке и
+# размер пачки ссылок для записи в БД
+YADISK_WORKERS = 4
+YADISK_RETRIES = 3
+YADISK_BATCH_SIZE = 50
+
 # Максимальный размер закачиваемого файла и его типы
 LIMIT_FILE_SIZE = 15728640  # bytes (15Mb) # 78643200  # bytes (75Mb)
 TYPE_FILE_DOWNLOAD = ['rar', 'pdf', 'djvu', 'zip', '7z']
 
+# Файлы от этого размера загружаются параллельными запросами
+# (None - только последовательная загрузка) и число таких запросов
+PARALLEL_THRESHOLD = 10485760  # bytes (10Mb)
+PARALLEL_WORKERS = 4
+
+# Незавершенные загрузки, которые не продолжались дольше этого времени,
+# удаляются при запуске
+PART_MAX_AGE = 7 * 24 * 3600  # sec
+
 # Шаблон фильтра ссылок(оставляет только телеграм ссылки)
 PATTERN = 'https://t.me/\S+/\d+'
 
@@ -38,26 +70,215 @@ NAME_FILE_PHOTO_PATTERN = '\d+_\d+_\d+_resize.jpg|\d+_\d+_\d+_thumbnail.jpg'
 MAIN_TABLE = 'book_books'
 SERVICE_TABLE = 'service_info'
 FRIENDLY_CHANNELS_TABLE = 'friendly_channels'
+CHECKPOINTS_TABLE = 'parser_checkpoints'
+BACKFILL_TABLE = 'backfill_ranges'
+FAILURES_TABLE = 'parser_failures'
 
+# Каналы для парсинга: (id канала, название шаблона)
+CHANNELS = [
+    (1360755573, 'physics_lib'),
+]
 
-def main():
-    # создаем соединение с Телеграм
-    tg = TelegramConnect(api_id=config('TELEGRAM_API_ID'),
-                         api_hash=config('TELEGRAM_API_HASH'),
-                         session='session_name'
-                         )
+# Шаблоны асинхронного парсинга
+TEMPLATES = {
+    'physics_lib': physics_lib_async.PhysicsLibParser,
+}
+
+# Число одновременно обрабатываемых каналов и число сообщений канала
+# за один ход планировщика
+CHANNELS_CONCURRENCY = 4
+CHANNEL_QUOTA = 100
+
+# Число выполнений запроса, после которого он подготавливается на сервере
+# БД (PREPARE), None - не подготавливать (например, 50, если PREPARE
+# поддерживается пулером соединений перед БД)
+DB_PREPARE_THRESHOLD = None
+
+# Размер пула соединений с БД
+DB_MIN_CONNECTIONS = 1
+DB_MAX_CONNECTIONS = 4
+
+# Асинхронный парсинг: число одновременно обрабатываемых сообщений,
+# одновременных загрузок и запросов сообщений по ссылкам
+PARSER_ASYNC = True
+IN_FLIGHT = 8
+DOWNLOAD_LIMIT = 4
+LINK_LIMIT = 8
+
+# Журнал в виде JSON-строк и уровни записей в файле и в терминале
+LOG_PATH = r'../Media/parser.log.jsonl'
+LOG_LEVEL = logging.INFO
+LOG_CONSOLE_LEVEL = logging.INFO
+
+# Файл метрик (расширение .json - JSON, иначе текстовый формат Prometheus)
+# и интервал его обновления, сек
+METRICS_PATH = r'../Media/metrics.prom'
+METRICS_INTERVAL = 60
+
+# Парсинг конвейером: сообщения загружаются на SFTP и ЯндексДиск сразу после
+# обработки, число обработчиков стадий конвейера
+PARSER_PIPELINE = True
+PIPELINE_WORKERS = {
+    'select': 4,
+    'download': DOWNLOAD_LIMIT,
+    'image': 2,
+    'sftp': SFTP_WORKERS,
+    'yadisk': YADISK_WORKERS,
+}
+
+# Число попыток обработки сообщения конвейером, после которого сообщение
+# записывается с complete=False и контрольная точка канала идет дальше
+PIPELINE_MAX_ATTEMPTS = 3
+
+# Локальный архив сообщений: None - не используется, 'capture' - полученные
+# из Telegram сообщения записываются в архив, 'replay' - архив
+# обрабатывается шаблонами без обращения к Telegram в отдельные таблицы
+# с префиксом REPLAY_PREFIX (таблицы пересоздаются, файлы-заглушки
+# сохраняются в PATH_REPLAY, загрузки на SFTP и ЯндексДиск не выполняются)
+ARCHIVE_MODE = None
+ARCHIVE_PATH = r'../Media/archive.sqlite'
+REPLAY_PREFIX = 'replay_'
+PATH_REPLAY = r'../Media/Replay/'
+
+# Историческая загрузка каналов перед парсингом: каналы (id канала, название
+# шаблона), файлы сессий Telegram (у каждой сессии свой лимит частоты
+# запросов и кэш каналов) и размер диапазона номеров сообщений на сессию.
+# Прерванная загрузка продолжается при следующем запуске.
+BACKFILL_CHANNELS = []
+BACKFILL_SESSIONS = ['session_backfill_1', 'session_backfill_2',
+                     'session_backfill_3']
+BACKFILL_RANGE_SIZE = 2000
+
+
+async def connect_async(archive=None, session='session_name',
+                        entity_cache_path='entity_cache.sqlite'
+                        ) -> AsyncTelegramConnect:
+    # клиент создается внутри цикла событий, к которому он будет привязан
+    tg = AsyncTelegramConnect(api_id=config('TELEGRAM_API_ID'),
+                              api_hash=config('TELEGRAM_API_HASH'),
+                              session=session,
+                              entity_cache_path=entity_cache_path,
+                              download_limit=DOWNLOAD_LIMIT,
+                              link_limit=LINK_LIMIT,
+                              parallel_threshold=PARALLEL_THRESHOLD,
+                              parallel_workers=PARALLEL_WORKERS,
+                              archive=archive
+                              )
+    await tg.start()
+    return tg
+
+
+def new_template(template_name: str, db: DB, tg: AsyncTelegramConnect,
+                 db_executor: ThreadPoolExecutor):
+    return TEMPLATES[template_name](
+        db, tg, table=MAIN_TABLE, service_table=SERVICE_TABLE,
+        path_photo=PATH_PHOTO, path_download=PATH_DOWNLOAD,
+        limit_file_size=LIMIT_FILE_SIZE,
+        type_file_download=TYPE_FILE_DOWNLOAD,
+        t_me_link=T_ME_LINK, pattern=PATTERN, in_flight=IN_FLIGHT,
+        db_executor=db_executor)
 
+
+async def parse_pipeline(db: DB, sftp_upload: Sftp, uploader: YaDiskUploader,
+                         archive=None) -> None:
+    tg = await connect_async(archive)
+    db_executor = ThreadPoolExecutor(max_workers=1)
+    pusher = SftpPusher(sftp_upload, PATH_PHOTO, PATH_REMOTE_PHOTO,
+                        manifest_path=SFTP_MANIFEST)
+    checkpoints = DBCheckpoints(db, CHECKPOINTS_TABLE, SERVICE_TABLE)
+    failures = DBFailures(db, FAILURES_TABLE)
+    # каналы одного шаблона обрабатываются одним конвейером
+    channels = {}
+    for channel_id, template_name in CHANNELS:
+        channels.setdefault(template_name, []).append(channel_id)
+    # конвейеры шаблонов работают одновременно, каналы внутри конвейера
+    # чередуются (см. PhysicsLibParser.pipeline)
+    try:
+        await asyncio.gather(
+            *(new_template(template_name, db, tg, db_executor).pipeline(
+                channel_ids, checkpoints, sftp=pusher, uploader=uploader,
+                workers=PIPELINE_WORKERS, concurrency=CHANNELS_CONCURRENCY,
+                quota=CHANNEL_QUOTA, failures=failures,
+                max_attempts=PIPELINE_MAX_ATTEMPTS)
+              for template_name, channel_ids in channels.items()))
+    finally:
+        await tg.disconnect()
+        db_executor.shutdown()
+        pusher.close()
+        log.info(tg.rate_limiter.summary())
+
+
+async def parse_async(db: DB, archive=None) -> None:
+    tg = await connect_async(archive)
+
+    # один экземпляр шаблона на все его каналы, общий поток БД
+    db_executor = ThreadPoolExecutor(max_workers=1)
+    templates = {}
+    scheduler = ChannelScheduler(
+        tg, DBCheckpoints(db, CHECKPOINTS_TABLE, SERVICE_TABLE),
+        concurrency=CHANNELS_CONCURRENCY, quota=CHANNEL_QUOTA)
+    for channel_id, template_name in CHANNELS:
+        if template_name not in templates:
+            templates[template_name] = new_template(template_name, db, tg,
+                                                    db_executor)
+        scheduler.add(channel_id, templates[template_name])
+    try:
+        await scheduler.run()
+    finally:
+        await tg.disconnect()
+        db_executor.shutdown()
+        log.info(tg.rate_limiter.summary())
+
+
+async def backfill(db: DB) -> None:
+    # у каждой сессии свой клиент и свои шаблоны, общий поток БД
+    db_executor = ThreadPoolExecutor(max_workers=1)
+    clients = []
+    try:
+        for session in BACKFILL_SESSIONS:
+            clients.append(await connect_async(
+                session=session,
+                entity_cache_path=f'{session}.entity_cache.sqlite'))
+        checkpoints = DBCheckpoints(db, CHECKPOINTS_TABLE, SERVICE_TABLE)
+        for channel_id, template_name in BACKFILL_CHANNELS:
+            sessions = [(tg, new_template(template_name, db, tg,
+                                          db_executor))
+                        for tg in clients]
+            loader = Backfill(sessions, DBRanges(db, BACKFILL_TABLE),
+                              range_size=BACKFILL_RANGE_SIZE,
+                              quota=CHANNEL_QUOTA, checkpoints=checkpoints)
+            log.info(f'Канал {channel_id}: {await loader.run(channel_id)}')
+    finally:
+        for session, tg in zip(BACKFILL_SESSIONS, clients):
+            await tg.disconnect()
+            log.info(f'{session}: {tg.rate_limiter.summary()}')
+        db_executor.shutdown()
+
+
+def main():
     # создаем подключение к базе данных
     db = DB(database=config('DATABASE_NAME'),
             user=config('DATABASE_USERNAME'),
             password=config('DATABASE_PASSWORD'),
             host=config('DATABASE_HOST'),
             sslmode='verify-ca',
-            sslrootcert=config('PATH_DATABASE_CERT')
+            sslrootcert=config('PATH_DATABASE_CERT'),
+            prepare_threshold=DB_PREPARE_THRESHOLD,
+            minconn=DB_MIN_CONNECTIONS,
+            maxconn=DB_MAX_CONNECTIONS
             )
 
     # db = DB(database='pyapp', user='kuusee', password='357612462')
 
+    archive = MessageArchive(ARCHIVE_PATH) if ARCHIVE_MODE else None
+    if ARCHIVE_MODE == 'replay':
+        try:
+            replay(db, archive)
+        finally:
+            archive.close()
+            db.close()
+        return
+
     # создаем объект класса для работы по sftp
     sftp_upload = Sftp(config('SFTP_USER'), config('SFTP_PASSWORD'),
                        config('SFTP_HOST'), int(config('SFTP_PORT')))
@@ -68,34 +289,123 @@ def main():
     # создаем/проверяем пути
     create_path(PATH_DOWNLOAD)
     create_path(PATH_PHOTO)
+    remove_stale_parts(PATH_DOWNLOAD, PART_MAX_AGE)
     storage.create_dirs(YADISK_DOWNLOAD)
 
+    try:
+        with MetricsExporter(METRICS, METRICS_PATH,
+                             interval=METRICS_INTERVAL):
+            process(db, sftp_upload, storage, archive)
+    finally:
+        if archive is not None:
+            log.info(f'Сообщений в архиве {ARCHIVE_PATH}: {len(archive)}')
+            archive.close()
+    log.info(METRICS.summary())
+    log.info(f'Кэш запросов БД: {db.statements.stats()}')
+    db.close()
+
+
+def replay(db: DB, archive: MessageArchive) -> None:
+    # обработка архива шаблонами в отдельные таблицы
+    table = REPLAY_PREFIX + MAIN_TABLE
+    service_table = REPLAY_PREFIX + SERVICE_TABLE
+    with db.connection() as con:
+        with con.cursor() as cur:
+            cur.execute(sql.SQL('drop table if exists {}, {}').format(
+                sql.Identifier(table), sql.Identifier(service_table)))
+    db.create_table(table, schemas.MAIN_TABLE, schemas.MAIN_TABLE_INDEXES)
+    db.create_table(service_table, schemas.SERVICE_INFO,
+                    schemas.SERVICE_INFO_INDEXES)
+    create_path(PATH_REPLAY)
+
+    tg = ReplayTelegramConnect(archive)
+    for channel_id, _ in CHANNELS:
+        physics_lib.physics_lib(database_connect=db, telegram_connect=tg,
+                                table=table, service_table=service_table,
+                                path_photo=PATH_REPLAY,
+                                path_download=PATH_REPLAY,
+                                limit_file_size=LIMIT_FILE_SIZE,
+                                type_file_download=TYPE_FILE_DOWNLOAD,
+                                t_me_link=T_ME_LINK, pattern=PATTERN,
+                                channel_id=channel_id)
+    log.info(METRICS.summary())
+
+
+def process(db: DB, sftp_upload: Sftp, storage: YaDiskStorage,
+            archive=None) -> None:
     # создаем требуемые таблицы в БД
-    db.create_table(MAIN_TABLE, schemas.MAIN_TABLE)
-    db.create_table(SERVICE_TABLE, schemas.SERVICE_INFO)
-    db.create_table(FRIENDLY_CHANNELS_TABLE, schemas.FRIENDLY_CHANNELS)
-
-    # Пар
-    physics_lib.physics_lib(database_connect=db, telegram_connect=tg,
-                            table=MAIN_TABLE, service_table=SERVICE_TABLE,
-                            path_photo=PATH_PHOTO, path_download=PATH_DOWNLOAD,
-                            limit_file_size=LIMIT_FILE_SIZE,
-                            type_file_download=TYPE_FILE_DOWNLOAD,
-                            t_me_link=T_ME_LINK, pattern=PATTERN)
-
-    # загружаем изображения по sftp на удаленный сервер
-    sftp_upload.upload_files(PATH_PHOTO,
-                             PATH_REMOTE_PHOTO,
-                             NAME_FILE_PHOTO_PATTERN)
-
-    # создаем список файлов для загрузки на яндекс диск
-    pbar = tqdm(db.select_null_yadisk(MAIN_TABLE))  # красивый бар загрузки
-    for pk, file, _ in pbar:
-        os_path = PATH_DOWNLOAD + file
-        pbar.set_description(f"Processing '{os_path}'")
-        href = storage.upload_file(os_path, YADISK_DOWNLOAD, file)
-        db.set_values('book_books', {'id': pk, 'yadisk': href})
+    db.create_table(MAIN_TABLE, schemas.MAIN_TABLE,
+                    schemas.MAIN_TABLE_INDEXES)
+    # сервисная таблица - журнал, повторные записи в ней можно удалить
+    db.create_table(SERVICE_TABLE, schemas.SERVICE_INFO,
+                    schemas.SERVICE_INFO_INDEXES, deduplicate=True)
+    db.create_table(FRIENDLY_CHANNELS_TABLE, schemas.FRIENDLY_CHANNELS,
+                    schemas.FRIENDLY_CHANNELS_INDEXES)
+    db.create_table(CHECKPOINTS_TABLE, schemas.CHECKPOINTS,
+                    schemas.CHECKPOINTS_INDEXES)
+    db.create_table(BACKFILL_TABLE, schemas.BACKFILL_RANGES,
+                    schemas.BACKFILL_RANGES_INDEXES)
+    db.create_table(FAILURES_TABLE, schemas.PARSER_FAILURES,
+                    schemas.PARSER_FAILURES_INDEXES)
+
+    uploader = YaDiskUploader(storage, PATH_DOWNLOAD, YADISK_DOWNLOAD,
+                              workers=YADISK_WORKERS, retries=YADISK_RETRIES)
+
+    # историческая загрузка новых каналов несколькими сессиями, обычный
+    # парсинг продолжает каналы с ее конца
+    if BACKFILL_CHANNELS:
+        asyncio.run(backfill(db))
+
+    # Парсинг
+    if PARSER_PIPELINE:
+        asyncio.run(parse_pipeline(db, sftp_upload, uploader, archive))
+    elif PARSER_ASYNC:
+        asyncio.run(parse_async(db, archive))
+    else:
+        # создаем соединение с Телеграм
+        tg = TelegramConnect(api_id=config('TELEGRAM_API_ID'),
+                             api_hash=config('TELEGRAM_API_HASH'),
+                             session='session_name',
+                             parallel_threshold=PARALLEL_THRESHOLD,
+                             parallel_workers=PARALLEL_WORKERS,
+                             archive=archive
+                             )
+        # синхронный парсинг - каналы по очереди
+        for channel_id, _ in CHANNELS:
+            physics_lib.physics_lib(database_connect=db, telegram_connect=tg,
+                                    table=MAIN_TABLE,
+                                    service_table=SERVICE_TABLE,
+                                    path_photo=PATH_PHOTO,
+                                    path_download=PATH_DOWNLOAD,
+                                    limit_file_size=LIMIT_FILE_SIZE,
+                                    type_file_download=TYPE_FILE_DOWNLOAD,
+                                    t_me_link=T_ME_LINK, pattern=PATTERN,
+                                    channel_id=channel_id)
+        log.info(tg.rate_limiter.summary())
+
+    # загружаем изображения по sftp на удаленный сервер (при парсинге
+    # конвейером - только не загруженные во время парсинга)
+    sftp_upload.upload_files_parallel(PATH_PHOTO,
+                                      PATH_REMOTE_PHOTO,
+                                      NAME_FILE_PHOTO_PATTERN,
+                                      manifest_path=SFTP_MANIFEST,
+                                      workers=SFTP_WORKERS)
+
+    # загружаем на яндекс диск файлы без ссылки и записываем ссылки в БД
+    # (при парсинге конвейером - только не загруженные во время парсинга)
+    def save_links(batch):
+        db.set_values_many(MAIN_TABLE, [{'id': pk, 'yadisk': href}
+                                        for pk, href in batch])
+
+    uploader.run(db.iter_null_yadisk(MAIN_TABLE), on_batch=save_links,
+                 batch_size=YADISK_BATCH_SIZE,
+                 total=db.count_null_yadisk(MAIN_TABLE))
 
 
 if __name__ == '__main__':
-    main()
+    listener = setup_logging(LOG_PATH, level=LOG_LEVEL,
+                             console_level=LOG_CONSOLE_LEVEL)
+    try:
+        main()
+    finally:
+        listener.stop()
@@ -0,0 +1,112 @@
+"""
+Планировщик каналов с тестовым клиентом и контрольными точками в памяти.
+"""
+import asyncio
+from types import SimpleNamespace
+
+from TelegramParser.scheduler import ChannelScheduler, MemoryCheckpoints
+
+
+class FakeClient:
+    """
+    Клиент, отдающий сообщения с номерами 1..last для каждого канала.
+    """
+
+    def __init__(self, last: dict) -> None:
+        self.last = last
+
+    async def iter_messages(self, channel_id: int, min_id: int, limit=None):
+        count = 0
+        for message_id in range(min_id + 1, self.last[channel_id] + 1):
+            if limit is not None and count >= limit:
+                return
+            count += 1
+            await asyncio.sleep(0)
+            yield SimpleNamespace(id=message_id)
+
+
+class FakeTemplate:
+    """
+    Шаблон, записывающий порядок обработки (channel_id, номер сообщения).
+    """
+
+    def __init__(self, failing=()) -> None:
+        self.failing = set(failing)
+        self.processed = []
+        self.opened = self.closed = 0
+
+    async def open(self) -> None:
+        self.opened += 1
+
+    async def close(self) -> None:
+        self.closed += 1
+
+    async def db_call(self, func, *args):
+        return func(*args)
+
+    async def process(self, channel_id: int, messages) -> None:
+        async for message in messages:
+            if (channel_id, message.id) in self.failing:
+                raise RuntimeError('ошибка обработки')
+            self.processed.append((channel_id, message.id))
+
+
+def test_run_round_robin_and_checkpoints():
+    template = FakeTemplate()
+    checkpoints = MemoryCheckpoints()
+    scheduler = ChannelScheduler(FakeClient({1: 5, 2: 3, 3: 0}), checkpoints,
+                                 concurrency=1, quota=2)
+    for channel_id in (1, 2, 3):
+        scheduler.add(channel_id, template)
+
+    processed = asyncio.run(scheduler.run())
+
+    assert processed == {1: 5, 2: 3, 3: 0}
+    assert template.processed == [(1, 1), (1, 2), (2, 1), (2, 2),
+                                  (1, 3), (1, 4), (2, 3), (1, 5)]
+    assert checkpoints.points == {1: 5, 2: 3}
+    assert (template.opened, template.closed) == (1, 1)
+
+
+def test_run_continues_from_checkpoints():
+    template = FakeTemplate()
+    checkpoints = MemoryCheckpoints({1: 4, 2: 3})
+    scheduler = ChannelScheduler(FakeClient({1: 6, 2: 3}), checkpoints,
+                                 concurrency=2, quota=10)
+    scheduler.add(1, template)
+    scheduler.add(2, template)
+
+    assert asyncio.run(scheduler.run()) == {1: 2, 2: 0}
+    assert template.processed == [(1, 5), (1, 6)]
+    assert checkpoints.points == {1: 6, 2: 3}
+
+
+def test_failing_channel_keeps_last_checkpoint():
+    template = FakeTemplate(failing={(1, 3)})
+    checkpoints = MemoryCheckpoints()
+    scheduler = ChannelScheduler(FakeClient({1: 6, 2: 6}), checkpoints,
+                                 concurrency=2, quota=2)
+    scheduler.add(1, template)
+    scheduler.add(2, template)
+
+    processed = asyncio.run(scheduler.run())
+
+    assert processed == {1: 2, 2: 6}
+    assert checkpoints.points == {1: 2, 2: 6}
+
+
+def test_stream_interleaves_channels_without_moving_checkpoints():
+    template = FakeTemplate()
+    checkpoints = MemoryCheckpoints({2: 1})
+    scheduler = ChannelScheduler(FakeClient({1: 3, 2: 4}), checkpoints,
+                                 concurrency=1, quota=2)
+    scheduler.add(1, template)
+    scheduler.add(2, template)
+
+    async def collect():
+        return [(channel_id, message.id)
+                async for channel_id, message in scheduler.stream()]
+
+    assert asyncio.run(collect()) == [(1, 1), (1, 2), (2, 2), (2, 3),
+                                      (1, 3), (2, 4)]
+    assert checkpoints.points == {2: 1}
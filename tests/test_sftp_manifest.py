@@ -0,0 +1,47 @@
+"""
+Манифест файлов, загруженных на удаленный сервер.
+"""
+import os
+
+from Utils.plugins import SftpManifest
+
+
+def test_manifest_round_trip(tmp_path):
+    photo = tmp_path / '1360755573_1_0_resize.jpg'
+    photo.write_bytes(b'jpeg')
+    stat = os.stat(photo)
+    path = str(tmp_path / 'manifest.json')
+
+    manifest = SftpManifest(path)
+    assert not manifest.exists()
+    manifest.add(photo.name, stat.st_size, stat.st_mtime)
+    manifest.save()
+
+    loaded = SftpManifest(path)
+    assert loaded.exists()
+    assert len(loaded) == 1
+    assert loaded.contains(photo.name, stat.st_size, stat.st_mtime)
+    assert not os.path.exists(path + '.tmp')
+
+
+def test_manifest_detects_changed_file(tmp_path):
+    path = str(tmp_path / 'manifest.json')
+    manifest = SftpManifest(path)
+    manifest.add('a.jpg', 10, 1700000000.25)
+    manifest.save()
+
+    loaded = SftpManifest(path)
+    assert not loaded.contains('a.jpg', 11, 1700000000.25)
+    assert not loaded.contains('a.jpg', 10, 1700000001.25)
+    assert not loaded.contains('b.jpg', 10, 1700000000.25)
+
+
+def test_manifest_clear(tmp_path):
+    path = str(tmp_path / 'manifest.json')
+    manifest = SftpManifest(path)
+    manifest.add('a.jpg', 10, 1.0)
+    manifest.save()
+    manifest.clear()
+    manifest.save()
+
+    assert len(SftpManifest(path)) == 0
@@ -0,0 +1,248 @@
+"""
+Загрузка на удаленный сервер через локальный SFTP-сервер на paramiko
+(см. Sftp(cnopts=...)).
+"""
+import os
+import socket
+import threading
+import time
+import warnings
+
+import paramiko
+import pysftp
+import pytest
+
+from Utils.plugins import Sftp, SftpManifest, SftpPusher
+
+USERNAME = 'parser'
+PASSWORD = 'secret'
+
+
+class FakeServer:
+    """
+    Состояние сервера: корневая папка, загруженные файлы
+    [(номер сессии, путь)] и наибольшее число одновременных загрузок.
+    """
+
+    def __init__(self, root: str, put_delay=0.0) -> None:
+        self.root = root
+        self.put_delay = put_delay
+        self.puts = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+
+class AuthServer(paramiko.ServerInterface):
+    def check_auth_password(self, username, password):
+        if (username, password) == (USERNAME, PASSWORD):
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+
+class PutHandle(paramiko.SFTPHandle):
+    def __init__(self, server: FakeServer, session: int, path: str,
+                 file, flags) -> None:
+        super().__init__(flags)
+        self.server = server
+        self.session = session
+        self.path = path
+        self.readfile = self.writefile = file
+        with server.lock:
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(
+            self.writefile.fileno()))
+
+    def close(self):
+        time.sleep(self.server.put_delay)
+        super().close()
+        with self.server.lock:
+            self.server.active -= 1
+            self.server.puts.append((self.session, self.path))
+
+
+def make_sftp_interface(server: FakeServer, session: int):
+    class Interface(paramiko.SFTPServerInterface):
+        def local(self, path: str) -> str:
+            return server.root + self.canonicalize(path)
+
+        def list_folder(self, path):
+            folder = self.local(path)
+            items = []
+            for name in os.listdir(folder):
+                attr = paramiko.SFTPAttributes.from_stat(
+                    os.stat(os.path.join(folder, name)))
+                attr.filename = name
+                items.append(attr)
+            return items
+
+        def stat(self, path):
+            try:
+                return paramiko.SFTPAttributes.from_stat(
+                    os.stat(self.local(path)))
+            except OSError as exc:
+                return paramiko.SFTPServer.convert_errno(exc.errno)
+
+        lstat = stat
+
+        def open(self, path, flags, attr):
+            try:
+                file = open(self.local(path), 'w+b')
+            except OSError as exc:
+                return paramiko.SFTPServer.convert_errno(exc.errno)
+            return PutHandle(server, session, self.canonicalize(path), file,
+                             flags)
+
+    return Interface
+
+
+@pytest.fixture
+def server(tmp_path):
+    root = tmp_path / 'remote'
+    (root / 'Photo').mkdir(parents=True)
+    server = FakeServer(str(root), put_delay=0.05)
+    host_key = paramiko.RSAKey.generate(1024)
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(16)
+    transports = []
+
+    def accept():
+        session = 0
+        while True:
+            try:
+                sock, _ = listener.accept()
+            except OSError:
+                return
+            session += 1
+            transport = paramiko.Transport(sock)
+            transport.add_server_key(host_key)
+            transport.set_subsystem_handler(
+                'sftp', paramiko.SFTPServer,
+                make_sftp_interface(server, session))
+            transport.start_server(server=AuthServer())
+            transports.append(transport)
+
+    threading.Thread(target=accept, daemon=True).start()
+    server.port = listener.getsockname()[1]
+    yield server
+    listener.close()
+    for transport in transports:
+        transport.close()
+
+
+@pytest.fixture
+def sftp(server):
+    with warnings.catch_warnings():
+        # known_hosts нет, проверка ключа хоста отключается ниже
+        warnings.simplefilter('ignore')
+        cnopts = pysftp.CnOpts()
+    cnopts.hostkeys = None
+    return Sftp(USERNAME, PASSWORD, '127.0.0.1', server.port, cnopts=cnopts)
+
+
+@pytest.fixture
+def local(tmp_path):
+    folder = tmp_path / 'local'
+    folder.mkdir()
+    for index in range(1, 7):
+        (folder / f'{index}_1_0_resize.jpg').write_bytes(b'x' * index)
+    return str(folder) + '/'
+
+
+def remote_files(server: FakeServer) -> dict:
+    folder = os.path.join(server.root, 'Photo')
+    return {name: os.path.getsize(os.path.join(folder, name))
+            for name in os.listdir(folder)}
+
+
+def test_upload_files_parallel_uses_several_sessions(server, sftp, local,
+                                                     tmp_path):
+    manifest_path = str(tmp_path / 'manifest.json')
+
+    uploaded = sftp.upload_files_parallel(local, 'Photo',
+                                          manifest_path=manifest_path,
+                                          workers=3)
+
+    assert uploaded == 6
+    assert remote_files(server) == {f'{index}_1_0_resize.jpg': index
+                                    for index in range(1, 7)}
+    assert server.max_active > 1
+    assert len({session for session, _ in server.puts}) > 1
+    assert len(SftpManifest(manifest_path)) == 6
+
+
+def test_upload_files_parallel_skips_files_in_manifest(server, sftp, local,
+                                                       tmp_path):
+    manifest_path = str(tmp_path / 'manifest.json')
+    sftp.upload_files_parallel(local, 'Photo', manifest_path=manifest_path,
+                               workers=2)
+    server.puts.clear()
+
+    assert sftp.upload_files_parallel(local, 'Photo',
+                                      manifest_path=manifest_path) == 0
+    assert server.puts == []
+
+    # измененный файл загружается повторно
+    with open(local + '2_1_0_resize.jpg', 'ab') as file:
+        file.write(b'y')
+    assert sftp.upload_files_parallel(local, 'Photo',
+                                      manifest_path=manifest_path) == 1
+    assert [path for _, path in server.puts] == ['/Photo/2_1_0_resize.jpg']
+
+
+def test_reconcile_marks_files_with_same_size(server, sftp, local, tmp_path):
+    folder = os.path.join(server.root, 'Photo')
+    with open(os.path.join(folder, '1_1_0_resize.jpg'), 'wb') as file:
+        file.write(b'x')
+    with open(os.path.join(folder, '2_1_0_resize.jpg'), 'wb') as file:
+        file.write(b'x' * 10)
+    manifest = SftpManifest(str(tmp_path / 'manifest.json'))
+    manifest.add('9_1_0_resize.jpg', 9, 1.0)
+
+    assert sftp.reconcile(local, 'Photo', manifest) == 1
+    stat = os.stat(local + '1_1_0_resize.jpg')
+    assert manifest.files == {'1_1_0_resize.jpg': [stat.st_size,
+                                                   stat.st_mtime]}
+    assert SftpManifest(manifest.path).files == manifest.files
+
+    # без манифеста upload_files_parallel сверяется с сервером и
+    # не загружает 1_1_0_resize.jpg повторно
+    os.remove(manifest.path)
+    assert sftp.upload_files_parallel(local, 'Photo',
+                                      manifest_path=manifest.path) == 5
+    assert '/Photo/1_1_0_resize.jpg' not in \
+        [path for _, path in server.puts]
+    assert remote_files(server)['2_1_0_resize.jpg'] == 2
+
+
+def test_pusher_pushes_from_threads_and_skips_manifest(server, sftp, local,
+                                                       tmp_path):
+    manifest_path = str(tmp_path / 'manifest.json')
+    pusher = SftpPusher(sftp, local, 'Photo', manifest_path=manifest_path)
+    files = sorted(os.listdir(local))
+    counts = []
+    threads = [threading.Thread(target=lambda part: counts.append(
+        pusher.push(part)), args=(files[index::2],)) for index in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sum(counts) == 6
+    assert len({session for session, _ in server.puts}) == 2
+    assert pusher.push(files) == 0
+    pusher.close()
+
+    assert set(SftpManifest(manifest_path).files) == set(files)
+    assert remote_files(server) == {file: os.path.getsize(local + file)
+                                    for file in files}
@@ -0,0 +1,160 @@
+"""
+Загрузка на ЯндексДиск через локальный сервер, имитирующий REST API
+ЯндексДиска (см. YaDiskStorage(api_url=...)).
+"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+import pytest
+
+from YandexDiskKeeper.keeper import YaDiskStorage, YaDiskUploader
+
+
+class FakeDisk:
+    """
+    Состояние диска: {путь: {'size', 'public_url'}} и число загрузок.
+    """
+
+    def __init__(self) -> None:
+        self.files = {}
+        self.uploads = []
+        self.lock = threading.Lock()
+
+
+def make_handler(disk: FakeDisk):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args) -> None:
+            pass
+
+        def reply(self, status: int, body=None) -> None:
+            data = json.dumps(body or {}).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def not_found(self) -> None:
+            self.reply(404, {'error': 'DiskNotFoundError',
+                             'message': 'not found',
+                             'description': 'Resource not found.'})
+
+        def link(self, href: str, method: str) -> None:
+            self.reply(200, {'href': href, 'method': method,
+                             'templated': False})
+
+        def do_GET(self) -> None:
+            url = urlsplit(self.path)
+            path = parse_qs(url.query)['path'][0]
+            with disk.lock:
+                meta = disk.files.get(path)
+            if url.path == '/v1/disk/resources':
+                if meta is None:
+                    return self.not_found()
+                return self.reply(200, {
+                    'type': 'file', 'path': path,
+                    'name': path.rsplit('/', 1)[-1], 'size': meta['size'],
+                    'public_url': meta['public_url']})
+            if url.path == '/v1/disk/resources/upload':
+                host, port = self.server.server_address
+                return self.link(f'http://{host}:{port}/put?path={path}',
+                                 'PUT')
+            self.not_found()
+
+        def do_PUT(self) -> None:
+            url = urlsplit(self.path)
+            path = parse_qs(url.query)['path'][0]
+            if url.path == '/put':
+                size = int(self.headers.get('Content-Length', 0))
+                self.rfile.read(size)
+                with disk.lock:
+                    disk.uploads.append(path)
+                    disk.files[path] = {'size': size, 'public_url': None}
+                return self.reply(201)
+            if url.path == '/v1/disk/resources/publish':
+                with disk.lock:
+                    meta = disk.files.get(path)
+                    if meta is None:
+                        return self.not_found()
+                    meta['public_url'] = meta['public_url'] or \
+                        f'https://yadi.sk/d/{len(disk.files)}'
+                return self.link(f'https://cloud-api.yandex.net/v1/disk/'
+                                 f'resources?path={path}', 'GET')
+            self.not_found()
+
+    return Handler
+
+
+@pytest.fixture
+def disk():
+    disk = FakeDisk()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(disk))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.server_address
+    disk.api_url = f'http://{host}:{port}'
+    yield disk
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def files(tmp_path):
+    for name, size in (('a.pdf', 10), ('b.pdf', 20), ('c.pdf', 30)):
+        (tmp_path / name).write_bytes(b'x' * size)
+    return str(tmp_path) + '/'
+
+
+def test_upload_file_skips_same_size_file(disk, files):
+    disk.files['disk:/Media/a.pdf'] = {'size': 10,
+                                       'public_url': 'https://yadi.sk/d/a'}
+    storage = YaDiskStorage('token', api_url=disk.api_url)
+
+    href = storage.upload_file(files + 'a.pdf', '/Media/', 'a.pdf')
+
+    assert href == 'https://yadi.sk/d/a'
+    assert disk.uploads == []
+
+
+def test_upload_file_publishes_same_size_unpublished_file(disk, files):
+    disk.files['disk:/Media/a.pdf'] = {'size': 10, 'public_url': None}
+    storage = YaDiskStorage('token', api_url=disk.api_url)
+
+    href = storage.upload_file(files + 'a.pdf', '/Media/', 'a.pdf')
+
+    assert href.startswith('https://yadi.sk/d/')
+    assert disk.uploads == []
+
+
+def test_upload_file_overwrites_different_size_file(disk, files):
+    disk.files['disk:/Media/a.pdf'] = {'size': 3, 'public_url': None}
+    storage = YaDiskStorage('token', api_url=disk.api_url)
+
+    storage.upload_file(files + 'a.pdf', '/Media/', 'a.pdf')
+
+    assert disk.uploads == ['disk:/Media/a.pdf']
+    assert disk.files['disk:/Media/a.pdf']['size'] == 10
+
+
+def test_uploader_resume_uploads_only_missing_files(disk, files):
+    # a.pdf загружен и опубликован, b.pdf загружен до аварийного
+    # завершения, но не опубликован, c.pdf не загружен
+    disk.files['disk:/Media/a.pdf'] = {'size': 10,
+                                       'public_url': 'https://yadi.sk/d/a'}
+    disk.files['disk:/Media/b.pdf'] = {'size': 20, 'public_url': None}
+    uploader = YaDiskUploader(YaDiskStorage('token', api_url=disk.api_url),
+                              files, '/Media/', workers=2, retries=0)
+    batches = []
+
+    uploaded, failed = uploader.run(
+        [(1, 'a.pdf', None), (2, 'b.pdf', None), (3, 'c.pdf', None)],
+        on_batch=batches.append, batch_size=2)
+
+    assert (uploaded, failed) == (3, 0)
+    assert disk.uploads == ['disk:/Media/c.pdf']
+    links = dict(row for batch in batches for row in batch)
+    assert sorted(links) == [1, 2, 3]
+    assert links[1] == 'https://yadi.sk/d/a'
+    assert all(links.values())